@@ -0,0 +1,100 @@
+import argparse
+import time
+import cv2
+import numpy as np
+from src.evaluate.car_detection import BLACK_BGR, BLUE_BGR, LILAC_BGR, mark_parked_cars
+
+
+def reference_mark_parked_cars(image):
+    """
+    Original per-contour implementation of car_detection, kept as the reference for correctness and speed.
+    """
+    image = image.copy()
+    original_blue_mask = np.all(image == BLUE_BGR, axis=-1)
+    contours, _ = cv2.findContours(original_blue_mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    for contour in contours:
+        mask = np.zeros_like(image[:, :, 0], dtype=np.uint8)
+        cv2.drawContours(mask, [contour], -1, 255, thickness=cv2.FILLED)
+
+        kernel = np.ones((15, 15), np.uint8)
+        dilated_mask = cv2.dilate(mask, kernel, iterations=1)
+
+        black_count = np.sum(np.all(image[dilated_mask == 255] == BLACK_BGR, axis=-1))
+        lilac_count = np.sum(np.all(image[dilated_mask == 255] == LILAC_BGR, axis=-1))
+
+        if black_count > lilac_count:
+            change_mask = np.logical_and(original_blue_mask, mask)
+            image[change_mask] = [0, 255, 255]
+
+    return image
+
+
+def synthetic_scene(height, width, n_cars, seed=0):
+    """
+    Build a color-coded BGR segmentation with roads, background blocks and randomly placed cars.
+
+    Parameters:
+    - height (int): Height of the scene.
+    - width (int): Width of the scene.
+    - n_cars (int): Number of cars to draw.
+    - seed (int, optional): Seed of the random generator. Default is 0.
+
+    Returns:
+    - numpy.ndarray: The BGR scene.
+    """
+    rng = np.random.default_rng(seed)
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+
+    # Horizontal and vertical streets over a background
+    for y in range(0, height, 120):
+        image[y:y + 40] = LILAC_BGR
+    for x in range(0, width, 160):
+        image[:, x:x + 40] = LILAC_BGR
+
+    for _ in range(n_cars):
+        h, w = rng.integers(6, 14), rng.integers(10, 24)
+        y, x = rng.integers(0, height - h), rng.integers(0, width - w)
+        image[y:y + h, x:x + w] = BLUE_BGR
+    return image
+
+
+def run(sizes, densities, repeats=3):
+    """
+    Time the reference and the current car classification on synthetic scenes and check they match.
+
+    Parameters:
+    - sizes (List[int]): Side lengths of the square scenes.
+    - densities (List[float]): Number of cars per 10,000 pixels.
+    - repeats (int, optional): Number of timed runs; the best one is reported. Default is 3.
+    """
+    print(f"{'size':>6} {'cars':>7} {'reference (s)':>14} {'current (s)':>12} {'speedup':>8}")
+    for size in sizes:
+        for density in densities:
+            n_cars = int(size * size * density / 10_000)
+            image = synthetic_scene(size, size, n_cars)
+
+            timings = {}
+            for name, fn in (('reference', reference_mark_parked_cars), ('current', mark_parked_cars)):
+                best = float('inf')
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    result = fn(image)
+                    best = min(best, time.perf_counter() - start)
+                timings[name] = (best, result)
+
+            if not np.array_equal(timings['reference'][1], timings['current'][1]):
+                raise AssertionError(f"Outputs differ for size={size}, density={density}")
+
+            ref, cur = timings['reference'][0], timings['current'][0]
+            print(f"{size:>6} {n_cars:>7} {ref:>14.3f} {cur:>12.4f} {ref / cur:>7.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark car_detection on synthetic dense scenes.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512, 1024])
+    parser.add_argument('--densities', type=float, nargs='+', default=[2.0, 8.0])
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    run(args.sizes, args.densities, args.repeats)
@@ -0,0 +1,120 @@
+import argparse
+import time
+from src.data.dataset import build_dataloaders
+from src.models.model_loader import load_config
+from src.models.train import build_datablock
+
+
+def stage_latency(dl, n_batches=5):
+    """
+    Time each stage of the data pipeline of a DataLoader in the current process.
+
+    Stages:
+    - 'load': reading the item (get_x/get_y, e.g. JPEG decoding or a cache hit) and the type transforms.
+    - 'item_tfms': the item transforms (e.g. Resize).
+    - 'collate': stacking the items into a batch.
+    - 'batch_tfms': the batch transforms (augmentations and normalization), which always run in the main
+      process.
+
+    Parameters:
+    - dl (TfmdDL): The DataLoader (e.g. dls.train).
+    - n_batches (int, optional): Number of batches to time. Default is 5.
+
+    Returns:
+    - dict: The mean latency of each stage, in milliseconds per sample.
+    """
+    totals = {'load': 0.0, 'item_tfms': 0.0, 'collate': 0.0, 'batch_tfms': 0.0}
+    n_samples = 0
+    idxs = list(range(min(len(dl.dataset), n_batches * dl.bs)))
+    for start in range(0, len(idxs), dl.bs):
+        batch_idxs = idxs[start:start + dl.bs]
+
+        t0 = time.perf_counter()
+        items = [dl.create_item(i) for i in batch_idxs]
+        t1 = time.perf_counter()
+        items = [dl.after_item(item) for item in items]
+        t2 = time.perf_counter()
+        batch = dl.create_batch(dl.before_batch(items))
+        t3 = time.perf_counter()
+        dl.after_batch(batch)
+        t4 = time.perf_counter()
+
+        totals['load'] += t1 - t0
+        totals['item_tfms'] += t2 - t1
+        totals['collate'] += t3 - t2
+        totals['batch_tfms'] += t4 - t3
+        n_samples += len(batch_idxs)
+    return {stage: 1000 * total / max(n_samples, 1) for stage, total in totals.items()}
+
+
+def throughput(dl, n_batches=20):
+    """
+    Measure the end-to-end throughput of a DataLoader, including its worker processes.
+
+    Parameters:
+    - dl (TfmdDL): The DataLoader (e.g. dls.train).
+    - n_batches (int, optional): Maximum number of batches to read. Default is 20.
+
+    Returns:
+    - dict: The time to the first batch (worker startup included) in seconds, the samples per second after
+      the first batch and the mean wait per batch in milliseconds.
+    """
+    start = time.perf_counter()
+    first = None
+    n_samples = n_read = 0
+    for i, (xb, _) in enumerate(dl):
+        if first is None:
+            first = time.perf_counter()
+        else:
+            n_samples += len(xb)
+            n_read += 1
+        if i + 1 >= n_batches:
+            break
+    end = time.perf_counter()
+
+    elapsed = end - (first or end)
+    return {'first_batch_s': (first or end) - start,
+            'samples_per_sec': n_samples / elapsed if elapsed > 0 else float('nan'),
+            'wait_ms': 1000 * elapsed / n_read if n_read else float('nan')}
+
+
+def run(config_path, workers, n_batches=20):
+    """
+    Build the exact training DataBlock of a configuration and benchmark its pipeline across worker counts.
+
+    Parameters:
+    - config_path (str): Path to the configuration file.
+    - workers (List[int]): Worker counts to try.
+    - n_batches (int, optional): Number of batches read for each worker count. Default is 20.
+
+    Returns:
+    - List[dict]: One result per worker count.
+    """
+    config = load_config(config_path)
+    datablock = build_datablock(config, config_path)
+    source = config['data']['path_to_dataset']
+
+    dls = build_dataloaders(datablock, source, config['data'], num_workers=0)
+    stages = stage_latency(dls.train)
+    print("Per-sample latency by stage (ms, main process): "
+          + ", ".join(f"{stage} {value:.2f}" for stage, value in stages.items()))
+
+    results = []
+    print(f"{'workers':>8} {'first batch (s)':>16} {'samples/s':>10} {'wait/batch (ms)':>16}")
+    for num_workers in workers:
+        dls = build_dataloaders(datablock, source, config['data'], num_workers=num_workers)
+        result = {'num_workers': num_workers, **throughput(dls.train, n_batches), **stages}
+        results.append(result)
+        print(f"{num_workers:>8} {result['first_batch_s']:>16.2f} {result['samples_per_sec']:>10.1f} "
+              f"{result['wait_ms']:>16.1f}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the training data pipeline across worker counts.")
+    parser.add_argument('--config', default='config.yml')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4, 8])
+    parser.add_argument('--batches', type=int, default=20)
+    args = parser.parse_args()
+
+    run(args.config, args.workers, args.batches)
@@ -0,0 +1,108 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from src.cli import COMMAND_MODULES
+
+# Modules that take seconds to import
+HEAVY_MODULES = ('torch', 'fastai', 'matplotlib', 'segmentation_models_pytorch', 'seaborn', 'pandas')
+
+# Startup budget of the subcommands launched by batch jobs: wall time (s) of a fresh interpreter that imports
+# the CLI and the modules of the subcommand, and the heavy modules it must not load
+BUDGETS = {
+    'tile': (1.0, HEAVY_MODULES),
+    'detect-cars': (1.0, HEAVY_MODULES),
+    'infer': (1.0, HEAVY_MODULES),
+}
+
+_PROBE = """
+import importlib, json, sys, time
+start = time.perf_counter()
+for module in sys.argv[1:]:
+    importlib.import_module(module)
+print(json.dumps({'import_s': time.perf_counter() - start, 'modules': sorted(sys.modules)}))
+"""
+
+
+def measure_startup(command, repeats=3):
+    """
+    Measure the startup of a subcommand of src.cli in fresh interpreters.
+
+    Parameters:
+    - command (str): The subcommand (a key of src.cli.COMMAND_MODULES).
+    - repeats (int, optional): Number of interpreters started; the fastest one is reported. Default is 3.
+
+    Returns:
+    - dict: The 'wall_s' of the fastest interpreter (start, imports and exit), the median 'import_s' of the
+      modules, the 'heavy' modules loaded, and an 'error' if the modules can't be imported (e.g. a missing
+      optional dependency).
+    """
+    modules = ['src.cli', *COMMAND_MODULES[command]]
+    walls, imports = [], []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', _PROBE, *modules], capture_output=True, text=True)
+        walls.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            error = (result.stderr.strip().splitlines() or ['import failed'])[-1]
+            return {'command': command, 'wall_s': None, 'import_s': None, 'heavy': [], 'error': error}
+        probe = json.loads(result.stdout.strip().splitlines()[-1])
+        imports.append(probe['import_s'])
+        loaded = set(probe['modules'])
+    heavy = [module for module in HEAVY_MODULES if module in loaded]
+    return {'command': command, 'wall_s': min(walls), 'import_s': statistics.median(imports), 'heavy': heavy,
+            'error': None}
+
+
+def check_budgets(results, scale=1.0):
+    """
+    Compare the startup of the subcommands with their budget (see BUDGETS).
+
+    Parameters:
+    - results (List[dict]): The measures of measure_startup.
+    - scale (float, optional): Factor applied to the time budgets (e.g. 2 on a slow machine). Default is 1.
+
+    Returns:
+    - List[str]: A description of each violation.
+    """
+    violations = []
+    for result in results:
+        if result['command'] not in BUDGETS:
+            continue
+        seconds, forbidden = BUDGETS[result['command']]
+        if result['error']:
+            violations.append(f"{result['command']}: {result['error']}")
+            continue
+        heavy = [module for module in result['heavy'] if module in forbidden]
+        if heavy:
+            violations.append(f"{result['command']}: imports {', '.join(heavy)}")
+        if result['wall_s'] > seconds * scale:
+            violations.append(f"{result['command']}: starts in {result['wall_s']:.2f} s "
+                              f"(budget {seconds * scale:.2f} s)")
+    return violations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Startup time and heavy imports of the subcommands of src.cli.")
+    parser.add_argument('--only', nargs='+', choices=list(COMMAND_MODULES), help="Subcommands to measure.")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--scale', type=float, default=1.0, help="Factor applied to the time budgets.")
+    args = parser.parse_args()
+
+    results = [measure_startup(command, args.repeats) for command in args.only or COMMAND_MODULES]
+    print(f"{'command':<12} {'wall_s':>8} {'import_s':>9}  heavy modules")
+    for result in results:
+        if result['error']:
+            print(f"{result['command']:<12} {'-':>8} {'-':>9}  {result['error']}")
+        else:
+            print(f"{result['command']:<12} {result['wall_s']:>8.3f} {result['import_s']:>9.3f}  "
+                  f"{', '.join(result['heavy']) or '-'}")
+
+    violations = check_budgets(results, args.scale)
+    for violation in violations:
+        print(f"Over budget: {violation}")
+    if violations:
+        sys.exit(1)
+    print("All subcommands within budget.")
@@ -0,0 +1,268 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+import numpy as np
+
+# Color-to-class mapping of config.yml
+MAPPING = {(107, 142, 35): 0, (102, 102, 156): 0, (128, 64, 128): 1, (0, 0, 142): 2, (0, 0, 0): 0}
+
+
+def synthetic_mask(size, density, seed=0):
+    """
+    Build an RGB mask with the colors of MAPPING: a background with roads and random car rectangles.
+
+    Parameters:
+    - size (int): Side of the square mask.
+    - density (float): Number of cars per 10,000 pixels.
+    - seed (int, optional): Seed of the random generator. Default is 0.
+
+    Returns:
+    - numpy.ndarray: The RGB mask.
+    """
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((size, size, 3), dtype=np.uint8)
+    mask[:] = (107, 142, 35)
+    for y in range(0, size, 120):
+        mask[y:y + 40] = (128, 64, 128)
+    for _ in range(int(size * size * density / 10_000)):
+        h, w = rng.integers(6, 14), rng.integers(10, 24)
+        y, x = rng.integers(0, size - h), rng.integers(0, size - w)
+        mask[y:y + h, x:x + w] = (0, 0, 142)
+    return mask
+
+
+# Folder of the files written by the cases, created and removed by run
+_scratch_root = None
+
+
+def _scratch_dir(prefix):
+    """
+    Create a folder for the files of a case, removed with the others when run returns.
+    """
+    return tempfile.mkdtemp(prefix=prefix, dir=_scratch_root)
+
+
+def _quiet(fn):
+    """
+    Wrap a function so that its progress messages are not printed.
+    """
+    def run():
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            return fn()
+    return run
+
+
+def _case_normalize_mask(size, density):
+    from src.utils.transforms import normalize_mask
+    mask = synthetic_mask(size, density)
+    return lambda: normalize_mask(mask, MAPPING)
+
+
+def _case_denormalize_mask(size, density):
+    from src.utils.transforms import denormalize_mask, normalize_mask
+    class_mask = normalize_mask(synthetic_mask(size, density), MAPPING)
+    return lambda: denormalize_mask(class_mask, MAPPING)
+
+
+def _case_add_shadow(size, num_shadows):
+    from src.utils.transforms import add_shadow
+    image = np.random.default_rng(0).integers(0, 256, (size, size, 3), dtype=np.uint8)
+    return lambda: add_shadow(image, num_shadows, 0.5, 0.75)
+
+
+def _case_add_shadow_batch(size, num_shadows):
+    import torch
+    from src.utils.transforms import add_shadow_batch
+    images = torch.rand(8, 3, size, size, generator=torch.Generator().manual_seed(0))
+    generator = torch.Generator().manual_seed(0)
+    return lambda: add_shadow_batch(images, num_shadows, 0.5, 0.75, generator=generator)
+
+
+def _case_split_image(size, tile):
+    from PIL import Image
+    from src.data.split_image import split_image
+    folder = _scratch_dir('bench_split_')
+    path = os.path.join(folder, 'image.png')
+    Image.fromarray(np.random.default_rng(0).integers(0, 256, (size, size, 3), dtype=np.uint8)).save(path)
+    output = os.path.join(folder, 'tiles')
+    return _quiet(lambda: split_image(path, output, tile, tile, output_format='npy'))
+
+
+def _case_car_detection(size, density):
+    from benchmarks.car_detection import synthetic_scene
+    from src.evaluate.car_detection import mark_parked_cars
+    scene = synthetic_scene(size, size, int(size * size * density / 10_000))
+    return lambda: mark_parked_cars(scene)
+
+
+def _case_detect_vehicles(size, density):
+    from src.evaluate.car_detection import detect_vehicles
+    from src.utils.transforms import normalize_mask
+    class_mask = normalize_mask(synthetic_mask(size, density), MAPPING)
+    return lambda: detect_vehicles(class_mask)
+
+
+def _case_save_metrics_to_csv(epochs, n_metrics):
+    from src.utils.metrics import save_metrics_to_csv
+    values = [list(np.random.default_rng(e).random(n_metrics + 2)) for e in range(epochs)]
+    names = ['epoch', 'train_loss', 'valid_loss'] + [f'metric_{i}' for i in range(n_metrics)] + ['time']
+    learner = SimpleNamespace(recorder=SimpleNamespace(values=values, metric_names=names))
+    path = os.path.join(_scratch_dir('bench_metrics_'), 'metrics.csv')
+    return _quiet(lambda: save_metrics_to_csv(learner, file_path=path))
+
+
+# (function, parameter names, parameter grid)
+CASES = {
+    'normalize_mask': (_case_normalize_mask, ('size', 'density'), [(256, 8.0), (1024, 2.0), (1024, 8.0), (2048, 8.0)]),
+    'denormalize_mask': (_case_denormalize_mask, ('size', 'density'), [(256, 8.0), (1024, 8.0), (2048, 8.0)]),
+    'add_shadow': (_case_add_shadow, ('size', 'shadows'), [(256, 3), (1024, 3), (1024, 8)]),
+    'add_shadow_batch': (_case_add_shadow_batch, ('size', 'shadows'), [(256, 3), (256, 8)]),
+    'split_image': (_case_split_image, ('size', 'tile'), [(1024, 256), (2048, 256), (2048, 512)]),
+    'car_detection': (_case_car_detection, ('size', 'density'), [(256, 8.0), (1024, 2.0), (1024, 8.0)]),
+    'detect_vehicles': (_case_detect_vehicles, ('size', 'density'), [(1024, 2.0), (1024, 8.0)]),
+    'save_metrics_to_csv': (_case_save_metrics_to_csv, ('epochs', 'metrics'), [(10, 3), (1000, 3)]),
+}
+
+
+def case_id(name, param_names, params):
+    """
+    Return the identifier of a benchmark case, e.g. 'normalize_mask[size=1024,density=8.0]'.
+    """
+    return f"{name}[{','.join(f'{k}={v}' for k, v in zip(param_names, params))}]"
+
+
+def time_call(fn, repeats=5, min_time=0.05):
+    """
+    Time a callable: the number of calls per run is chosen so that a run lasts at least min_time seconds.
+
+    Returns:
+    - dict: The 'min' and 'median' seconds per call over the runs, and the 'number' of calls per run.
+    """
+    fn()  # Warm-up (imports, caches, lookup tables)
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(min_time / elapsed) + 1)
+
+    runs = [elapsed / number]
+    for _ in range(repeats - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        runs.append((time.perf_counter() - start) / number)
+    return {'min': min(runs), 'median': statistics.median(runs), 'number': number}
+
+
+def run(names=None, repeats=5, min_time=0.05):
+    """
+    Run the benchmark cases.
+
+    Parameters:
+    - names (List[str], optional): Functions to benchmark (keys of CASES). Defaults to all.
+    - repeats (int, optional): Number of timed runs per case. Default is 5.
+    - min_time (float, optional): Minimum duration of each run, in seconds. Default is 0.05.
+
+    Returns:
+    - dict: The results, with the environment under 'meta' and the timings of each case under 'results'.
+    """
+    global _scratch_root
+
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory(prefix='bench_') as _scratch_root:
+            for name in names or CASES:
+                make_case, param_names, grid = CASES[name]
+                for params in grid:
+                    key = case_id(name, param_names, params)
+                    results[key] = time_call(make_case(*params), repeats, min_time)
+                    print(f"{key:<50} {results[key]['median'] * 1000:>10.3f} ms")
+    finally:
+        _scratch_root = None
+
+    meta = {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+            'processor': platform.processor(), 'cpus': os.cpu_count(), 'node': platform.node()}
+    return {'meta': meta, 'results': results}
+
+
+def compare(baseline, current, threshold=0.25):
+    """
+    Compare two benchmark results by their median times.
+
+    Parameters:
+    - baseline (dict): The baseline results, as returned by run.
+    - current (dict): The current results.
+    - threshold (float, optional): Maximum relative slowdown allowed. Default is 0.25 (25% slower).
+
+    Returns:
+    - List[str]: The cases that are slower than the baseline by more than the threshold.
+    """
+    regressions = []
+    print(f"{'case':<50} {'baseline (ms)':>14} {'current (ms)':>13} {'ratio':>7}")
+    for key, result in current['results'].items():
+        if key not in baseline['results']:
+            continue
+        ratio = result['median'] / baseline['results'][key]['median']
+        flag = ' SLOWER' if ratio > 1 + threshold else ''
+        print(f"{key:<50} {baseline['results'][key]['median'] * 1000:>14.3f} "
+              f"{result['median'] * 1000:>13.3f} {ratio:>6.2f}x{flag}")
+        if flag:
+            regressions.append(key)
+    return regressions
+
+
+def _load(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def _save(results, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f"Results saved to {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the numeric hot paths on synthetic data.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="Run the benchmarks and optionally save them as JSON.")
+    run_parser.add_argument('--only', nargs='+', choices=list(CASES), help="Functions to benchmark.")
+    run_parser.add_argument('--repeats', type=int, default=5)
+    run_parser.add_argument('--min-time', type=float, default=0.05)
+    run_parser.add_argument('--output', help="JSON file where the results are saved (e.g. a new baseline).")
+    run_parser.add_argument('--baseline', help="JSON baseline to compare the results with.")
+    run_parser.add_argument('--threshold', type=float, default=0.25)
+
+    compare_parser = subparsers.add_parser('compare', help="Compare two saved results.")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.25)
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        current = run(args.only, args.repeats, args.min_time)
+        if args.output:
+            _save(current, args.output)
+        baseline = _load(args.baseline) if args.baseline else None
+    else:
+        baseline, current = _load(args.baseline), _load(args.current)
+
+    if baseline is not None:
+        regressions = compare(baseline, current, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} case(s) slower than the baseline by more than {args.threshold:.0%}.")
+            sys.exit(1)
+        print("No regressions.")
@@ -0,0 +1,173 @@
+import argparse
+import sys
+
+# Modules imported by each subcommand. Only the light ones (tile, detect-cars, infer with an exported model) are
+# imported by short batch jobs, so they must not pull in PyTorch, fastai or matplotlib (see benchmarks.startup).
+COMMAND_MODULES = {
+    'tile': ['src.data.split_image'],
+    'train': ['src.models.train'],
+    'evaluate': ['src.evaluate.evaluate'],
+    'infer': ['src.models.inference', 'src.models.export', 'src.models.model_loader', 'src.utils.mask_codec'],
+    'detect-cars': ['src.evaluate.car_detection'],
+    'plot': ['src.evaluate.graphics'],
+}
+
+
+def tile(args):
+    """
+    Split an image into chunks, in a folder or, with --shard, in a shard.
+    """
+    if args.shard:
+        from src.data.shards import split_image_to_shard
+        split_image_to_shard(args.input, args.output, args.width, args.height, args.stride_x, args.stride_y)
+    elif args.streaming:
+        from src.data.split_image import split_image_streaming
+        split_image_streaming(args.input, args.output, args.width, args.height, args.stride_x, args.stride_y,
+                              cache_mb=args.cache_mb, workers=args.workers, output_format=args.format,
+                              compress_level=args.compress_level, value_range=args.value_range)
+    else:
+        from src.data.split_image import split_image
+        split_image(args.input, args.output, args.width, args.height, args.stride_x, args.stride_y,
+                    workers=args.workers, output_format=args.format, compress_level=args.compress_level)
+
+
+def train(args):
+    """
+    Train a model with the settings of the configuration file.
+    """
+    from src.models.train import train_model
+    train_model(args.config, args.model_type)
+
+
+def evaluate(args):
+    """
+    Evaluate a trained model on the test dataset.
+    """
+    from src.evaluate.evaluate import evaluate_model
+    evaluate_model(args.config, args.model_path, streaming=not args.in_memory, masks_dir=args.masks_dir)
+
+
+def infer(args):
+    """
+    Segment a full orthophoto with a sliding window. Exported models (.pt/.onnx) are run without fastai.
+    """
+    from src.models.inference import infer_raster, learner_predictor
+    from src.models.model_loader import load_config
+    from src.utils.mask_codec import load_mask_codec
+
+    config = load_config(args.config)
+    palette = load_mask_codec(args.config).palette
+    if args.model_path.endswith('.pkl'):
+        predict = learner_predictor(args.model_path, num_threads=args.threads)
+    else:
+        from src.models.export import ExportedModel
+        predict = ExportedModel(args.model_path, num_threads=args.threads)
+    infer_raster(predict, args.input, args.output, num_classes=config['model']['classes'], tile_size=args.tile_size,
+                 overlap=args.overlap, batch_size=args.batch_size,
+                 colormap={c: tuple(int(v) for v in color) for c, color in enumerate(palette)})
+
+
+def detect_cars(args):
+    """
+    Mark the parked cars of a folder of predicted images, skipping the images already processed.
+    """
+    from src.evaluate.car_detection import car_detection_batch
+    car_detection_batch(args.input, args.output, workers=args.workers, use_hash=args.hash)
+
+
+def plot(args):
+    """
+    Plot a metric of several training logs in one figure.
+    """
+    from src.evaluate.graphics import plot_dfs
+    names = args.names or [path.rsplit('/', 1)[-1].removesuffix('_metrics.csv') for path in args.csv_paths]
+    if len(names) != len(args.csv_paths):
+        raise SystemExit("--names must give one name per CSV file")
+    plot_dfs(args.csv_paths, names, args.column, args.output, args.rows, args.style)
+
+
+def build_parser():
+    """
+    Build the parser of the command line, with one subcommand per task.
+
+    Returns:
+    - argparse.ArgumentParser: The parser.
+    """
+    parser = argparse.ArgumentParser(prog='python -m src.cli', description="Parking segmentation tasks.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    tile_parser = subparsers.add_parser('tile', help="Split an image into chunks.")
+    tile_parser.add_argument('input', help="Source image or raster.")
+    tile_parser.add_argument('output', help="Folder of the chunks (or of the shard with --shard).")
+    tile_parser.add_argument('--width', type=int, default=256)
+    tile_parser.add_argument('--height', type=int, default=256)
+    tile_parser.add_argument('--stride-x', type=int, default=None)
+    tile_parser.add_argument('--stride-y', type=int, default=None)
+    tile_parser.add_argument('--workers', type=int, default=1)
+    tile_parser.add_argument('--format', default='png', choices=['png', 'webp', 'npy'])
+    tile_parser.add_argument('--compress-level', type=int, default=6)
+    tile_parser.add_argument('--streaming', action='store_true',
+                             help="Read the chunks window by window with rasterio (large rasters).")
+    tile_parser.add_argument('--cache-mb', type=int, default=128, help="GDAL block cache with --streaming.")
+    tile_parser.add_argument('--value-range', type=float, nargs=2, default=None, metavar=('MIN', 'MAX'),
+                             help="Values mapped to 0-255 with --streaming, for rasters that aren't uint8.")
+    tile_parser.add_argument('--shard', action='store_true', help="Write the chunks to a shard.")
+    tile_parser.set_defaults(func=tile)
+
+    train_parser = subparsers.add_parser('train', help="Train a model.")
+    train_parser.add_argument('model_type', nargs='?', default='pspnet')
+    train_parser.add_argument('--config', default='config.yml')
+    train_parser.set_defaults(func=train)
+
+    evaluate_parser = subparsers.add_parser('evaluate', help="Evaluate a trained model on the test dataset.")
+    evaluate_parser.add_argument('model_path', help="Exported learner (.pkl).")
+    evaluate_parser.add_argument('--config', default='config.yml')
+    evaluate_parser.add_argument('--masks-dir', default=None, help="Folder where the predicted masks are written.")
+    evaluate_parser.add_argument('--in-memory', action='store_true',
+                                 help="Keep the probabilities of the whole test set in memory.")
+    evaluate_parser.set_defaults(func=evaluate)
+
+    infer_parser = subparsers.add_parser('infer', help="Segment a full orthophoto with a sliding window.")
+    infer_parser.add_argument('model_path', help="Exported learner (.pkl) or model exported with src.models.export "
+                                                 "(.pt/.onnx).")
+    infer_parser.add_argument('input', help="Source raster (e.g. a GeoTIFF orthophoto).")
+    infer_parser.add_argument('output', help="Output class mask (GeoTIFF).")
+    infer_parser.add_argument('--config', default='config.yml')
+    infer_parser.add_argument('--tile-size', type=int, default=256)
+    infer_parser.add_argument('--overlap', type=int, default=64)
+    infer_parser.add_argument('--batch-size', type=int, default=8)
+    infer_parser.add_argument('--threads', type=int, default=None)
+    infer_parser.set_defaults(func=infer)
+
+    detect_parser = subparsers.add_parser('detect-cars', help="Mark the parked cars of predicted images.")
+    detect_parser.add_argument('input', help="Folder of the predicted images.")
+    detect_parser.add_argument('output', help="Folder of the results and the manifest.")
+    detect_parser.add_argument('--workers', type=int, default=None)
+    detect_parser.add_argument('--hash', action='store_true', help="Detect changed images by content hash.")
+    detect_parser.set_defaults(func=detect_cars)
+
+    plot_parser = subparsers.add_parser('plot', help="Compare a metric of several training logs.")
+    plot_parser.add_argument('csv_paths', nargs='+', help="Metrics CSV files (e.g. results/logs/pspnet_metrics.csv).")
+    plot_parser.add_argument('--names', nargs='+', default=None, help="Legend names. Default: the model types.")
+    plot_parser.add_argument('--column', default='dice_multi')
+    plot_parser.add_argument('--output', default='results/figures/comparison.png')
+    plot_parser.add_argument('--rows', type=int, default=None, help="Plot only the first epochs.")
+    plot_parser.add_argument('--style', default='darkgrid')
+    plot_parser.set_defaults(func=plot)
+    return parser
+
+
+def main(argv=None):
+    """
+    Run a subcommand. Each subcommand imports only the modules it needs, so that the short tasks (tile,
+    detect-cars, infer with an exported model) start without loading PyTorch, fastai or matplotlib.
+
+    Parameters:
+    - argv (List[str], optional): The arguments. Defaults to sys.argv.
+    """
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,244 @@
+import hashlib
+import json
+import os
+import numpy as np
+import yaml
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from pathlib import Path
+from PIL import Image
+from src.utils.mask_codec import DEFAULT_CONFIG_PATH, load_mask_codec
+
+
+def _digest(value, length=16):
+    """
+    Compute a short, stable hexadecimal digest of a JSON-serializable value.
+    """
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode()).hexdigest()[:length]
+
+
+class ArrayCache:
+    """
+    A persistent on-disk cache of preprocessed numpy arrays, keyed by source file.
+
+    Each entry is stored as an uncompressed '.npy' file, so it can be memory-mapped when read. The entry name
+    is derived from the resolved source path together with its modification time and size, so a modified
+    source file simply misses the cache and is rebuilt, while untouched files are never processed again.
+    Entries are written atomically, which makes the cache safe to fill from several DataLoader workers.
+
+    Parameters:
+    - root (str or Pathlib.Path): Base directory of the cache.
+    - build_fn (callable): Function that takes a source path and returns the array to cache. It must be
+                           picklable (a module-level function or a functools.partial of one) for parallel builds.
+    - params (optional): JSON-serializable description of everything else that affects the cached arrays
+                         (palette, target size, ...). Caches with different params live in different folders.
+    """
+    def __init__(self, root, build_fn, params=None):
+        self.root = Path(root) / _digest(params)
+        self.build_fn = build_fn
+        self.params = params
+
+    def _prefix(self, source):
+        return hashlib.sha1(str(Path(source).resolve()).encode()).hexdigest()[:20]
+
+    def entry_path(self, source):
+        """
+        Return the path of the cache entry for the current version of a source file.
+
+        Parameters:
+        - source (str or Pathlib.Path): Path to the source file.
+
+        Returns:
+        - Pathlib.Path: The path of the '.npy' cache entry.
+        """
+        stat = os.stat(source)
+        return self.root / f"{self._prefix(source)}_{stat.st_mtime_ns}_{stat.st_size}.npy"
+
+    def is_fresh(self, source):
+        """
+        Check whether a source file has an up-to-date cache entry.
+        """
+        return self.entry_path(source).exists()
+
+    def _write(self, source, entry):
+        # Remove outdated versions of the entry (the temporary files of other writers don't end in '.npy')
+        for stale in self.root.glob(f"{self._prefix(source)}_*.npy"):
+            if stale != entry:
+                stale.unlink(missing_ok=True)
+
+        array = np.ascontiguousarray(self.build_fn(source))
+        tmp_path = entry.with_name(f"{entry.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'wb') as file:
+            np.save(file, array)
+        try:
+            os.replace(tmp_path, entry)
+        except FileNotFoundError:
+            # Lost a race with another writer of the same entry: keep the entry it wrote
+            if not entry.exists():
+                raise
+        return array
+
+    def get(self, source):
+        """
+        Return the cached array for a source file, building it first if the entry is missing or stale.
+
+        Parameters:
+        - source (str or Pathlib.Path): Path to the source file.
+
+        Returns:
+        - numpy.ndarray: The cached array, memory-mapped in read-only mode.
+        """
+        entry = self.entry_path(source)
+        if not entry.exists():
+            self.root.mkdir(parents=True, exist_ok=True)
+            self._write(source, entry)
+        return np.load(entry, mmap_mode='r')
+
+    def _build_one(self, source):
+        entry = self.entry_path(source)
+        if entry.exists():
+            return False
+        self._write(source, entry)
+        return True
+
+    def build(self, sources, workers=1):
+        """
+        Preprocess a collection of source files, rebuilding only missing or stale entries.
+
+        Parameters:
+        - sources (Iterable[str or Pathlib.Path]): Paths to the source files.
+        - workers (int, optional): Number of worker processes. Default is 1 (build in the current process).
+
+        Returns:
+        - int: The number of entries that were (re)built.
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        sources = list(sources)
+
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                built = sum(executor.map(self._build_one, sources, chunksize=16))
+        else:
+            built = sum(self._build_one(source) for source in sources)
+
+        print(f"Cache {self.root}: {built} entries built, {len(sources) - built} up to date.")
+        return built
+
+
+def _target_size(resize):
+    """
+    Convert the 'resize' setting of the configuration ([height, width] or a single side) to a PIL (width, height).
+    """
+    if resize is None:
+        return None
+    if isinstance(resize, int):
+        return (resize, resize)
+    return (int(resize[1]), int(resize[0]))
+
+
+def decode_image(image_path, resize=None):
+    """
+    Read an image file as a uint8 RGB array, optionally resized.
+
+    Parameters:
+    - image_path (str or Pathlib.Path): Path to the image file.
+    - resize (int or List[int], optional): Target size, as the 'resize' setting of the configuration
+                                           ([height, width] or a single side). Default is None (no resize).
+
+    Returns:
+    - numpy.ndarray: A uint8 array (height x width x 3).
+    """
+    with Image.open(image_path) as img:
+        img = img.convert('RGB')
+        size = _target_size(resize)
+        if size is not None and img.size != size:
+            img = img.resize(size, Image.BILINEAR)
+        return np.asarray(img)
+
+
+def decode_mask(mask_path, config_path=DEFAULT_CONFIG_PATH, resize=None):
+    """
+    Read an RGB mask file and convert it to a uint8 class mask, optionally resized.
+
+    Parameters:
+    - mask_path (str or Pathlib.Path): Path to the RGB mask file.
+    - config_path (str, optional): Path to the configuration file with the color-to-class mapping.
+    - resize (int or List[int], optional): Target size, as the 'resize' setting of the configuration. The class
+                                           mask is resized with nearest-neighbor interpolation so that no new
+                                           classes appear at the borders. Default is None (no resize).
+
+    Returns:
+    - numpy.ndarray: A 2D uint8 array where each pixel's value represents its class.
+    """
+    with Image.open(mask_path) as img:
+        msk = np.asarray(img.convert('RGB'))
+    msk = load_mask_codec(config_path).normalize(msk)
+
+    size = _target_size(resize)
+    if size is not None and (msk.shape[1], msk.shape[0]) != size:
+        msk = np.asarray(Image.fromarray(msk).resize(size, Image.NEAREST))
+    return msk
+
+
+def _load_cache_config(config_path):
+    with open(config_path, 'r') as stream:
+        config = yaml.safe_load(stream)
+    return config['data'], config['data'].get('cache') or {}
+
+
+@lru_cache(maxsize=None)
+def get_mask_cache(config_path=DEFAULT_CONFIG_PATH):
+    """
+    Return the class-mask cache configured in a configuration file.
+
+    The cache is enabled through the 'data.cache' section of the configuration:
+
+        cache:
+          path: './data/cache'
+          masks: true
+          images: false
+
+    When the image cache is enabled (see get_image_cache), the masks are cached too, resized to the same size
+    as the images.
+
+    Parameters:
+    - config_path (str, optional): Path to the configuration file. Defaults to 'config.yml'.
+
+    Returns:
+    - ArrayCache or None: The mask cache, or None if mask caching is disabled.
+    """
+    data_config, cache_config = _load_cache_config(config_path)
+    resize = data_config['augmentation'].get('resize') if cache_config.get('images', False) else None
+    if not (cache_config.get('masks', False) or resize is not None):
+        return None
+
+    palette = [[list(item['color']), item['class']] for item in data_config['mapping_class_color']]
+    params = {'palette': palette}
+    if resize is not None:
+        params['resize'] = resize
+    return ArrayCache(Path(cache_config['path']) / 'masks',
+                      partial(decode_mask, config_path=config_path, resize=resize),
+                      params=params)
+
+
+@lru_cache(maxsize=None)
+def get_image_cache(config_path=DEFAULT_CONFIG_PATH):
+    """
+    Return the cache of decoded images, resized to the 'resize' setting of the augmentation configuration.
+
+    It is enabled with 'images: true' in the 'data.cache' section of the configuration. The resize setting is
+    part of the cache key, so changing it switches to a new set of entries instead of reusing stale ones.
+
+    Parameters:
+    - config_path (str, optional): Path to the configuration file. Defaults to 'config.yml'.
+
+    Returns:
+    - ArrayCache or None: The image cache, or None if image caching is disabled.
+    """
+    data_config, cache_config = _load_cache_config(config_path)
+    if not cache_config.get('images', False):
+        return None
+
+    resize = data_config['augmentation'].get('resize')
+    return ArrayCache(Path(cache_config['path']) / 'images', partial(decode_image, resize=resize),
+                      params={'resize': resize})
@@ -1,7 +1,10 @@
 import numpy as np
 from fastai.vision.all import get_image_files, PILImage, PILMask
-from src.utils.transforms import normalize_mask
+from src.utils.mask_codec import DEFAULT_CONFIG_PATH, load_mask_codec
+from src.data.cache import get_image_cache, get_mask_cache
+from functools import partial
 from pathlib import Path
+import os
 import yaml
 
 def get_y_fn(x):
@@ -35,24 +38,200 @@ def get_items(path):
     """
     return get_image_files(Path(path)/'src')
 
-def get_mask(item):
+def get_mask(item, config_path=DEFAULT_CONFIG_PATH):
     """
     Retrieve the normalized mask for a given image file.
 
-    This function reads the mask file corresponding to a given image, normalizes it based on a predefined
-    color-to-class mapping defined in 'config.yaml', and returns the normalized mask.
+    This function reads the mask file corresponding to a given image, normalizes it based on the
+    color-to-class mapping defined in the configuration file, and returns the normalized mask.
+    The mapping is loaded once per process and reused for every mask. If the mask cache is enabled in
+    the configuration, the class mask is read from the cache instead and only decoded when its entry
+    is missing or stale.
 
     Parameters:
     - item (Pathlib.Path or str): The path to the source image file.
+    - config_path (str, optional): Path to the configuration file. Defaults to 'config.yml'.
 
     Returns:
     - PILMask: A PILMask object representing the normalized mask.
     """
-    with open("config.yaml", 'r') as stream:
-        config = yaml.safe_load(stream)
+    msk_path = get_y_fn(item)
 
-    mapping_class_color = {tuple(item['color']): item['class'] for item in config['data']['mapping_class_color']}
+    cache = get_mask_cache(config_path)
+    if cache is not None:
+        return PILMask.create(np.asarray(cache.get(msk_path)))
 
-    msk_path = get_y_fn(item)
+    codec = load_mask_codec(config_path)
     msk = np.array(PILImage.create(msk_path))
-    return PILMask.create(normalize_mask(msk, mapping_class_color))
\ No newline at end of file
+    return PILMask.create(codec.normalize(msk))
+
+
+def get_image(item, config_path=DEFAULT_CONFIG_PATH):
+    """
+    Retrieve a source image from the image cache, already decoded and resized to the configured size.
+
+    Parameters:
+    - item (Pathlib.Path or str): The path to the source image file.
+    - config_path (str, optional): Path to the configuration file. Defaults to 'config.yml'.
+
+    Returns:
+    - PILImage: The resized image.
+    """
+    return PILImage.create(np.asarray(get_image_cache(config_path).get(item)))
+
+
+def uses_image_cache(data_config, config_path=DEFAULT_CONFIG_PATH):
+    """
+    Check whether the DataBlock reads pre-resized images (and masks) from the cache, in which case the
+    Resize item transform must be left out.
+
+    Parameters:
+    - data_config (dict): The 'data' section of the configuration.
+    - config_path (str, optional): Path to the configuration file. Defaults to 'config.yml'.
+
+    Returns:
+    - bool: True if the image cache is enabled for a dataset in 'files' format.
+    """
+    return data_config.get('format', 'files') == 'files' and get_image_cache(config_path) is not None
+
+
+def datablock_getters(data_config, config_path=DEFAULT_CONFIG_PATH):
+    """
+    Select the DataBlock item getters for the dataset format set in the configuration.
+
+    With 'format: files' (the default) items are the image files in the 'src' folder and masks are read with
+    get_mask (and images with get_image if the image cache is enabled). With 'format: shards' items are tiles
+    of the shards written by src.data.shards, read directly from the memory-mapped shard arrays.
+
+    Parameters:
+    - data_config (dict): The 'data' section of the configuration.
+    - config_path (str, optional): Path to the configuration file. Defaults to 'config.yml'.
+
+    Returns:
+    - dict: The 'get_items', 'get_x' and 'get_y' arguments for a DataBlock.
+
+    Raises:
+    - ValueError: If the dataset format is unknown.
+    """
+    data_format = data_config.get('format', 'files')
+    if data_format == 'shards':
+        from src.data.shards import get_shard_items, get_shard_image, get_shard_mask
+        return {'get_items': get_shard_items, 'get_x': get_shard_image, 'get_y': get_shard_mask}
+    if data_format == 'files':
+        get_x = partial(get_image, config_path=config_path) if uses_image_cache(data_config, config_path) else None
+        return {'get_items': get_items, 'get_x': get_x, 'get_y': partial(get_mask, config_path=config_path)}
+    raise ValueError(f"Unknown dataset format: {data_format}")
+
+
+def loader_kwargs(data_config):
+    """
+    Read the DataLoader settings of the 'data.loader' section of the configuration:
+
+        loader:
+          num_workers: 4
+          pin_memory: false
+          prefetch_factor: 2
+
+    Settings that are missing or null keep the fastai defaults. There is no 'persistent_workers': fastai starts
+    new worker processes at every epoch whatever its value.
+
+    Parameters:
+    - data_config (dict): The 'data' section of the configuration.
+
+    Returns:
+    - dict: Keyword arguments for DataBlock.dataloaders ('num_workers', 'pin_memory').
+    """
+    loader_config = data_config.get('loader') or {}
+    return {key: loader_config[key] for key in ('num_workers', 'pin_memory') if loader_config.get(key) is not None}
+
+
+def fork_loader_workers():
+    """
+    Start the DataLoader workers of the current process by forking it (where supported).
+
+    Processes started with 'spawn' (e.g. the runs of a sweep or the workers of distributed training) would
+    otherwise spawn their DataLoader workers too, which fails because the fastai transforms can't be pickled.
+    """
+    import multiprocessing
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        multiprocessing.set_start_method('fork', force=True)
+
+
+def build_dataloaders(datablock, source, data_config, **kwargs):
+    """
+    Create the DataLoaders of a DataBlock with the batch size and DataLoader settings of the configuration.
+
+    fastai doesn't take the prefetch factor as an argument, so it is set on the underlying PyTorch loader of
+    each DataLoader that runs worker processes (fastai runs without workers on macOS, for instance).
+
+    Parameters:
+    - datablock (DataBlock): The DataBlock.
+    - source: The source passed to DataBlock.dataloaders (e.g. the dataset path).
+    - data_config (dict): The 'data' section of the configuration.
+    - **kwargs: Settings that override the configuration (e.g. num_workers).
+
+    Returns:
+    - DataLoaders: The DataLoaders.
+    """
+    settings = {**loader_kwargs(data_config), **kwargs}
+    prefetch_factor = settings.pop('prefetch_factor', (data_config.get('loader') or {}).get('prefetch_factor'))
+    dls = datablock.dataloaders(source, bs=data_config['batch_size'], **settings)
+    if prefetch_factor is not None:
+        for dl in dls.loaders:
+            # PyTorch rejects a prefetch factor without workers
+            if dl.fake_l.num_workers > 0:
+                dl.fake_l.prefetch_factor = prefetch_factor
+    return dls
+
+
+def build_mask_cache(path, config_path=DEFAULT_CONFIG_PATH, workers=1):
+    """
+    Preprocess the masks of a dataset into the class-mask cache.
+
+    This function decodes the RGB mask of every image in the 'src' directory of the given path and stores
+    it as a uint8 class mask, so that later epochs and runs read the cached arrays instead. Masks whose
+    cache entries are up to date are skipped. It does nothing if the mask cache is disabled.
+
+    Parameters:
+    - path (Pathlib.Path or str): The path to the directory containing the 'src' and 'gt' folders.
+    - config_path (str, optional): Path to the configuration file. Defaults to 'config.yml'.
+    - workers (int, optional): Number of worker processes used to decode the masks. Default is 1.
+
+    Returns:
+    - int: The number of cache entries that were (re)built.
+    """
+    cache = get_mask_cache(config_path)
+    if cache is None or not (Path(path) / 'src').exists():
+        return 0
+    return cache.build([get_y_fn(item) for item in get_items(path)], workers=workers)
+
+
+def build_image_cache(path, config_path=DEFAULT_CONFIG_PATH, workers=1):
+    """
+    Decode and resize the images of a dataset into the image cache.
+
+    Images whose cache entries are up to date (same file and same resize setting) are skipped. It does nothing
+    if the image cache is disabled.
+
+    Parameters:
+    - path (Pathlib.Path or str): The path to the directory containing the 'src' and 'gt' folders.
+    - config_path (str, optional): Path to the configuration file. Defaults to 'config.yml'.
+    - workers (int, optional): Number of worker processes used to decode the images. Default is 1.
+
+    Returns:
+    - int: The number of cache entries that were (re)built.
+    """
+    cache = get_image_cache(config_path)
+    if cache is None or not (Path(path) / 'src').exists():
+        return 0
+    return cache.build(get_items(path), workers=workers)
+
+
+if __name__ == "__main__":
+    config_path = 'config.yml'
+    with open(config_path, 'r') as stream:
+        config = yaml.safe_load(stream)
+    for path in (config['data']['path_to_dataset'], config['data']['path_test_dataset']):
+        build_mask_cache(path, config_path, workers=os.cpu_count())
+        build_image_cache(path, config_path, workers=os.cpu_count())
\ No newline at end of file
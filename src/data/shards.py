@@ -0,0 +1,295 @@
+import json
+import numpy as np
+from functools import lru_cache
+from pathlib import Path
+from PIL import Image
+from src.data.split_image import WindowReader, iter_tile_windows, tile_transform
+from src.utils.mask_codec import DEFAULT_CONFIG_PATH
+
+INDEX_DTYPE = np.dtype([('source', np.int32), ('x', np.int32), ('y', np.int32),
+                        ('width', np.int32), ('height', np.int32)])
+
+
+class ShardWriter:
+    """
+    Write fixed-size tiles into a shard: contiguous memory-mapped arrays plus a compact index.
+
+    A shard is a directory with the following files:
+    - images.npy: uint8 array (N x H x W x 3) with the tile pixels.
+    - masks.npy: uint8 array (N x H x W) with the class mask of each tile (only if the shard has masks).
+    - index.npy: structured array with the source file id, position and valid size of each tile.
+    - meta.json: tile size, number of tiles and the list of source files.
+
+    Tiles smaller than the shard tile size (e.g. at the right or bottom border of an image) are padded with
+    zeros; their valid width and height are recorded in the index.
+
+    Parameters:
+    - shard_dir (str or Pathlib.Path): Directory of the shard. It is created if it doesn't exist.
+    - n_tiles (int): Number of tiles the shard will hold.
+    - tile_height (int): Height of the tiles.
+    - tile_width (int): Width of the tiles.
+    - with_masks (bool, optional): Whether the shard stores a mask for each tile. Default is False.
+    """
+    def __init__(self, shard_dir, n_tiles, tile_height, tile_width, with_masks=False):
+        self.shard_dir = Path(shard_dir)
+        self.shard_dir.mkdir(parents=True, exist_ok=True)
+        self.tile_size = (tile_height, tile_width)
+        self.sources = []
+        self.georeference = {}
+        self._source_ids = {}
+        self.count = 0
+
+        self.images = np.lib.format.open_memmap(self.shard_dir / 'images.npy', mode='w+', dtype=np.uint8,
+                                                shape=(n_tiles, tile_height, tile_width, 3))
+        self.masks = np.lib.format.open_memmap(self.shard_dir / 'masks.npy', mode='w+', dtype=np.uint8,
+                                               shape=(n_tiles, tile_height, tile_width)) if with_masks else None
+        self.index = np.zeros(n_tiles, dtype=INDEX_DTYPE)
+
+    def add(self, image, source, x=0, y=0, mask=None):
+        """
+        Append a tile to the shard.
+
+        Parameters:
+        - image (numpy.ndarray): The tile pixels as a uint8 RGB array (H x W x 3).
+        - source (str): Path of the file the tile comes from.
+        - x (int, optional): Column of the tile in the source file. Default is 0.
+        - y (int, optional): Row of the tile in the source file. Default is 0.
+        - mask (numpy.ndarray, optional): The class mask of the tile (H x W). Required if the shard has masks.
+
+        Returns:
+        - int: The position of the tile in the shard.
+        """
+        i = self.count
+        h, w = image.shape[:2]
+        self.images[i, :h, :w] = image
+        if self.masks is not None:
+            self.masks[i, :h, :w] = mask
+
+        source_id = self._source_ids.setdefault(str(source), len(self.sources))
+        if source_id == len(self.sources):
+            self.sources.append(str(source))
+        self.index[i] = (source_id, x, y, w, h)
+
+        self.count += 1
+        return i
+
+    def set_georeference(self, source, transform, crs=None):
+        """
+        Record the affine geotransform and CRS of a source file, so tile positions can be mapped to the map.
+
+        Parameters:
+        - source (str): Path of the source file.
+        - transform (Sequence[float]): The (a, b, c, d, e, f) affine transform of the source.
+        - crs (str, optional): The coordinate reference system of the source.
+        """
+        self.georeference[str(source)] = {'transform': list(transform[:6]), 'crs': crs}
+
+    def close(self):
+        """
+        Flush the arrays and write the index and metadata of the shard.
+        """
+        self.images.flush()
+        if self.masks is not None:
+            self.masks.flush()
+        np.save(self.shard_dir / 'index.npy', self.index[:self.count])
+
+        meta = {'count': self.count, 'tile_size': list(self.tile_size),
+                'has_masks': self.masks is not None, 'sources': self.sources, 'georeference': self.georeference}
+        with open(self.shard_dir / 'meta.json', 'w') as file:
+            json.dump(meta, file)
+        print(f"Shard written at {self.shard_dir} ({self.count} tiles).")
+
+
+class Shard:
+    """
+    Read-only view of a shard written by ShardWriter.
+
+    The image and mask arrays are memory-mapped, so opening a shard is cheap and tiles are read lazily.
+
+    Parameters:
+    - shard_dir (str or Pathlib.Path): Directory of the shard.
+    """
+    def __init__(self, shard_dir):
+        self.shard_dir = Path(shard_dir)
+        with open(self.shard_dir / 'meta.json', 'r') as file:
+            self.meta = json.load(file)
+        self.sources = self.meta['sources']
+        self.index = np.load(self.shard_dir / 'index.npy')
+        self.images = np.load(self.shard_dir / 'images.npy', mmap_mode='r')
+        self.masks = np.load(self.shard_dir / 'masks.npy', mmap_mode='r') if self.meta['has_masks'] else None
+
+    def __len__(self):
+        return self.meta['count']
+
+    def image(self, i):
+        """
+        Return the pixels of a tile, without padding, as a view of the memory-mapped array.
+        """
+        return self.images[i, :self.index['height'][i], :self.index['width'][i]]
+
+    def mask(self, i):
+        """
+        Return the class mask of a tile, without padding, as a view of the memory-mapped array.
+        """
+        return self.masks[i, :self.index['height'][i], :self.index['width'][i]]
+
+    def source(self, i):
+        """
+        Return the source file and (x, y) position of a tile.
+        """
+        entry = self.index[i]
+        return self.sources[entry['source']], int(entry['x']), int(entry['y'])
+
+    def transform(self, i):
+        """
+        Return the affine geotransform of a tile, or None if its source is not georeferenced.
+        """
+        source, x, y = self.source(i)
+        georeference = self.meta.get('georeference', {}).get(source)
+        return tile_transform(georeference['transform'], x, y) if georeference else None
+
+
+@lru_cache(maxsize=64)
+def open_shard(shard_dir):
+    """
+    Open a shard, reusing already opened shards within the process.
+
+    Parameters:
+    - shard_dir (str): Directory of the shard.
+
+    Returns:
+    - Shard: The opened shard.
+    """
+    return Shard(shard_dir)
+
+
+def find_shards(path):
+    """
+    Find the shards in a directory.
+
+    Parameters:
+    - path (str or Pathlib.Path): A shard directory, or a directory whose subdirectories are shards.
+
+    Returns:
+    - List[Pathlib.Path]: The shard directories, sorted by name.
+    """
+    path = Path(path)
+    if (path / 'meta.json').exists():
+        return [path]
+    return sorted(meta.parent for meta in path.glob('*/meta.json'))
+
+
+def get_shard_items(path):
+    """
+    Retrieve the tiles of all the shards in a directory as DataBlock items.
+
+    Each item is a (shard directory, tile position) tuple, which is cheap to pickle to DataLoader workers.
+    It is the shard counterpart of get_items and is used together with get_shard_image and get_shard_mask.
+
+    Parameters:
+    - path (str or Pathlib.Path): A shard directory, or a directory whose subdirectories are shards.
+
+    Returns:
+    - List[Tuple[str, int]]: One item per tile.
+    """
+    return [(str(shard_dir), i) for shard_dir in find_shards(path) for i in range(len(open_shard(str(shard_dir))))]
+
+
+def get_shard_image(item):
+    """
+    Retrieve the image of a shard item (the shard counterpart of reading the 'src' image file).
+
+    Parameters:
+    - item (Tuple[str, int]): A (shard directory, tile position) item.
+
+    Returns:
+    - numpy.ndarray: The tile pixels as a uint8 RGB array.
+    """
+    shard_dir, i = item
+    return open_shard(shard_dir).image(i)
+
+
+def get_shard_mask(item):
+    """
+    Retrieve the class mask of a shard item (the shard counterpart of get_mask).
+
+    Parameters:
+    - item (Tuple[str, int]): A (shard directory, tile position) item.
+
+    Returns:
+    - numpy.ndarray: The class mask of the tile as a uint8 array.
+    """
+    shard_dir, i = item
+    return open_shard(shard_dir).mask(i)
+
+
+def pack_dataset(path, shard_dir, config_path=DEFAULT_CONFIG_PATH):
+    """
+    Pack a dataset with 'src' and 'gt' folders into a single shard.
+
+    The images and their RGB masks are read once; the masks are converted to class masks with the palette
+    defined in the configuration. All the images of the dataset must have the same size.
+
+    Parameters:
+    - path (str or Pathlib.Path): The path to the directory containing the 'src' and 'gt' folders.
+    - shard_dir (str or Pathlib.Path): Directory of the shard to write.
+    - config_path (str, optional): Path to the configuration file. Defaults to 'config.yml'.
+
+    Returns:
+    - Pathlib.Path: The directory of the shard.
+
+    Raises:
+    - ValueError: If the dataset has no images, or if its images don't all have the same size.
+    """
+    from src.data.cache import decode_mask
+    from src.data.dataset import get_items, get_y_fn
+
+    items = get_items(path)
+    if not items:
+        raise ValueError(f"No images to pack in {Path(path) / 'src'} (with their masks in {Path(path) / 'gt'}).")
+    writer = None
+    for item in items:
+        with Image.open(item) as img:
+            image = np.asarray(img.convert('RGB'))
+        if writer is None:
+            writer = ShardWriter(shard_dir, len(items), *image.shape[:2], with_masks=True)
+        elif image.shape[:2] != writer.tile_size:
+            raise ValueError(f"All images must have the same size to be packed: {item} is "
+                             f"{image.shape[:2]}, expected {writer.tile_size}.")
+        writer.add(image, item, mask=decode_mask(get_y_fn(item), config_path))
+
+    writer.close()
+    return writer.shard_dir
+
+
+def split_image_to_shard(file_path, shard_dir, chunk_width=256, chunk_height=256, stride_x=None, stride_y=None):
+    """
+    Split an image into chunks stored in a shard instead of one file per chunk.
+
+    The chunks are the same (and in the same order) as those written by split_image; their position in the
+    source image is kept in the shard index. The source is read window by window with rasterio, so the
+    whole image is never loaded in memory.
+
+    Parameters:
+    - file_path (str): Path to the source image file to be split.
+    - shard_dir (str or Pathlib.Path): Directory of the shard to write.
+    - chunk_width (int, optional): Width of each chunk. Default is 256.
+    - chunk_height (int, optional): Height of each chunk. Default is 256.
+    - stride_x (int, optional): Horizontal distance between chunks. Defaults to `chunk_width` (no overlap).
+    - stride_y (int, optional): Vertical distance between chunks. Defaults to `chunk_height` (no overlap).
+
+    Returns:
+    - Pathlib.Path: The directory of the shard.
+    """
+    with WindowReader(file_path) as src:
+        windows = list(iter_tile_windows(src.width, src.height, chunk_width, chunk_height, stride_x, stride_y))
+        writer = ShardWriter(shard_dir, len(windows), chunk_height, chunk_width)
+        writer.set_georeference(file_path, src.transform, src.crs)
+        for box in windows:
+            chunk = src.read(box)
+            if chunk.ndim == 2:
+                chunk = np.repeat(chunk[..., None], 3, axis=-1)
+            writer.add(chunk, file_path, x=box[0], y=box[1])
+
+    writer.close()
+    return writer.shard_dir
@@ -1,56 +1,403 @@
 from PIL import Image, ImageFile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import json
+import numpy as np
 import os
-import math
+import time
+import warnings
 
 Image.MAX_IMAGE_PIXELS = None  # Removes the limit on image size
 ImageFile.LOAD_TRUNCATED_IMAGES = True  # To handle potential truncation issues
 
-def split_image(file_path, output_folder, chunk_width=256, chunk_height=256):
+
+def tile_offsets(size, chunk, stride=None):
+    """
+    Compute the start offsets of the chunks along one dimension of an image.
+
+    Chunks start every `stride` pixels. When the last full chunk doesn't reach the end of the image, one
+    more chunk is added, which might be smaller than `chunk` pixels. With the default stride (equal to the
+    chunk size) the chunks don't overlap and exactly cover the image.
+
+    Parameters:
+    - size (int): Size of the image along the dimension.
+    - chunk (int): Size of each chunk along the dimension.
+    - stride (int, optional): Distance between the starts of consecutive chunks. Defaults to `chunk`.
+
+    Returns:
+    - List[int]: The start offset of each chunk.
+
+    Raises:
+    - ValueError: If the stride is not between 1 and the chunk size.
+    """
+    stride = stride or chunk
+    if not 0 < stride <= chunk:
+        raise ValueError(f"The stride must be between 1 and the chunk size ({chunk}), got {stride}.")
+
+    offsets = list(range(0, max(size - chunk, 0) + 1, stride))
+    if offsets[-1] + chunk < size:
+        offsets.append(offsets[-1] + stride)
+    return offsets
+
+
+def iter_tile_windows(img_width, img_height, chunk_width=256, chunk_height=256, stride_x=None, stride_y=None):
+    """
+    Generate the windows of the chunks of an image in row-major order.
+
+    Parameters:
+    - img_width (int): Width of the image.
+    - img_height (int): Height of the image.
+    - chunk_width (int, optional): Width of each chunk. Default is 256.
+    - chunk_height (int, optional): Height of each chunk. Default is 256.
+    - stride_x (int, optional): Horizontal distance between chunks. Defaults to `chunk_width` (no overlap).
+    - stride_y (int, optional): Vertical distance between chunks. Defaults to `chunk_height` (no overlap).
+
+    Yields:
+    - Tuple[int, int, int, int]: The (left, upper, right, lower) box of each chunk, clipped to the image.
+    """
+    for upper in tile_offsets(img_height, chunk_height, stride_y):
+        for left in tile_offsets(img_width, chunk_width, stride_x):
+            yield left, upper, min(left + chunk_width, img_width), min(upper + chunk_height, img_height)
+
+
+def tile_transform(transform, x, y):
+    """
+    Compute the affine geotransform of a tile from the geotransform of its source raster.
+
+    Parameters:
+    - transform (Sequence[float]): The (a, b, c, d, e, f) affine transform of the source, in rasterio order,
+                                   mapping (col, row) to (a * col + b * row + c, d * col + e * row + f).
+    - x (int): Column of the tile's upper-left pixel in the source.
+    - y (int): Row of the tile's upper-left pixel in the source.
+
+    Returns:
+    - Tuple[float, ...]: The (a, b, c, d, e, f) affine transform of the tile.
+    """
+    a, b, c, d, e, f = transform[:6]
+    return a, b, c + a * x + b * y, d, e, f + d * x + e * y
+
+
+def write_tile_index(output_folder, source, boxes, output_format='png', transform=None, crs=None):
+    """
+    Write the 'tiles.json' index of a folder of chunks.
+
+    The index keeps the position of every chunk in the source image together with the geotransform and CRS
+    of the source (when it is georeferenced), so predictions on the chunks can be mapped back to the map.
+
+    Parameters:
+    - output_folder (str): Path to the folder with the chunks.
+    - source (str): Path to the source image.
+    - boxes (List[Tuple[int, int, int, int]]): The (left, upper, right, lower) box of each chunk, in order.
+    - output_format (str, optional): Extension of the chunk files. Default is 'png'.
+    - transform (Sequence[float], optional): The (a, b, c, d, e, f) affine transform of the source.
+    - crs (str, optional): The coordinate reference system of the source (e.g. 'EPSG:25830').
+    """
+    index = {'source': str(source), 'crs': crs, 'transform': list(transform[:6]) if transform else None,
+             'tiles': [[f"chunk_{n:04}.{output_format}", left, upper, right - left, lower - upper]
+                       for n, (left, upper, right, lower) in enumerate(boxes, start=1)]}
+    with open(os.path.join(output_folder, 'tiles.json'), 'w') as file:
+        json.dump(index, file)
+
+
+def read_georeference(file_path):
+    """
+    Read the affine transform and CRS of a GeoTIFF with rasterio.
+
+    Parameters:
+    - file_path (str): Path to the source image.
+
+    Returns:
+    - Tuple[Tuple[float, ...], str]: The (a, b, c, d, e, f) transform and the CRS of the source, or (None, None)
+      for plain images (PNG, JPEG, ...), rasters without georeference, and GeoTIFFs when rasterio is not
+      installed (with a warning).
+    """
+    if os.path.splitext(str(file_path))[1].lower() not in ('.tif', '.tiff'):
+        return None, None
+    try:
+        import rasterio
+    except ImportError:
+        warnings.warn(f"rasterio is not installed: the tile index of {file_path} is written without its "
+                      f"georeference (pip install rasterio)")
+        return None, None
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', rasterio.errors.NotGeoreferencedWarning)
+        with rasterio.open(file_path) as dataset:
+            if dataset.crs is None and dataset.transform.is_identity:
+                return None, None
+            return tuple(dataset.transform)[:6], dataset.crs.to_string() if dataset.crs else None
+
+
+def load_tile_index(folder):
+    """
+    Load the 'tiles.json' index of a folder of chunks.
+
+    Parameters:
+    - folder (str): Path to the folder with the chunks.
+
+    Returns:
+    - dict: For each chunk filename, a dict with its 'x', 'y', 'width', 'height', the 'crs' of the source and
+            its own affine 'transform' (None if the source is not georeferenced).
+    """
+    with open(os.path.join(folder, 'tiles.json'), 'r') as file:
+        index = json.load(file)
+
+    tiles = {}
+    for name, x, y, width, height in index['tiles']:
+        transform = tile_transform(index['transform'], x, y) if index['transform'] else None
+        tiles[name] = {'x': x, 'y': y, 'width': width, 'height': height, 'crs': index['crs'], 'transform': transform}
+    return tiles
+
+
+def save_chunk(chunk, output_folder, chunk_number, output_format='png', compress_level=6):
+    """
+    Encode and save a single chunk.
+
+    Parameters:
+    - chunk (PIL.Image.Image or numpy.ndarray): The chunk, as an image (saved in its own mode, with its palette)
+                                                or as a uint8 array (H x W x C or H x W).
+    - output_folder (str): Path to the folder where the chunk will be saved.
+    - chunk_number (int): Order of the chunk, used to build the filename 'chunk_NNNN'.
+    - output_format (str, optional): 'png', 'webp' (lossless) or 'npy' (raw uint8 array). Default is 'png'.
+    - compress_level (int, optional): PNG compression level (0-9). Default is 6.
+
+    Returns:
+    - str: The path of the saved chunk.
+
+    Raises:
+    - ValueError: If the output format is unknown.
+    """
+    path = os.path.join(output_folder, f"chunk_{chunk_number:04}.{output_format}")
+    image = chunk if isinstance(chunk, Image.Image) else None
+    if output_format == 'png':
+        (image or Image.fromarray(chunk)).save(path, compress_level=compress_level)
+    elif output_format == 'webp':
+        (image or Image.fromarray(chunk)).save(path, lossless=True)
+    elif output_format == 'npy':
+        np.save(path, np.ascontiguousarray(chunk))
+    else:
+        raise ValueError(f"Unknown output format: {output_format}")
+    return path
+
+
+def _report(n_chunks, start, workers):
+    elapsed = time.perf_counter() - start
+    print(f"{n_chunks} chunks written in {elapsed:.2f}s "
+          f"({n_chunks / max(elapsed, 1e-9):.1f} tiles/sec, {workers} workers).")
+
+
+def split_image(file_path, output_folder, chunk_width=256, chunk_height=256, stride_x=None, stride_y=None,
+                workers=1, output_format='png', compress_level=6):
     """
     Split an image into smaller chunks.
 
-    This function divides a larger image into smaller, non-overlapping chunks of specified width and height,
+    This function divides a larger image into smaller chunks of specified width and height,
     and saves them to a specified output folder. If the output folder doesn't exist, it is created.
+    The whole image is loaded in memory; use split_image_streaming for rasters that don't fit in memory.
 
     Parameters:
     - file_path (str): Path to the source image file to be split.
     - output_folder (str): Path to the folder where the image chunks will be saved.
     - chunk_width (int, optional): Width of each chunk. Default is 256.
     - chunk_height (int, optional): Height of each chunk. Default is 256.
+    - stride_x (int, optional): Horizontal distance between chunks. Defaults to `chunk_width` (no overlap).
+    - stride_y (int, optional): Vertical distance between chunks. Defaults to `chunk_height` (no overlap).
+    - workers (int, optional): Number of processes used to encode the chunks. Default is 1.
+    - output_format (str, optional): 'png', 'webp' (lossless) or 'npy' (raw uint8 array). Default is 'png'.
+    - compress_level (int, optional): PNG compression level (0-9). Default is 6.
 
-    Each chunk is saved in the output folder with a filename indicating its order in the splitting process.
+    Returns:
+    - int: The number of chunks written.
+
+    Each chunk is saved in the output folder with a filename indicating its order in the splitting process,
+    and the position of every chunk is recorded in a 'tiles.json' index (see load_tile_index), with the
+    geotransform and CRS of the source when it is a GeoTIFF and rasterio is installed.
     The chunk dimensions will be exactly as specified, except possibly for the last row or column of chunks,
-    which might be smaller if the original image's dimensions are not exact multiples of the chunk dimensions.
+    which might be smaller if the original image's dimensions are not covered exactly by the chunks.
+    The numbering is the same whatever the number of workers.
     """
     # Create output directory if it doesn't exist
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
+    start = time.perf_counter()
+    n_chunks = 0
+
     # Open the image
     with Image.open(file_path) as img:
         img_width, img_height = img.size
+        windows = list(iter_tile_windows(img_width, img_height, chunk_width, chunk_height, stride_x, stride_y))
+        transform, crs = read_georeference(file_path)
+        write_tile_index(output_folder, file_path, windows, output_format, transform, crs)
+
+        if workers > 1:
+            # Crop in this process and encode in the pool, keeping a bounded number of chunks in flight. The crops
+            # are sent as PIL images, which keeps their mode and palette (e.g. of 'P' masks)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                pending = deque()
+                for chunk_number, box in enumerate(windows, start=1):
+                    chunk = img.crop(box)
+                    pending.append(executor.submit(save_chunk, chunk, output_folder, chunk_number,
+                                                   output_format, compress_level))
+                    if len(pending) >= 4 * workers:
+                        pending.popleft().result()
+                    n_chunks += 1
+                for future in pending:
+                    future.result()
+        else:
+            for chunk_number, box in enumerate(windows, start=1):
+                # Create and save the chunk
+                chunk = img.crop(box)
+                save_chunk(chunk, output_folder, chunk_number, output_format, compress_level)
+                n_chunks += 1
+
+    _report(n_chunks, start, workers)
+    return n_chunks
+
+
+class WindowReader:
+    """
+    Read windows of a raster with rasterio, keeping the source open between reads.
+
+    Parameters:
+    - file_path (str): Path to the source raster file.
+    - cache_mb (int, optional): Size of the GDAL block cache in megabytes. Default is 128.
+    - value_range (Tuple[float, float], optional): Range of the raster values mapped linearly to 0-255 (values
+                                                   outside are clipped), for rasters that aren't uint8 (e.g.
+                                                   16-bit or float orthophotos). Default is None (uint8 only).
+
+    Only the first three bands of the raster are read (or the first band for single-band rasters).
+
+    Raises:
+    - ValueError: If the bands aren't uint8 and no value range is given, or if the value range is empty.
+    """
+    def __init__(self, file_path, cache_mb=128, value_range=None):
+        try:
+            import rasterio
+        except ImportError as e:
+            raise ImportError("Streaming tiling requires rasterio (pip install rasterio).") from e
+
+        self._env = rasterio.Env(GDAL_CACHEMAX=cache_mb)
+        self._env.__enter__()
+        self.dataset = rasterio.open(file_path)
+        self.width, self.height = self.dataset.width, self.dataset.height
+        self.transform = tuple(self.dataset.transform)[:6]
+        self.crs = self.dataset.crs.to_string() if self.dataset.crs else None
+        self.bands = [1, 2, 3] if self.dataset.count >= 3 else [1]
+
+        dtypes = {self.dataset.dtypes[band - 1] for band in self.bands}
+        if value_range is None and dtypes != {'uint8'}:
+            self.close()
+            raise ValueError(f"{file_path} has {', '.join(sorted(dtypes))} bands: give the value_range mapped to "
+                             f"0-255 (e.g. (0, 4095) for 12-bit data) instead of truncating the values to uint8.")
+        if value_range is not None and value_range[1] <= value_range[0]:
+            self.close()
+            raise ValueError(f"Invalid value range: {value_range}")
+        self.value_range = value_range
+
+    def read(self, box):
+        """
+        Read the pixels of a (left, upper, right, lower) box as a uint8 array (H x W x 3 or H x W).
+        """
+        from rasterio.windows import Window
+        left, upper, right, lower = box
+
+        data = self.dataset.read(self.bands, window=Window(left, upper, right - left, lower - upper))
+        chunk = np.moveaxis(data, 0, -1)
+        if len(self.bands) == 1:
+            chunk = chunk[..., 0]
+        if self.value_range is not None:
+            low, high = self.value_range
+            chunk = np.clip((chunk.astype(np.float32) - low) * (255 / (high - low)), 0, 255).round()
+        return np.ascontiguousarray(chunk.astype(np.uint8))
+
+    def close(self):
+        self.dataset.close()
+        self._env.__exit__(None, None, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Raster opened once per worker process by the streaming tiler
+_reader = None
+
+
+def _open_reader(file_path, cache_mb, value_range=None):
+    global _reader
+    _reader = WindowReader(file_path, cache_mb, value_range)
+
+
+def _read_and_save_chunk(args):
+    box, output_folder, chunk_number, output_format, compress_level = args
+    return save_chunk(_reader.read(box), output_folder, chunk_number, output_format, compress_level)
+
+
+def split_image_streaming(file_path, output_folder, chunk_width=256, chunk_height=256, stride_x=None, stride_y=None,
+                          cache_mb=128, workers=1, output_format='png', compress_level=6, value_range=None):
+    """
+    Split a large raster (e.g. a GeoTIFF or COG orthophoto) into chunks without loading it in memory.
+
+    This function produces the same chunks as split_image, but reads each chunk's window directly from the
+    source with rasterio, so only the internal tiles or strips overlapping the window are decoded. Memory use
+    is bounded by the chunk size and the GDAL block cache, regardless of the size of the raster. With several
+    workers, each worker process opens the raster once and both reads and encodes its chunks.
+
+    Parameters:
+    - file_path (str): Path to the source raster file to be split.
+    - output_folder (str): Path to the folder where the image chunks will be saved.
+    - chunk_width (int, optional): Width of each chunk. Default is 256.
+    - chunk_height (int, optional): Height of each chunk. Default is 256.
+    - stride_x (int, optional): Horizontal distance between chunks. Defaults to `chunk_width` (no overlap).
+    - stride_y (int, optional): Vertical distance between chunks. Defaults to `chunk_height` (no overlap).
+    - cache_mb (int, optional): Size of the GDAL block cache in megabytes (per process). Default is 128.
+    - workers (int, optional): Number of processes used to read and encode the chunks. Default is 1.
+    - output_format (str, optional): 'png', 'webp' (lossless) or 'npy' (raw uint8 array). Default is 'png'.
+    - compress_level (int, optional): PNG compression level (0-9). Default is 6.
+    - value_range (Tuple[float, float], optional): Range of the raster values mapped to 0-255, required for
+                                                   rasters that aren't uint8 (see WindowReader).
+
+    Returns:
+    - int: The number of chunks written.
+
+    Only the first three bands of the raster are kept (or the first band for single-band rasters).
+    The 'tiles.json' index written next to the chunks keeps the geotransform of the raster, so the affine
+    transform of every chunk can be recovered with load_tile_index.
+    """
+    # Create output directory if it doesn't exist
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
 
-        # Calculate the number of chunks in each dimension
-        x_chunks = math.ceil(img_width / chunk_width)
-        y_chunks = math.ceil(img_height / chunk_height)
+    start = time.perf_counter()
+    with WindowReader(file_path, cache_mb, value_range) as src:
+        img_width, img_height = src.width, src.height
+        transform, crs = src.transform, src.crs
 
-        # Initialize chunk number
-        chunk_number = 1
+    windows = list(iter_tile_windows(img_width, img_height, chunk_width, chunk_height, stride_x, stride_y))
+    write_tile_index(output_folder, file_path, windows, output_format, transform, crs)
+    tasks = ((box, output_folder, chunk_number, output_format, compress_level)
+             for chunk_number, box in enumerate(windows, start=1))
 
-        for y in range(0, y_chunks):
-            for x in range(0, x_chunks):
-                # Calculate the dimensions of the chunk
-                left = x * chunk_width
-                upper = y * chunk_height
-                right = min(left + chunk_width, img_width)
-                lower = min(upper + chunk_height, img_height)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_open_reader,
+                                 initargs=(file_path, cache_mb, value_range)) as executor:
+            n_chunks = sum(1 for _ in executor.map(_read_and_save_chunk, tasks, chunksize=32))
+    else:
+        _open_reader(file_path, cache_mb, value_range)
+        try:
+            n_chunks = 0
+            for task in tasks:
+                _read_and_save_chunk(task)
+                n_chunks += 1
+        finally:
+            _reader.close()
 
-                # Create the chunk
-                chunk = img.crop((left, upper, right, lower))
+    _report(n_chunks, start, workers)
+    return n_chunks
 
-                # Save the chunk
-                chunk.save(os.path.join(output_folder, f"chunk_{chunk_number:04}.png"))
-                chunk_number += 1
 
 if __name__ == "__main__":
     split_image("D:/Documentos/DGIIM5/h50_1009_fot_042-1066_cog.tif", "granada256")
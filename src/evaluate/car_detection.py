@@ -1,15 +1,196 @@
 import cv2
+import hashlib
+import json
 import numpy as np
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from src.utils.mask_codec import pack_rgb
+
+# Define BGR color values for different objects
+BLUE_BGR = np.array([142, 0, 0])  # Car
+BLACK_BGR = np.array([0, 0, 0])   # Background
+LILAC_BGR = np.array([128, 64, 128])  # Road
+YELLOW_BGR = np.array([0, 255, 255])  # Parked car
+
+
+def find_vehicles(car_plane, background_plane, road_plane, kernel_size=15):
+    """
+    Locate the cars of a segmentation and count the background and road pixels around each of them.
+
+    Each car is an external contour of the car pixels, filled (including any hole). Its surroundings are the
+    filled contour dilated with a kernel_size x kernel_size square kernel. All the work for a car is done
+    inside its bounding box enlarged by the kernel radius, so the cost grows with the size of the cars rather
+    than with their number times the size of the image.
+
+    Parameters:
+    - car_plane (numpy.ndarray): Boolean (H x W) array marking the car pixels.
+    - background_plane (numpy.ndarray): Boolean (H x W) array marking the background pixels.
+    - road_plane (numpy.ndarray): Boolean (H x W) array marking the road pixels.
+    - kernel_size (int, optional): Size of the dilation kernel. Default is 15.
+
+    Yields:
+    - Tuple[Tuple[int, int, int, int], numpy.ndarray, int, int]: For each car, the (x0, y0, x1, y1) window
+      that was processed, the filled contour as a boolean array over that window, and the number of
+      background and road pixels in the dilated contour.
+    """
+    height, width = car_plane.shape
+    radius = kernel_size // 2
+    kernel = np.ones((kernel_size, kernel_size), np.uint8)
+
+    # Find the contours of the car pixels
+    contours, _ = cv2.findContours(car_plane.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    for contour in contours:
+        # Window covering the contour and everything the dilation can reach
+        x, y, w, h = cv2.boundingRect(contour)
+        x0, y0 = max(x - radius, 0), max(y - radius, 0)
+        x1, y1 = min(x + w + radius, width), min(y + h + radius, height)
+
+        filled = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        cv2.drawContours(filled, [contour], -1, 1, thickness=cv2.FILLED, offset=(-x0, -y0))
+        dilated = cv2.dilate(filled, kernel, iterations=1).astype(bool)
+
+        # Count the background and road pixels in the dilated contour
+        background_count = np.count_nonzero(background_plane[y0:y1, x0:x1] & dilated)
+        road_count = np.count_nonzero(road_plane[y0:y1, x0:x1] & dilated)
+
+        yield (x0, y0, x1, y1), filled.astype(bool), background_count, road_count
+
+
+def mark_parked_cars(image, kernel_size=15):
+    """
+    Recolor the parked cars of a color-coded segmentation.
+
+    A car is considered parked when there are more background (black) than road (lilac) pixels around it.
+    The car (blue) pixels of every parked car are changed to yellow.
+
+    Parameters:
+    - image (numpy.ndarray): A BGR color-coded segmentation, as read by cv2.imread.
+    - kernel_size (int, optional): Size of the dilation kernel that defines the surroundings of a car. Default is 15.
+
+    Returns:
+    - numpy.ndarray: A copy of the image with the parked cars in yellow.
+    """
+    result = image.copy()
+
+    # Precompute the class planes with a single comparison per pixel
+    packed = pack_rgb(image)
+    blue_plane = packed == pack_rgb(BLUE_BGR)
+    black_plane = packed == pack_rgb(BLACK_BGR)
+    lilac_plane = packed == pack_rgb(LILAC_BGR)
+
+    for (x0, y0, x1, y1), filled, black_count, lilac_count in find_vehicles(blue_plane, black_plane, lilac_plane,
+                                                                            kernel_size):
+        # Change color of pixels if there are more black pixels than lilac pixels
+        if black_count > lilac_count:
+            window = result[y0:y1, x0:x1]
+            window[filled & blue_plane[y0:y1, x0:x1]] = YELLOW_BGR
+
+    return result
+
+
+def detect_vehicles(class_mask, tile_id=None, car_class=2, road_class=1, background_class=0, kernel_size=15,
+                    transform=None):
+    """
+    Detect the cars of a class-index segmentation and decide whether each of them is parked.
+
+    This is the structured counterpart of mark_parked_cars: it works directly on the uint8 class mask produced
+    by the model (no color-coded PNG round-trip) and returns one row per car instead of a recolored image.
+    The parked/unparked decision is the same: a car is parked when there are more background than road
+    pixels around it.
+
+    Parameters:
+    - class_mask (numpy.ndarray): A 2D array where each pixel's value represents its class.
+    - tile_id (optional): Identifier of the tile (e.g. its file name), stored in the 'tile' column.
+    - car_class (int, optional): Class ID of the cars. Default is 2.
+    - road_class (int, optional): Class ID of the road. Default is 1.
+    - background_class (int, optional): Class ID of the background. Default is 0.
+    - kernel_size (int, optional): Size of the dilation kernel that defines the surroundings of a car. Default is 15.
+    - transform (Sequence[float], optional): The (a, b, c, d, e, f) affine geotransform of the tile
+                                             (see load_tile_index). If given, map coordinates are added.
+
+    Returns:
+    - pandas.DataFrame: One row per car with the columns tile, vehicle_id, x, y, width, height (bounding box
+      in pixels), area (car pixels), centroid_x, centroid_y, background_count, road_count and parked, plus
+      the columns added by georeference_vehicles when a transform is given.
+    """
+    import pandas as pd
+
+    car_plane = class_mask == car_class
+    rows = []
+    for vehicle_id, ((x0, y0, _, _), filled, background_count, road_count) in enumerate(
+            find_vehicles(car_plane, class_mask == background_class, class_mask == road_class, kernel_size)):
+        ys, xs = np.nonzero(filled & car_plane[y0:y0 + filled.shape[0], x0:x0 + filled.shape[1]])
+        rows.append((vehicle_id, x0 + xs.min(), y0 + ys.min(), xs.max() - xs.min() + 1, ys.max() - ys.min() + 1,
+                     len(xs), x0 + xs.mean(), y0 + ys.mean(), background_count, road_count,
+                     background_count > road_count))
+
+    columns = ['vehicle_id', 'x', 'y', 'width', 'height', 'area', 'centroid_x', 'centroid_y',
+               'background_count', 'road_count', 'parked']
+    table = pd.DataFrame(rows, columns=columns).astype(
+        {'vehicle_id': 'int32', 'x': 'int32', 'y': 'int32', 'width': 'int32', 'height': 'int32', 'area': 'int32',
+         'centroid_x': 'float32', 'centroid_y': 'float32', 'background_count': 'int32', 'road_count': 'int32',
+         'parked': 'bool'})
+    table.insert(0, 'tile', tile_id)
+    return georeference_vehicles(table, transform) if transform is not None else table
+
+
+def georeference_vehicles(table, transform):
+    """
+    Add map coordinates to a vehicle table using the affine geotransform of its tile.
+
+    Pixel coordinates refer to pixel centers, so a centroid at pixel (col, row) is mapped from (col + 0.5,
+    row + 0.5), and bounding boxes are mapped from their outer pixel edges.
+
+    Parameters:
+    - table (pandas.DataFrame): A table returned by detect_vehicles.
+    - transform (Sequence[float]): The (a, b, c, d, e, f) affine transform mapping (col, row) to map coordinates.
+
+    Returns:
+    - pandas.DataFrame: The table with the columns geo_x, geo_y (centroid) and geo_xmin, geo_ymin, geo_xmax,
+      geo_ymax (bounding box) added, in the units of the transform's CRS.
+    """
+    a, b, c, d, e, f = transform[:6]
+
+    def to_map(col, row):
+        # float64 keeps sub-pixel precision for projected coordinates in the millions
+        col, row = np.asarray(col, dtype=np.float64), np.asarray(row, dtype=np.float64)
+        return a * col + b * row + c, d * col + e * row + f
+
+    table = table.copy()
+    table['geo_x'], table['geo_y'] = to_map(table['centroid_x'] + 0.5, table['centroid_y'] + 0.5)
+
+    corners_x, corners_y = zip(*(to_map(table['x'] + dx * table['width'], table['y'] + dy * table['height'])
+                                 for dx in (0, 1) for dy in (0, 1)))
+    table['geo_xmin'], table['geo_xmax'] = np.min(corners_x, axis=0), np.max(corners_x, axis=0)
+    table['geo_ymin'], table['geo_ymax'] = np.min(corners_y, axis=0), np.max(corners_y, axis=0)
+    return table
+
+
+def save_vehicle_table(table, file_path):
+    """
+    Save a vehicle table to Parquet (if the path ends with '.parquet') or CSV.
+
+    Parameters:
+    - table (pandas.DataFrame): A table returned by detect_vehicles, or several of them concatenated.
+    - file_path (str): The path where the table will be saved.
+    """
+    if str(file_path).endswith('.parquet'):
+        table.to_parquet(file_path, index=False)
+    else:
+        table.to_csv(file_path, index=False)
+    print(f"Vehicle table saved to {file_path} ({len(table)} vehicles)")
+
 
 def car_detection(folder_path):
     """
     Processes images in a specified folder by identifying and altering specific colored regions.
 
-    This function iterates over PNG image files in the given folder. For each image, it identifies contours of 
-    a specific blue color (representing a car), dilates these contours, and checks for the prevalence of black 
-    (background) and lilac (road) colors within the dilated area. If more black than lilac pixels are found, 
-    it changes the color of the original blue region to yellow. The modified image is then saved in the same folder 
+    This function iterates over PNG image files in the given folder. For each image, it identifies contours of
+    a specific blue color (representing a car), dilates these contours, and checks for the prevalence of black
+    (background) and lilac (road) colors within the dilated area. If more black than lilac pixels are found,
+    it changes the color of the original blue region to yellow. The modified image is then saved in the same folder
     with a modified filename.
 
     Parameters:
@@ -18,44 +199,112 @@ def car_detection(folder_path):
     Returns:
     None
     """
-
-    # Define BGR color values for different objects
-    blue_bgr = np.array([142, 0, 0])  # Car
-    black_bgr = np.array([0, 0, 0])   # Background
-    lilac_bgr = np.array([128, 64, 128])  # Road
-
     # Iterate over all files in the folder
     for filename in os.listdir(folder_path):
         if filename.endswith(".png"):
             image_path = os.path.join(folder_path, filename)
-            image = cv2.imread(image_path)
+            image = mark_parked_cars(cv2.imread(image_path))
+
+            # Save the modified image
+            result_filename = f"{os.path.splitext(filename)[0]}_aparcado.png"
+            result_path = os.path.join(folder_path, result_filename)
+            cv2.imwrite(result_path, image)
 
-            # Create a mask for the blue pixels
-            original_blue_mask = np.all(image == blue_bgr, axis=-1)
 
-            # Find the contours of the blue pixels
-            contours, _ = cv2.findContours(original_blue_mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+def _file_signature(path, use_hash=False):
+    """
+    Describe the current version of a file by its size and modification time, or its size and SHA-1 hash.
+    """
+    stat = os.stat(path)
+    if not use_hash:
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    with open(path, 'rb') as file:
+        return {'size': stat.st_size, 'sha1': hashlib.sha1(file.read()).hexdigest()}
 
-            for contour in contours:
-                mask = np.zeros_like(image[:,:,0], dtype=np.uint8)
-                cv2.drawContours(mask, [contour], -1, 255, thickness=cv2.FILLED)
 
-                kernel = np.ones((15, 15), np.uint8)  # Create a 15x15 kernel
-                dilated_mask = cv2.dilate(mask, kernel, iterations=1)  # Dilate the mask
+def _process_image(paths):
+    # Errors are returned rather than raised, so that one corrupt image doesn't stop the batch
+    image_path, result_path = paths
+    try:
+        image = cv2.imread(image_path)
+        if image is None:
+            raise ValueError("the image can't be read")
+        if not cv2.imwrite(result_path, mark_parked_cars(image)):
+            raise OSError(f"the result can't be written to {result_path}")
+    except Exception as e:
+        return image_path, f"{type(e).__name__}: {e}"
+    return image_path, None
 
-                # Count the number of black and lilac pixels in the dilated mask
-                black_count = np.sum(np.all(image[dilated_mask == 255] == black_bgr, axis=-1))
-                lilac_count = np.sum(np.all(image[dilated_mask == 255] == lilac_bgr, axis=-1))
 
-                # Change color of pixels if there are more black pixels than lilac pixels
-                if black_count > lilac_count:
-                    change_mask = np.logical_and(original_blue_mask, mask)
-                    image[change_mask] = [0, 255, 255]
+def _save_manifest(manifest, manifest_path):
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def car_detection_batch(input_folder, output_folder, workers=None, use_hash=False):
+    """
+    Run car_detection over a folder of predicted images in parallel, skipping images already processed.
+
+    Results are written to a separate output folder, so previous outputs are never taken as inputs.
+    A manifest in the output folder records the signature (size and modification time, or size and hash) of
+    every processed input; inputs whose signature hasn't changed and whose output exists are skipped.
+    Images that can't be processed (e.g. unreadable or corrupt files) are recorded in the manifest with their
+    'error' and the batch continues; they are tried again by the next run. The manifest is saved even if the
+    run is interrupted.
+
+    Parameters:
+    - input_folder (str): The path to the folder containing the images to process.
+    - output_folder (str): The path to the folder where the results and the manifest are saved.
+    - workers (int, optional): Number of worker processes. Defaults to the number of CPUs.
+    - use_hash (bool, optional): Whether to detect changes by content hash instead of modification time.
+                                 Default is False.
+
+    Returns:
+    - int: The number of images processed successfully.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    manifest_path = os.path.join(output_folder, 'manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as file:
+            manifest = json.load(file)
+
+    # Select the new or modified images
+    pending, signatures = [], {}
+    filenames = sorted(f for f in os.listdir(input_folder) if f.endswith(".png") and not f.endswith("_aparcado.png"))
+    for filename in filenames:
+        image_path = os.path.join(input_folder, filename)
+        result_path = os.path.join(output_folder, f"{os.path.splitext(filename)[0]}_aparcado.png")
+        signatures[image_path] = _file_signature(image_path, use_hash)
+        if manifest.get(filename) != signatures[image_path] or not os.path.exists(result_path):
+            pending.append((image_path, result_path))
+
+    start = time.perf_counter()
+    failed = []
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(_process_image, pending, chunksize=8)
+            for n_done, (image_path, error) in enumerate(results, start=1):
+                filename = os.path.basename(image_path)
+                if error is None:
+                    manifest[filename] = signatures[image_path]
+                else:
+                    manifest[filename] = {**signatures[image_path], 'error': error}
+                    failed.append(filename)
+                    print(f"Failed to process {filename}: {error}")
+                # Save progress regularly so an interrupted run can be resumed
+                if n_done % 100 == 0:
+                    _save_manifest(manifest, manifest_path)
+    finally:
+        _save_manifest(manifest, manifest_path)
+
+    elapsed = time.perf_counter() - start
+    print(f"{len(pending) - len(failed)} images processed in {elapsed:.2f}s, {len(failed)} failed, "
+          f"{len(filenames) - len(pending)} unchanged skipped.")
+    return len(pending) - len(failed)
 
-            # Save the modified image
-            result_filename = f"{os.path.splitext(filename)[0]}_aparcado.png"
-            result_path = os.path.join(folder_path, result_filename)
-            cv2.imwrite(result_path, image)
 
 if __name__ == "__main__":
     folder_path = '/content/drive/My Drive/FotosGranada/predicted_images'
@@ -1,99 +1,223 @@
 from fastai.vision.all import *
-from src.data.dataset import get_items, get_y_fn
+from src.data.dataset import datablock_getters, build_dataloaders, build_image_cache, build_mask_cache, uses_image_cache
 from src.models.model_loader import load_config
+from src.models.registry import load_model
+from src.evaluate.figures import SampleSelector, colorize, render_comparisons
+from src.utils.mask_codec import load_mask_codec
+from src.utils.confusion import ConfusionMatrix, save_class_metrics_to_csv
 from pathlib import Path
 import matplotlib.pyplot as plt
 
-def evaluate_model(config_path, model_path):
+def evaluate_model(config_path, model_path, streaming=True, masks_dir=None, interactive=False):
     """
     Evaluate a trained model on a test dataset.
 
     This function loads a trained model and a test dataset, and then performs evaluation by making predictions
-    on the test data. It can optionally visualize the results for qualitative analysis.
+    on the test data. It saves comparison figures of a selection of samples for qualitative analysis.
 
     Parameters:
     - config_path (str): Path to the configuration file (config.yaml) which contains model and dataset settings.
-    - model_path (str): Path to the trained model file (usually a .pkl file).
+    - model_path (str): Path to the trained model file (usually a .pkl file), or a model of the registry
+                        ('name' or 'name:version', see src.models.registry).
+    - streaming (bool, optional): Accumulate a confusion matrix batch by batch instead of keeping the
+                                  probabilities of the whole test set in memory. Default is True.
+    - masks_dir (str, optional): Folder where the predicted masks are written as uint8 PNGs (streaming only).
+    - interactive (bool, optional): Also display the selected samples with pyplot. Default is False.
+
+    Returns:
+    - ConfusionMatrix: The confusion matrix of the test set, with the matrix of every tile.
 
     Workflow:
     1. Load the configuration from the given path.
     2. Prepare the test dataset using DataBlock with appropriate transformations and DataLoader.
     3. Load the trained model from the specified path.
-    4. Make predictions on the test dataset using the model.
-    5. Optionally, visualize the results for a subset of the test dataset.
+    4. Make predictions on the test dataset using the model, selecting the samples to plot on the way.
+    5. Report the Dice and Jaccard coefficients and save the per-class and per-tile metrics.
+    6. Render the comparison figures of the selected samples in parallel (see the 'evaluation' section
+       of the configuration).
     """
     # Load Configuration
     config = load_config(config_path)
 
+    # Preprocess the class masks and images once (only new or modified files are decoded)
+    test_path = Path(config['data']['path_test_dataset'])
+    build_mask_cache(test_path, config_path)
+    build_image_cache(test_path, config_path)
+
     # Prepare Test Data
+    getters = datablock_getters(config['data'], config_path)
     test_data = DataBlock(
         blocks=(ImageBlock, MaskBlock(codes=np.arange(config['model']['classes']))),
-        get_items=get_items, 
-        get_y=get_y_fn,
-        item_tfms=Resize(config['data']['augmentation']['resize']),
+        **getters,
+        item_tfms=None if uses_image_cache(config['data'], config_path) else Resize(config['data']['augmentation']['resize']),
         batch_tfms=None
     )
 
-    test_path = Path(config['data']['path_test_dataset'])
-    dls = test_data.dataloaders(test_path, bs=config['data']['batch_size'])
+    dls = build_dataloaders(test_data, test_path, config['data'])
 
-    # Load Model
-    model = load_learner(model_path)
+    # Load Model (kept in the model cache of the process, so repeated evaluations skip the load)
+    model = load_model(config, model_path)
+    if isinstance(model, nn.Module):
+        model = Learner(dls, model, loss_func=CrossEntropyLossFlat(axis=1))
+    elif not isinstance(model, Learner):
+        raise ValueError(f"Model {model_path} is exported for inference only; evaluate its learner or weights, "
+                         f"or compare it with src.models.export --report")
 
     # Evaluate the Model
-    test_dl = dls.test_dl(get_items(test_path))
-    preds, targs = model.get_preds(dl=test_dl)
+    num_classes = config['model']['classes']
+    figures_config = config.get('evaluation', {}).get('figures', {})
+    selector = SampleSelector(figures_config.get('selection', 'worst'), figures_config.get('samples', 5),
+                              num_classes, seed=figures_config.get('seed', 0))
+    test_dl = dls.test_dl(getters['get_items'](test_path), with_labels=True)
+    if streaming:
+        metrics = evaluate_streaming(model, test_dl, num_classes, masks_dir=masks_dir, selector=selector)
+    else:
+        preds, _ = model.get_preds(dl=test_dl)
+        metrics = ConfusionMatrix(num_classes, track_tiles=True)
+        preds = preds.argmax(dim=1).to(torch.uint8).numpy()
+
+        # Second pass over the data for the images only; the predictions are reused
+        n_items = 0
+        for xb, yb in test_dl:
+            _update_batch(metrics, selector, test_dl, n_items, xb, yb, preds[n_items:n_items + len(xb)])
+            n_items += len(xb)
+
+    scores = metrics.scores()
+    print(f"Dice: {scores['mean_dice']:.4f}, Jaccard: {scores['mean_jaccard']:.4f}, "
+          f"frequency-weighted IoU: {scores['fw_iou']:.4f}")
+
+    # Save per-class and per-tile metrics
+    metrics_path = Path(config['paths']['metrics'])
+    metrics_path.mkdir(parents=True, exist_ok=True)
+    model_name = Path(model_path).stem.replace(':', '_')
+    save_class_metrics_to_csv(metrics, metrics_path / f"{model_name}_class_metrics.csv")
+    tiles = metrics.tile_table()
+    tiles.to_csv(metrics_path / f"{model_name}_tile_metrics.csv", index=False)
+    print(f"Worst tiles:\n{tiles.head(5).to_string(index=False)}")
+
+    # Visualization
+    palette = load_mask_codec(config_path).palette
+    samples = selector.samples()
+    render_comparisons(samples, config['paths']['figures'], palette, workers=figures_config.get('workers'))
+    if interactive:
+        show_samples(samples, palette)
+    return metrics
+
+
+def _item_name(item):
+    """
+    Return a file name stem for a dataset item (an image path, or a (shard, index) pair).
+    """
+    if isinstance(item, tuple):
+        return f"{Path(item[0]).name}_{item[1]:06d}"
+    return Path(item).stem
+
+
+def _update_batch(metrics, selector, dl, start, xb, yb, preds):
+    """
+    Add a batch of predictions to the confusion matrix and offer its tiles to the sample selector.
+    """
+    names = [_item_name(item) for item in dl.items[start:start + len(preds)]]
+    targs = yb.cpu().numpy()
+    metrics.update(preds, targs, names)
+    if selector is not None:
+        images = (xb.cpu() * 255).round().clamp(0, 255).to(torch.uint8).permute(0, 2, 3, 1).numpy()
+        selector.offer(names, images, targs, preds, metrics.tile_matrices[-1])
+    return names
+
+
+def evaluate_streaming(learner, test_dl, num_classes, masks_dir=None, selector=None):
+    """
+    Evaluate a model batch by batch, keeping only confusion matrices in memory.
+
+    Each batch is predicted, reduced to class indices with argmax and added to the confusion matrix, so the
+    memory used doesn't grow with the size of the images (only C x C integers are kept per tile). The
+    predicted masks can be written to disk as uint8 PNGs named after the test items.
+
+    Parameters:
+    - learner (Learner): The trained learner.
+    - test_dl (DataLoader): DataLoader for the test dataset (with targets).
+    - num_classes (int): Number of classes.
+    - masks_dir (str, optional): Folder where the predicted masks are written. Default is None (not written).
+    - selector (SampleSelector, optional): Selector of the samples to plot, offered every batch.
+
+    Returns:
+    - ConfusionMatrix: The confusion matrix, with the matrix of every tile.
+    """
+    if masks_dir is not None:
+        masks_dir = Path(masks_dir)
+        masks_dir.mkdir(parents=True, exist_ok=True)
+
+    model = learner.model.eval()
+    metrics = ConfusionMatrix(num_classes, track_tiles=True)
+    n_items = 0
+    with torch.inference_mode():
+        for xb, yb in test_dl:
+            pred = model(xb).argmax(dim=1).to(torch.uint8).cpu().numpy()
+            names = _update_batch(metrics, selector, test_dl, n_items, xb, yb, pred)
+
+            if masks_dir is not None:
+                for name, mask in zip(names, pred):
+                    Image.fromarray(mask).save(masks_dir / f"{name}.png")
+            n_items += len(pred)
+
+    print(f"Evaluated {n_items} items.")
+    return metrics
 
-    # Visualization (Optional)
-    show_results(test_dl, preds, targs, config)
 
 def show_results(test_dl, preds, targs, config, num_samples=5):
     """
-    Show a comparison between original images, true masks, and predicted masks.
+    Show a comparison between original images, true masks, and predicted masks of the first test batch, and save
+    the figures as 'sample_<i>_comparison.png' in the figures folder. evaluate_model selects the samples over
+    the whole test set instead (see SampleSelector and show_samples).
 
     Parameters:
     - test_dl: DataLoader for the test dataset.
     - preds: Predictions from the model.
     - targs: Actual targets (true masks).
+    - config: The configuration, with the figures folder in paths.figures.
     - num_samples: Number of samples to display.
     """
+    x, _ = test_dl.one_batch()
+    num_samples = min(num_samples, len(x))
+    images = (x[:num_samples].cpu() * 255).round().clamp(0, 255).to(torch.uint8).permute(0, 2, 3, 1).numpy()
+    samples = [(f"sample_{i}", images[i], targs[i].squeeze().cpu().numpy(), preds[i].argmax(dim=0).cpu().numpy())
+               for i in range(num_samples)]
+    render_comparisons(samples, config['paths']['figures'], workers=1)
+    show_samples(samples)
 
-    # Get the path to save the figures
-    figures_save_path = Path(config['paths']['figures'])
 
-    # Get a batch of data
-    x, y = test_dl.one_batch()
-    for i in range(num_samples):
-        # Extract the image, true mask, and predicted mask
-        img = x[i]
-        true_mask = y[i]
-        pred_mask = preds[i].argmax(dim=0)
+def show_samples(samples, palette=None):
+    """
+    Show a comparison between original images, true masks, and predicted masks.
 
+    Parameters:
+    - samples: Samples as returned by SampleSelector.samples (the predictions already computed).
+    - palette: Colors of the classes (num_classes x 3). Masks are shown in gray scale if not given.
+    """
+    for name, img, true_mask, pred_mask in samples:
         # Set up the figure
         fig, axs = plt.subplots(1, 3, figsize=(12, 4))
-        
+        fig.suptitle(name)
+        cmap = 'gray' if palette is None else None
+
         # Show original image
-        axs[0].imshow(img.permute(1, 2, 0))
+        axs[0].imshow(img)
         axs[0].set_title('Original Image')
         axs[0].axis('off')
 
         # Show true mask
-        axs[1].imshow(true_mask.squeeze(), cmap='gray')
+        axs[1].imshow(colorize(true_mask, palette), cmap=cmap)
         axs[1].set_title('True Mask')
         axs[1].axis('off')
 
         # Show predicted mask
-        axs[2].imshow(pred_mask, cmap='gray')
+        axs[2].imshow(colorize(pred_mask, palette), cmap=cmap)
         axs[2].set_title('Predicted Mask')
         axs[2].axis('off')
 
-        # Save figure
-        fig.savefig(figures_save_path / f"sample_{i}_comparison.png")
-
-        plt.show()
-
-    print(f"Displayed {num_samples} samples.")
+    plt.show()
+    print(f"Displayed {len(samples)} samples.")
 
 if __name__ == "__main__":
     evaluate_model('config.yaml', 'results/models/pspnet.pkl')
-
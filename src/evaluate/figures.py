@@ -0,0 +1,158 @@
+import heapq
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+from src.utils.confusion import class_scores
+
+SELECTION_MODES = ('random', 'worst', 'per_class')
+
+
+class SampleSelector:
+    """
+    Select the samples to plot while the test set is being evaluated, keeping only the selected ones.
+
+    Each batch is offered with its images, targets, predictions and per-tile confusion matrices, and only the
+    current candidates are kept (as uint8 arrays), so selecting samples doesn't require a second pass over the
+    data nor keeping all the predictions in memory.
+
+    Selection modes:
+    - 'random': a uniform random sample of the tiles (reservoir sampling).
+    - 'worst': the tiles with the lowest mean IoU over the classes present.
+    - 'per_class': for each class, the tiles with the lowest IoU of that class, among those where it appears.
+
+    Parameters:
+    - mode (str, optional): 'random', 'worst' or 'per_class'. Default is 'worst'.
+    - n_samples (int, optional): Number of samples to select (per class with 'per_class'). Default is 5.
+    - num_classes (int, optional): Number of classes. Default is 3.
+    - seed (int, optional): Seed of the random selection. Default is 0.
+    """
+    def __init__(self, mode='worst', n_samples=5, num_classes=3, seed=0):
+        if mode not in SELECTION_MODES:
+            raise ValueError(f"Unknown selection mode: {mode}. Choose from {SELECTION_MODES}")
+        self.mode = mode
+        self.n_samples = n_samples
+        self.num_classes = num_classes
+        self.rng = np.random.default_rng(seed)
+        self.n_seen = 0
+        # One heap per group of (-score, order, sample); the root is the best kept sample
+        self.heaps = {c: [] for c in (range(num_classes) if mode == 'per_class' else [None])}
+
+    def _push(self, group, score, name, *arrays):
+        heap = self.heaps[group]
+        if len(heap) < self.n_samples or -score > heap[0][0]:
+            # Copy the kept tiles: slices of the batch arrays would keep the whole batches in memory
+            entry = (-score, self.n_seen, (name, *(array.copy() for array in arrays)))
+            (heapq.heappush if len(heap) < self.n_samples else heapq.heapreplace)(heap, entry)
+
+    def offer(self, names, images, targs, preds, tile_cms):
+        """
+        Offer a batch of tiles.
+
+        Parameters:
+        - names (List[str]): Names of the tiles.
+        - images (numpy.ndarray): uint8 images (N x H x W x 3).
+        - targs (numpy.ndarray): True class masks (N x H x W).
+        - preds (numpy.ndarray): Predicted class masks (N x H x W).
+        - tile_cms (numpy.ndarray): Confusion matrix of each tile (see src.utils.confusion.tile_confusion_matrices).
+        """
+        iou = class_scores(tile_cms)['iou']
+        with np.errstate(all='ignore'):
+            mean_iou = np.nanmean(iou, axis=1)
+
+        for i, name in enumerate(names):
+            if self.mode == 'random':
+                # Reservoir sampling with a random priority per tile
+                self._push(None, -self.rng.random(), name, images[i], targs[i], preds[i])
+            elif self.mode == 'worst':
+                self._push(None, float(mean_iou[i]), name, images[i], targs[i], preds[i])
+            else:
+                for c in range(self.num_classes):
+                    if not np.isnan(iou[i, c]):
+                        self._push(c, float(iou[i, c]), f"{name}_class{c}", images[i], targs[i], preds[i])
+            self.n_seen += 1
+
+    def samples(self):
+        """
+        Return the selected samples as (name, image, target, prediction) tuples, worst first (per class with
+        'per_class').
+        """
+        samples = []
+        for heap in self.heaps.values():
+            samples.extend(sample for _, _, sample in sorted(heap, key=lambda e: (-e[0], e[1])))
+        return samples
+
+
+def colorize(mask, palette=None):
+    """
+    Map a class mask to colors with a (num_classes x 3) palette, or return it as is without a palette.
+    """
+    return mask if palette is None else np.asarray(palette, dtype=np.uint8)[mask]
+
+
+def render_comparison(sample, output_path, palette=None):
+    """
+    Render the image, true mask and predicted mask of a sample side by side and save the figure.
+
+    The figure is drawn on an Agg canvas without pyplot, so it works in headless processes and doesn't touch
+    any global figure state.
+
+    Parameters:
+    - sample (tuple): (name, image, target, prediction), as returned by SampleSelector.samples.
+    - output_path (str): Path of the output image.
+    - palette (numpy.ndarray, optional): Colors of the classes (num_classes x 3). Masks are drawn in gray
+                                         scale if not given.
+
+    Returns:
+    - str: The output path.
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    name, image, target, prediction = sample
+    fig = Figure(figsize=(12, 4))
+    FigureCanvasAgg(fig)
+    axs = fig.subplots(1, 3)
+    gray = {'cmap': 'gray'} if palette is None else {}
+    for ax, data, title, kwargs in ((axs[0], image, 'Original Image', {}),
+                                    (axs[1], colorize(target, palette), 'True Mask', gray),
+                                    (axs[2], colorize(prediction, palette), 'Predicted Mask', gray)):
+        ax.imshow(data, interpolation='nearest', **kwargs)
+        ax.set_title(title)
+        ax.axis('off')
+    fig.suptitle(name)
+    fig.savefig(output_path)
+    return str(output_path)
+
+
+def _render_job(job):
+    return render_comparison(*job)
+
+
+def render_comparisons(samples, output_folder, palette=None, workers=None):
+    """
+    Render the comparison figures of several samples in parallel worker processes.
+
+    Parameters:
+    - samples (List[tuple]): Samples as returned by SampleSelector.samples.
+    - output_folder (str): Folder where the figures are saved as '<name>_comparison.png'.
+    - palette (numpy.ndarray, optional): Colors of the classes (num_classes x 3).
+    - workers (int, optional): Number of worker processes. Defaults to the number of CPUs; 1 renders in
+                               the current process.
+
+    Returns:
+    - List[str]: The paths of the figures.
+    """
+    output_folder = Path(output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    jobs = [(sample, output_folder / f"{sample[0]}_comparison.png", palette) for sample in samples]
+
+    workers = min(workers or os.cpu_count() or 1, max(len(jobs), 1))
+    if workers == 1:
+        paths = [_render_job(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            paths = list(executor.map(_render_job, jobs, chunksize=max(1, len(jobs) // (4 * workers))))
+
+    print(f"Saved {len(paths)} comparison figures to {output_folder}")
+    return paths
@@ -0,0 +1,165 @@
+import os
+import time
+import torch
+from fastai.callback.core import Callback
+from fastai.torch_core import to_float
+
+
+def bf16_supported():
+    """
+    Check whether the CPU runs bfloat16 natively (AVX512-BF16 or AMX), so that bf16 autocast is faster than fp32.
+    """
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def available_cores():
+    """
+    Return the CPU cores the current process may run on.
+    """
+    return sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+
+
+def set_cpu_budget(cores=None, threads=None):
+    """
+    Restrict the current process to a subset of the CPU cores and a number of PyTorch threads, so that several
+    training processes on one machine don't compete for the same cores.
+
+    Parameters:
+    - cores (List[int], optional): Cores to pin the process to (Linux only). Default is None (all cores).
+    - threads (int, optional): Number of intra-op PyTorch threads. Defaults to the number of cores.
+    """
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    threads = threads or (len(cores) if cores else None)
+    if threads:
+        torch.set_num_threads(threads)
+
+
+class CPUAcceleration(Callback):
+    """
+    A fastai callback that enables CPU training speed-ups and logs the training throughput of each epoch.
+
+    Modes:
+    - bf16: mixed precision with torch.autocast on the CPU (bfloat16 has the range of float32, so no loss
+            scaling is needed). Falls back to fp32 when the CPU has no native bfloat16 support.
+    - channels_last: the model and the input batches use the channels-last memory format, which the oneDNN
+                     convolutions of the ResNet encoders run faster with.
+    - compile: the model is compiled with torch.compile. A first forward pass on a batch checks that it
+               compiles; otherwise training continues in eager mode. The eager model is restored at the end
+               of training so that the learner can be exported.
+
+    Parameters:
+    - bf16 (bool, optional): Enable bfloat16 autocast. Default is False.
+    - channels_last (bool, optional): Enable the channels-last memory format. Default is False.
+    - compile (bool, optional): Compile the model with torch.compile. Default is False.
+    - compile_mode (str, optional): Mode passed to torch.compile (e.g. 'max-autotune'). Default is None.
+    """
+    order = 10
+
+    def __init__(self, bf16=False, channels_last=False, compile=False, compile_mode=None):
+        self.bf16 = bf16
+        self.channels_last = channels_last
+        self.compile = compile
+        self.compile_mode = compile_mode
+        self.autocast = None
+
+    def _fallback(self, mode, reason):
+        print(f"{mode} disabled: {reason}")
+        setattr(self, mode, False)
+
+    def before_fit(self):
+        if self.bf16 and not bf16_supported():
+            self._fallback('bf16', "the CPU has no native bfloat16 support")
+
+        if self.channels_last:
+            try:
+                self.learn.model = self.model.to(memory_format=torch.channels_last)
+            except RuntimeError as e:
+                self._fallback('channels_last', e)
+
+        self.eager_model = self.model
+        if self.compile:
+            if not hasattr(torch, 'compile'):
+                self._fallback('compile', f"torch.compile is not available in PyTorch {torch.__version__}")
+            else:
+                self._compile()
+
+        self.modes = [mode for mode in ('bf16', 'channels_last', 'compile') if getattr(self, mode)] or ['fp32']
+        print(f"Training modes: {', '.join(self.modes)}")
+
+    def _compile(self):
+        compiled = torch.compile(self.model, mode=self.compile_mode)
+        xb = self._format(self.dls.train.one_batch()[0][:2])
+        try:
+            with torch.no_grad(), torch.autocast('cpu', dtype=torch.bfloat16, enabled=self.bf16):
+                compiled.eval()(xb)
+            self.learn.model = compiled.train()
+        except Exception as e:
+            self.eager_model.train()
+            # Compiler errors span many lines; the last one states the cause
+            self._fallback('compile', (str(e).strip().splitlines() or [type(e).__name__])[-1])
+
+    def _format(self, x):
+        if self.compile:
+            # The fastai tensor subclasses (TensorImage) can't be traced by torch.compile
+            x = x.as_subclass(torch.Tensor)
+        return x.contiguous(memory_format=torch.channels_last) if self.channels_last and x.dim() == 4 else x
+
+    def before_train(self):
+        self.n_samples = 0
+        self.start = time.perf_counter()
+
+    def before_batch(self):
+        if self.channels_last or self.compile:
+            self.learn.xb = tuple(self._format(x) for x in self.xb)
+        if self.bf16:
+            self.autocast = torch.autocast('cpu', dtype=torch.bfloat16)
+            self.autocast.__enter__()
+
+    def after_pred(self):
+        if self.bf16:
+            self.learn.pred = to_float(self.pred)
+
+    def after_loss(self):
+        if self.autocast is not None:
+            self.autocast.__exit__(None, None, None)
+            self.autocast = None
+
+    def after_batch(self):
+        if self.training:
+            self.n_samples += len(self.xb[0])
+
+    def after_train(self):
+        elapsed = time.perf_counter() - self.start
+        print(f"Epoch {self.epoch + 1} training throughput ({', '.join(self.modes)}): "
+              f"{self.n_samples / elapsed:.1f} samples/s")
+
+    def after_fit(self):
+        # Export the eager model, in the default memory format
+        self.learn.model = self.eager_model.to(memory_format=torch.contiguous_format)
+
+
+def acceleration_callback(config):
+    """
+    Create the CPUAcceleration callback configured in the 'training.acceleration' section of the configuration:
+
+        acceleration:
+          bf16: true
+          channels_last: true
+          compile: false
+          compile_mode: null
+
+    Parameters:
+    - config (dict): The configuration.
+
+    Returns:
+    - CPUAcceleration or None: The callback, or None if no mode is enabled.
+    """
+    acceleration = config['training'].get('acceleration') or {}
+    modes = {mode: bool(acceleration.get(mode, False)) for mode in ('bf16', 'channels_last', 'compile')}
+    if not any(modes.values()):
+        return None
+    return CPUAcceleration(**modes, compile_mode=acceleration.get('compile_mode'))
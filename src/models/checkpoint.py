@@ -0,0 +1,240 @@
+import os
+import random
+from pathlib import Path
+import numpy as np
+import torch
+from fastai.callback.core import Callback, CancelFitException
+from fastai.torch_core import rank_distrib
+from torch.nn.parallel import DistributedDataParallel
+from src.models.distributed import CPUDistributedDL
+
+
+def _eager(model):
+    # Unwrap DistributedDataParallel (see src.models.distributed) and torch.compile (see
+    # src.models.acceleration), whose weights are in module and _orig_mod
+    if isinstance(model, DistributedDataParallel):
+        model = model.module
+    return getattr(model, '_orig_mod', model)
+
+
+def _train_dl(learner):
+    # The training DataLoader, unwrapped from its distributed shard
+    dl = learner.dls.train
+    return dl.dl if isinstance(dl, CPUDistributedDL) else dl
+
+
+def _generators(learner):
+    # Batch transforms with their own generator (e.g. BatchShadowTransform)
+    return [tfm.generator for tfm in _train_dl(learner).after_batch.fs
+            if isinstance(getattr(tfm, 'generator', None), torch.Generator)]
+
+
+def _rng_state(learner):
+    return {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state(),
+            'dataloader': _train_dl(learner).rng.getstate(),
+            'transforms': [generator.get_state() for generator in _generators(learner)]}
+
+
+def _set_rng_state(learner, state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    _train_dl(learner).rng.setstate(state['dataloader'])
+    for generator, generator_state in zip(_generators(learner), state['transforms']):
+        generator.set_state(generator_state)
+
+
+def _save(obj, path):
+    if rank_distrib():
+        return  # In distributed training, the processes have the same state and rank 0 saves it
+    # Write to a temporary file first, so that a run killed while saving keeps its previous checkpoint
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def latest_checkpoint(folder):
+    """
+    Return the path of the most recent epoch checkpoint ('epoch_XXX.pth') in a folder, or None if there is none.
+    """
+    checkpoints = sorted(Path(folder).glob('epoch_*.pth'))
+    return checkpoints[-1] if checkpoints else None
+
+
+class CheckpointCallback(Callback):
+    """
+    A fastai callback that saves a checkpoint after every epoch, keeps the best model and stops training early.
+
+    Each checkpoint ('<folder>/epoch_XXX.pth') holds the model weights, the optimizer state, the RNG states
+    (Python, NumPy, PyTorch, the shuffling of the training DataLoader and the generators of the batch
+    transforms) and the metrics of the epochs run so far. The one-cycle learning rate and momentum schedule is a
+    function of the epoch, so resuming with fit_one_cycle(epochs, start_epoch=...) continues it where it
+    stopped, and a resumed run reproduces the interrupted one. See resume.
+
+    The best model is tracked on a monitored metric (e.g. 'dice_multi' or 'jaccard_coeff_multi'): its weights
+    are kept in memory (and in '<folder>/best.pth') and loaded back into the model when training ends.
+
+    Parameters:
+    - folder (str, optional): Folder of the checkpoints. Default is None (no checkpoints, best model in memory).
+    - keep (int, optional): Number of most recent epoch checkpoints kept. Default is 2 (None keeps all).
+    - monitor (str, optional): Metric of the best model, as named by the fastai Recorder. Default is 'dice_multi'.
+    - patience (int, optional): Epochs without improvement before stopping. Default is None (no early stopping).
+    - min_delta (float, optional): Minimum improvement of the monitored metric. Default is 0.
+    - restore_best (bool, optional): Load the weights of the best epoch at the end of training. Default is False.
+    """
+    order = 55  # After the Recorder, so that the metrics of the epoch are recorded
+
+    def __init__(self, folder=None, keep=2, monitor='dice_multi', patience=None, min_delta=0.0, restore_best=False):
+        self.folder = Path(folder) if folder else None
+        self.keep = keep
+        self.monitor = monitor
+        self.patience = patience
+        self.min_delta = min_delta
+        self.restore_best = restore_best
+        # Losses and errors improve downwards, the segmentation metrics upwards
+        self.sign = -1 if 'loss' in monitor or 'error' in monitor else 1
+        self.start_epoch = 0
+        self.history = []
+        self.smooth_loss = None
+        self.best_state = None
+
+    def resume(self, n_epoch):
+        """
+        Load the latest checkpoint of the folder into the learner, if any.
+
+        A run whose last checkpoint is already at n_epoch is complete: resuming it would train nothing, so its
+        checkpoints are deleted and a new run starts from scratch.
+
+        Parameters:
+        - n_epoch (int): Total number of epochs of the run, which the checkpoint must have been saved with.
+
+        Returns:
+        - int: The epoch to resume from, to be passed as start_epoch to fit_one_cycle (0 without checkpoint).
+        """
+        path = latest_checkpoint(self.folder) if self.folder else None
+        if path is None:
+            return 0
+
+        checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+        if checkpoint['n_epoch'] != n_epoch:
+            raise ValueError(f"Checkpoint {path} belongs to a run of {checkpoint['n_epoch']} epochs, not "
+                             f"{n_epoch}: the learning rate schedule wouldn't match")
+        if checkpoint['epoch'] >= n_epoch:
+            print(f"The run of {path.parent} is already complete ({checkpoint['epoch']}/{n_epoch} epochs): "
+                  f"deleting its checkpoints and training from scratch")
+            self.clear()
+            return 0
+        _eager(self.learn.model).load_state_dict(checkpoint['model'])
+        if self.learn.opt is None:
+            self.learn.create_opt()
+        self.learn.opt.load_state_dict(checkpoint['opt'])
+        _set_rng_state(self.learn, checkpoint['rng'])
+        self.history = checkpoint['history']
+        self.smooth_loss = checkpoint['smooth_loss']
+        best_path = self.folder / 'best.pth'
+        if self.restore_best and best_path.exists():
+            self.best_state = torch.load(best_path, map_location='cpu', weights_only=False)
+
+        self.start_epoch = checkpoint['epoch']
+        print(f"Resuming from {path} (epoch {self.start_epoch}/{checkpoint['n_epoch']})")
+        return self.start_epoch
+
+    def clear(self):
+        """
+        Delete the checkpoints of the folder, to start a new run.
+        """
+        if self.folder is not None and not rank_distrib():
+            for path in [*self.folder.glob('epoch_*.pth'), self.folder / 'best.pth']:
+                path.unlink(missing_ok=True)
+
+    def before_fit(self):
+        self.run = not hasattr(self.learn, 'lr_finder') and not hasattr(self, 'gather_preds')
+        self.best, self.best_epoch, self.wait = -float('inf'), None, 0
+        self.idx = list(self.recorder.metric_names[1:]).index(self.monitor)
+        if self.folder is not None:
+            self.folder.mkdir(parents=True, exist_ok=True)
+        if self.start_epoch and self.smooth_loss is not None:
+            # Continue the smoothed training loss reported by the Recorder
+            self.recorder.smooth_loss.count, self.recorder.smooth_loss.val = self.smooth_loss
+
+    def after_epoch(self):
+        replayed = self.epoch < self.start_epoch
+        if replayed:
+            # Epochs skipped on resume: put back their recorded metrics, which also replays the best model and
+            # early stopping bookkeeping
+            self.recorder.values[-1] = self.learn.final_record = self.history[self.epoch]
+        else:
+            self.history = [list(values) for values in self.recorder.values]
+
+        value = self.sign * float(self.recorder.values[-1][self.idx])
+        if value > self.best + self.min_delta:
+            self.best, self.best_epoch, self.wait = value, self.epoch + 1, 0
+            if not replayed:
+                self._save_best()
+        else:
+            self.wait += 1
+
+        if not replayed:
+            self._save_checkpoint()
+        if self.patience is not None and self.wait >= self.patience:
+            print(f"No improvement of {self.monitor} since epoch {self.best_epoch}: early stopping")
+            raise CancelFitException()
+
+    def _save_best(self):
+        if not self.restore_best and self.folder is None:
+            return
+        self.best_state = {k: v.detach().cpu().clone() for k, v in _eager(self.model).state_dict().items()}
+        if self.folder is not None:
+            _save(self.best_state, self.folder / 'best.pth')
+
+    def _save_checkpoint(self):
+        if self.folder is None:
+            return
+        path = self.folder / f"epoch_{self.epoch + 1:03d}.pth"
+        _save({'epoch': self.epoch + 1, 'n_epoch': self.n_epoch, 'model': _eager(self.model).state_dict(),
+               'opt': self.opt.state_dict(), 'rng': _rng_state(self.learn), 'history': self.history,
+               'smooth_loss': (self.recorder.smooth_loss.count, self.recorder.smooth_loss.val)}, path)
+
+        if self.keep is not None and not rank_distrib():
+            for old in sorted(self.folder.glob('epoch_*.pth'))[:-self.keep]:
+                old.unlink()
+
+    def after_fit(self):
+        if self.restore_best and self.best_state is not None:
+            _eager(self.model).load_state_dict(self.best_state)
+            print(f"Restored the best model: epoch {self.best_epoch} with {self.monitor} "
+                  f"{self.sign * self.best:.4f}")
+        self.start_epoch = 0
+
+
+def checkpoint_callback(config):
+    """
+    Create the CheckpointCallback configured in the 'training.checkpoint' section of the configuration:
+
+        checkpoint:
+          enabled: true
+          path: './results/checkpoints'  # One folder per model type
+          keep: 2
+          resume: true
+          monitor: dice_multi
+          restore_best: true
+          patience: 3
+          min_delta: 0.0
+
+    With checkpoints disabled, the callback still keeps the best model and stops early if a patience is given.
+
+    Parameters:
+    - config (dict): The configuration, with the model type already selected.
+
+    Returns:
+    - CheckpointCallback or None: The callback, or None if checkpoints, best model and early stopping are all
+      disabled.
+    """
+    checkpoint = config['training'].get('checkpoint') or {}
+    enabled = checkpoint.get('enabled', False)
+    if not (enabled or checkpoint.get('restore_best', False) or checkpoint.get('patience') is not None):
+        return None
+    folder = Path(checkpoint.get('path', './results/checkpoints')) / config['model']['type'] if enabled else None
+    return CheckpointCallback(folder, keep=checkpoint.get('keep', 2), monitor=checkpoint.get('monitor', 'dice_multi'),
+                              patience=checkpoint.get('patience'), min_delta=checkpoint.get('min_delta', 0.0),
+                              restore_best=checkpoint.get('restore_best', False))
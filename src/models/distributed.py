@@ -0,0 +1,324 @@
+import argparse
+import math
+import os
+import torch
+import torch.distributed as dist
+from fastai.callback.core import Callback
+from fastai.data.core import TfmdDL
+from fastai.data.load import _FakeLoader
+from fastai.learner import AvgLoss, AvgMetric
+from fastai.torch_core import apply, find_bs, num_distrib, rank_distrib, to_detach
+from torch.nn.parallel import DistributedDataParallel
+
+
+class CPUDistributedDL(TfmdDL):
+    """
+    A DataLoader that gives each process of a distributed run its own shard of the data (gloo backend).
+
+    Every epoch, rank 0 shuffles the indices and broadcasts them, and each rank takes one index out of world_size
+    (rank r takes r, r + world_size, ...). The indices are padded with repeats of the first ones so that all the
+    ranks run the same number of batches; the batches gathered from the ranks are put back in dataset order and
+    stripped of the padding (see to_detach). It follows fastai's DistributedDL, which can't be used here: it
+    broadcasts the indices as CUDA tensors (NCCL only), and fastai.distributed requires Accelerate.
+
+    Parameters:
+    - dl (TfmdDL): The DataLoader to shard.
+    - rank (int, optional): Rank of the process. Defaults to the RANK environment variable.
+    - world_size (int, optional): Number of processes. Defaults to the WORLD_SIZE environment variable.
+    """
+    def __init__(self, dl, rank=None, world_size=None):
+        self.dl = dl
+        self.rank = rank_distrib() if rank is None else rank
+        self.world_size = num_distrib() if world_size is None else world_size
+        self.bs, self.drop_last, self.dataset, self.num_workers, self.offs, self.pin_memory, self.device = (
+            dl.bs, dl.drop_last, dl.dataset, dl.num_workers, dl.offs, dl.pin_memory, dl.device)
+        fake = dl.fake_l
+        self.fake_l = _FakeLoader(self, fake.pin_memory, fake.num_workers, fake.timeout,
+                                  persistent_workers=fake.persistent_workers,
+                                  pin_memory_device=fake.pin_memory_device)
+        self.fake_l.prefetch_factor = getattr(fake, 'prefetch_factor', None)
+
+    def __len__(self):
+        return math.ceil(len(self.dl) / self.world_size)
+
+    def get_idxs(self):
+        idxs = torch.LongTensor(list(self.dl.get_idxs()))
+        dist.broadcast(idxs, 0)  # The shuffle of rank 0
+        idxs = idxs.tolist()
+        self.n = len(idxs)
+        self.n_padded = math.ceil(self.n / self.world_size) * self.world_size
+        idxs += (idxs * (self.n_padded // self.n))[:self.n_padded - self.n]
+        return idxs[self.rank::self.world_size]
+
+    def padding(self, bs):
+        """
+        Return the slice of the padded items (past the n indices of the epoch) in the current batch of bs items.
+        """
+        first = -(-(self.n - self.rank) // self.world_size)  # Position of the first padded item of this rank
+        return slice(min(max(first - (self.i - bs), 0), bs), bs)
+
+    def before_iter(self):
+        self.i = 0
+        self.dl.before_iter()
+
+    def randomize(self): self.dl.randomize()
+    def after_iter(self): self.dl.after_iter()
+    def create_batches(self, samps): return self.dl.create_batches(samps)
+    def create_item(self, s): return self.dl.create_item(s)
+    def decode(self, b): return self.dl.decode(b)
+    def decode_batch(self, b, max_n=9, full=True): return self.dl.decode_batch(b, max_n, full)
+
+    def after_batch(self, b):
+        self.i += find_bs(b)
+        return self.dl.after_batch(b)
+
+    def to_detach(self, b, cpu=True, gather=True):
+        # Gathered across the ranks by fastai (e.g. the predictions of get_preds), rank after rank: put the
+        # items back in dataset order and drop the padding
+        b = to_detach(b, cpu, gather)
+        if not gather or num_distrib() < 2 or not hasattr(self, 'n'):
+            return b
+
+        def _unpad(x):
+            if not isinstance(x, torch.Tensor) or x.ndim == 0:
+                return x
+            bs = len(x) // self.world_size
+            x = x.view(self.world_size, bs, *x.shape[1:]).transpose(0, 1).reshape(x.shape)
+            return x[:max(self.n - (self.i - bs) * self.world_size, 0)]
+        return apply(_unpad, b)
+
+
+def _padded_sums(metric, loss_func, pred, yb):
+    # What a metric accumulated for the padded items of a batch: the sum of the value over the items and their
+    # number for the averaged metrics (AvgLoss, AvgMetric), the per-class intersection and union for DiceMulti
+    # and JaccardCoeffMulti, and None for the other metrics
+    n = find_bs(yb)
+    if isinstance(getattr(metric, 'inter', None), dict):
+        p, t = pred.argmax(dim=metric.axis), yb[0]
+        return torch.tensor([[float(((p == c) & (t == c)).sum()), float((p == c).sum() + (t == c).sum())]
+                             for c in range(pred.shape[metric.axis])], dtype=torch.float64)
+    if isinstance(metric, AvgLoss):
+        value = loss_func(pred, *yb).mean()
+    elif isinstance(metric, AvgMetric):
+        value = metric.func(pred, *yb)
+    else:
+        return None
+    return torch.tensor([float(value) * n, n], dtype=torch.float64)
+
+
+def sync_metrics(metrics):
+    """
+    Sum the per-class accumulators of the Dice and Jaccard metrics (DiceMulti, JaccardCoeffMulti) over all the
+    processes, so that every rank reports the metric of the whole validation set. The padded items must have
+    been removed first (see CPUDistributedTrainer).
+
+    The losses and the averaged metrics (e.g. foreground_acc) don't need it: fastai gathers their value over
+    the ranks at every batch.
+
+    Parameters:
+    - metrics (List[Metric]): The metrics of the Learner.
+    """
+    for metric in metrics:
+        inter, union = getattr(metric, 'inter', None), getattr(metric, 'union', None)
+        if not isinstance(inter, dict) or not isinstance(union, dict):
+            continue
+        classes = sorted(inter)
+        totals = torch.tensor([[inter[c] for c in classes], [union[c] for c in classes]], dtype=torch.float64)
+        dist.all_reduce(totals)
+        metric.inter = dict(zip(classes, totals[0].tolist()))
+        metric.union = dict(zip(classes, totals[1].tolist()))
+
+
+class CPUDistributedTrainer(Callback):
+    """
+    A fastai callback that trains with DistributedDataParallel on the CPU (gloo backend).
+
+    The model is wrapped in DistributedDataParallel without device_ids, and batch norm layers are not
+    synchronized (SyncBatchNorm needs CUDA), so each process normalizes with the statistics of its own batch.
+    The DataLoaders are wrapped in CPUDistributedDL, and the Dice and Jaccard metrics are summed over the ranks
+    after each validation (see sync_metrics). The padded items of the shards are removed from the validation
+    loss and metrics, so that each item of the validation set counts once. Only rank 0 logs.
+
+    Each process uses the configured batch size, so the effective batch size is batch_size * world size.
+    """
+    order = 11
+
+    def before_fit(self):
+        # The graph is the same at every step; declaring it static lets DDP skip the parameters that the model
+        # never uses (e.g. the last encoder stage of PSPNet) without searching for them every iteration
+        self.learn.model = DistributedDataParallel(self.model, static_graph=True)
+        self.old_dls = list(self.dls)
+        self.learn.dls.loaders = [self._wrap_dl(dl) for dl in self.dls]
+        if rank_distrib():
+            self.learn.logger = lambda *args, **kwargs: None
+
+    def _wrap_dl(self, dl):
+        return dl if isinstance(dl, CPUDistributedDL) else CPUDistributedDL(dl)
+
+    def before_train(self): self.learn.dl = self._wrap_dl(self.learn.dl)
+
+    def before_validate(self):
+        self.learn.dl = self._wrap_dl(self.learn.dl)
+        self.padded = {}  # What the padded items added to each validation metric
+
+    def after_batch(self):
+        if self.training or not self.yb or not isinstance(self.dl, CPUDistributedDL):
+            return
+        pad = self.dl.padding(find_bs(self.yb))
+        pred, yb = self.pred[pad], tuple(y[pad] for y in self.yb)
+        if not len(pred):
+            return
+        with torch.no_grad():
+            for i, metric in enumerate(self._valid_metrics()):
+                sums = _padded_sums(metric, self.learn.loss_func, pred, yb)
+                if sums is not None:
+                    self.padded[i] = self.padded.get(i, 0) + sums
+
+    def after_validate(self):
+        self._remove_padding()
+        sync_metrics(self.learn.metrics)
+
+    def _valid_metrics(self):
+        recorder = getattr(self.learn, 'recorder', None)
+        return list(getattr(recorder, '_valid_mets', []))
+
+    def _remove_padding(self):
+        metrics = self._valid_metrics()
+        # The averaged metrics hold the same mean of the gathered batches on every rank: subtract the padded
+        # items of all the ranks
+        averages = [i for i, metric in enumerate(metrics) if isinstance(metric, (AvgLoss, AvgMetric))]
+        if averages:
+            totals = torch.stack([torch.as_tensor(self.padded.get(i, torch.zeros(2)), dtype=torch.float64)
+                                  for i in averages])
+            dist.all_reduce(totals)
+            for i, (total, count) in zip(averages, totals.tolist()):
+                if count:
+                    metrics[i].total -= total / self.dl.world_size
+                    metrics[i].count -= count / self.dl.world_size
+        # The Dice and Jaccard accumulators are per rank (summed by sync_metrics)
+        for i, metric in enumerate(metrics):
+            if i in self.padded and isinstance(getattr(metric, 'inter', None), dict):
+                for c, (inter, union) in enumerate(self.padded[i].tolist()):
+                    metric.inter[c] -= inter
+                    metric.union[c] -= union
+
+    def after_fit(self):
+        # The model may have been replaced by another callback (e.g. the eager model of CPUAcceleration)
+        if isinstance(self.learn.model, DistributedDataParallel):
+            self.learn.model = self.learn.model.module
+        self.learn.dls.loaders = self.old_dls
+
+
+def distributed_callback():
+    """
+    Create the CPUDistributedTrainer if the process is part of a distributed run of several processes.
+
+    Returns:
+    - CPUDistributedTrainer or None: The callback, or None outside of a distributed run.
+    """
+    if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size() < 2:
+        return None
+    return CPUDistributedTrainer()
+
+
+def rank0_first(func, *args, **kwargs):
+    """
+    Run a function in the process of rank 0 first and then in the other processes, e.g. to build the dataset
+    caches once before the other ranks read them.
+    """
+    distributed = dist.is_available() and dist.is_initialized()
+    if distributed and rank_distrib():
+        dist.barrier()
+    result = func(*args, **kwargs)
+    if distributed and not rank_distrib():
+        dist.barrier()
+    return result
+
+
+def _train_process(config_path, model_type, local_rank, local_size, threads):
+    from src.data.dataset import fork_loader_workers
+    from src.models.acceleration import available_cores, set_cpu_budget
+    from src.models.train import train_model
+
+    # Each process of the machine gets its own cores and threads
+    fork_loader_workers()
+    cores = available_cores()
+    set_cpu_budget(cores[local_rank::local_size] if len(cores) >= local_size else None, threads)
+
+    dist.init_process_group(backend='gloo', init_method='env://')
+    try:
+        train_model(config_path, model_type)
+    finally:
+        dist.destroy_process_group()
+
+
+def _spawned_process(local_rank, config_path, model_type, nproc_per_node, node_rank, threads):
+    os.environ['LOCAL_RANK'] = str(local_rank)
+    os.environ['RANK'] = str(node_rank * nproc_per_node + local_rank)
+    _train_process(config_path, model_type, local_rank, nproc_per_node, threads)
+
+
+def launch(config_path, model_type, nproc_per_node=None, nnodes=None, node_rank=None, master_addr=None,
+           master_port=None, threads=None):
+    """
+    Train a model with distributed data parallelism on the CPU: nproc_per_node processes on each of nnodes
+    machines. Run the same command on every machine, with its node_rank (0 on the machine of master_addr).
+
+    Settings that are not given are read from the 'distributed' section of the configuration:
+
+        distributed:
+          nproc_per_node: 4
+          nnodes: 1
+          master_addr: 127.0.0.1
+          master_port: 29500
+          threads: null  # PyTorch threads per process (defaults to the cores divided among the processes)
+
+    When the environment already describes the process (RANK and WORLD_SIZE, e.g. under torchrun), this
+    process is trained as that rank instead of launching new ones.
+
+    Parameters:
+    - config_path (str): Path to the configuration file.
+    - model_type (str): Type of the model to train ('pspnet', 'deeplabv3_plus', 'unet').
+    - nproc_per_node (int, optional): Processes per machine.
+    - nnodes (int, optional): Number of machines.
+    - node_rank (int, optional): Rank of this machine. Default is 0.
+    - master_addr (str, optional): Address of the machine of node 0.
+    - master_port (int, optional): Free port on the machine of node 0.
+    - threads (int, optional): PyTorch threads per process.
+    """
+    from src.models.acceleration import available_cores
+    from src.models.model_loader import load_config
+
+    settings = load_config(config_path).get('distributed') or {}
+    threads = threads or settings.get('threads')
+    if num_distrib() > 0:
+        # Launched by torchrun (or another launcher that sets the environment)
+        _train_process(config_path, model_type, int(os.environ.get('LOCAL_RANK', 0)),
+                       int(os.environ.get('LOCAL_WORLD_SIZE', 1)), threads)
+        return
+
+    nproc_per_node = nproc_per_node or settings.get('nproc_per_node') or 1
+    nnodes = nnodes or settings.get('nnodes') or 1
+    os.environ['MASTER_ADDR'] = master_addr or str(settings.get('master_addr', '127.0.0.1'))
+    os.environ['MASTER_PORT'] = str(master_port or settings.get('master_port', 29500))
+    os.environ['WORLD_SIZE'] = str(nproc_per_node * nnodes)
+    threads = threads or max(1, len(available_cores()) // nproc_per_node)
+    print(f"Launching {nproc_per_node} processes on node {node_rank or 0} of {nnodes} "
+          f"({threads} threads each, master {os.environ['MASTER_ADDR']}:{os.environ['MASTER_PORT']})")
+    torch.multiprocessing.start_processes(_spawned_process, nprocs=nproc_per_node, start_method='spawn',
+                                          args=(config_path, model_type, nproc_per_node, node_rank or 0, threads))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distributed data-parallel training on the CPU (gloo).")
+    parser.add_argument('model_type', nargs='?', default='pspnet')
+    parser.add_argument('--config', default='config.yml')
+    parser.add_argument('--nproc-per-node', type=int, default=None)
+    parser.add_argument('--nnodes', type=int, default=None)
+    parser.add_argument('--node-rank', type=int, default=None)
+    parser.add_argument('--master-addr', default=None)
+    parser.add_argument('--master-port', type=int, default=None)
+    parser.add_argument('--threads', type=int, default=None, help="PyTorch threads per process.")
+    args = parser.parse_args()
+
+    launch(args.config, args.model_type, args.nproc_per_node, args.nnodes, args.node_rank, args.master_addr,
+           args.master_port, args.threads)
@@ -0,0 +1,323 @@
+import argparse
+import os
+import time
+import numpy as np
+from PIL import Image
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.webp')
+
+
+def load_calibration_tiles(folder, n_tiles=64, tile_size=256, seed=0):
+    """
+    Load a random sample of tiles from a folder of images, for quantization calibration and benchmarking.
+
+    Each selected image is center-cropped to a square and resized to the tile size.
+
+    Parameters:
+    - folder (str): Folder with the images (searched recursively).
+    - n_tiles (int, optional): Maximum number of tiles to load. Default is 64.
+    - tile_size (int, optional): Size of the square tiles. Default is 256.
+    - seed (int, optional): Seed of the random sample. Default is 0.
+
+    Returns:
+    - numpy.ndarray: A uint8 array (N x tile_size x tile_size x 3).
+
+    Raises:
+    - FileNotFoundError: If the folder doesn't exist.
+    - ValueError: If the folder has no images.
+    """
+    if not os.path.isdir(folder):
+        raise FileNotFoundError(f"Calibration folder not found: {folder}")
+    files = sorted(os.path.join(root, f) for root, _, names in os.walk(folder)
+                   for f in names if f.lower().endswith(IMAGE_EXTENSIONS))
+    rng = np.random.default_rng(seed)
+    files = rng.permutation(files)[:n_tiles]
+    if len(files) == 0:
+        raise ValueError(f"No images ({', '.join(IMAGE_EXTENSIONS)}) found in the calibration folder {folder}")
+
+    tiles = []
+    for path in files:
+        with Image.open(path) as img:
+            img = img.convert('RGB')
+            side = min(img.size)
+            left, upper = (img.width - side) // 2, (img.height - side) // 2
+            img = img.crop((left, upper, left + side, upper + side)).resize((tile_size, tile_size), Image.BILINEAR)
+            tiles.append(np.asarray(img))
+    return np.stack(tiles)
+
+
+def _normalized_model(model):
+    """
+    Wrap a model so that it takes float32 NCHW batches in [0, 1] and normalizes them with the ImageNet
+    statistics itself, as the training pipeline does. The exported graphs then don't depend on fastai.
+    """
+    import torch
+    from segmentation_models_pytorch.base import SegmentationModel
+    from torch import nn
+
+    class NormalizedModel(nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+            self.register_buffer('mean', torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1))
+            self.register_buffer('std', torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1))
+
+        def forward(self, x):
+            x = (x - self.mean) / self.std
+            if isinstance(self.model, SegmentationModel):
+                # Skip the input shape check of SegmentationModel.forward, which FX tracing can't follow
+                return self.model.segmentation_head(self.model.decoder(self.model.encoder(x)))
+            return self.model(x)
+
+    return NormalizedModel(model).eval()
+
+
+def _to_input(batch):
+    """
+    Convert a uint8 batch of tiles (N x H x W x 3) to the float32 NCHW input of the exported graphs.
+    """
+    return np.ascontiguousarray(batch.transpose(0, 3, 1, 2), dtype=np.float32) / 255.0
+
+
+def onnx_tile_multiple(model):
+    """
+    Return the multiple of the tile size that a model needs to be exported to ONNX.
+
+    The pyramid pooling of PSPNet averages the encoder features into 1, 2, 3 and 6 bins, and the ONNX exporter
+    only supports adaptive pooling when those bins divide the feature map: with the default encoder depth of 3
+    (features at 1/8 of the tile), the tile size must be a multiple of 48 (e.g. 192 or 384, but not 256). The
+    other models can be exported with any tile size (1 is returned).
+    """
+    import math
+    from segmentation_models_pytorch import PSPNet
+    from torch import nn
+
+    if not isinstance(model, PSPNet):
+        return 1
+    bins = [module.output_size for module in model.decoder.modules() if isinstance(module, nn.AdaptiveAvgPool2d)]
+    bins = [size if isinstance(size, int) else size[0] for size in bins]
+    return 2 ** model.encoder._depth * math.lcm(*bins)
+
+
+def export_model(model, output_path, export_format='torchscript', quantize=None, calibration_tiles=None,
+                 tile_size=256):
+    """
+    Export a segmentation model to a graph that runs on CPU without fastai, optionally quantized to int8.
+
+    The exported graph takes float32 NCHW batches with values in [0, 1] and returns the logits; the ImageNet
+    normalization is part of the graph. Use ExportedModel to run it.
+
+    Quantization options:
+    - 'dynamic': int8 weights, activations quantized on the fly. With ONNX this covers the convolutions;
+                 with TorchScript PyTorch only quantizes Linear layers, so it has little effect on these models.
+    - 'static': int8 weights and activations, with activation ranges calibrated on calibration_tiles.
+                With TorchScript this uses FX graph mode quantization; with ONNX, onnxruntime's QDQ format.
+
+    Parameters:
+    - model (nn.Module): The model to export (e.g. learner.model).
+    - output_path (str): Path of the exported file ('.pt' for TorchScript, '.onnx' for ONNX).
+    - export_format (str, optional): 'torchscript' or 'onnx'. Default is 'torchscript'.
+    - quantize (str, optional): None, 'dynamic' or 'static'. Default is None.
+    - calibration_tiles (numpy.ndarray, optional): uint8 tiles (N x H x W x 3) used for static quantization.
+    - tile_size (int, optional): Size of the example input used to trace the model. Default is 256. The ONNX
+                                 graph only accepts this size; a PSPNet needs a multiple of 48 (see
+                                 onnx_tile_multiple), or can be exported to TorchScript with any size.
+
+    Returns:
+    - str: The path of the exported file.
+
+    Raises:
+    - ValueError: If the format or the quantization mode is unknown, if static quantization is requested
+                  without calibration tiles, or if the tile size can't be exported to ONNX for the model.
+    """
+    import torch
+
+    if export_format not in ('torchscript', 'onnx'):
+        raise ValueError(f"Unknown export format: {export_format}")
+    if quantize not in (None, 'dynamic', 'static'):
+        raise ValueError(f"Unknown quantization mode: {quantize}")
+    if quantize == 'static' and calibration_tiles is None:
+        raise ValueError("Static quantization requires calibration tiles.")
+    if export_format == 'onnx' and tile_size % onnx_tile_multiple(model):
+        multiple = onnx_tile_multiple(model)
+        raise ValueError(f"{type(model).__name__} can only be exported to ONNX with a tile size multiple of "
+                         f"{multiple} (e.g. {multiple * -(-tile_size // multiple)}), not {tile_size}; "
+                         f"export it to TorchScript (.pt) to keep this size")
+
+    wrapped = _normalized_model(model.cpu().float())
+    example = torch.rand(1, 3, tile_size, tile_size)
+
+    if export_format == 'torchscript':
+        if quantize == 'dynamic':
+            wrapped = torch.ao.quantization.quantize_dynamic(wrapped, {torch.nn.Linear}, dtype=torch.qint8)
+        elif quantize == 'static':
+            from torch.ao.quantization import get_default_qconfig_mapping
+            from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+            torch.backends.quantized.engine = 'x86'
+            prepared = prepare_fx(wrapped, get_default_qconfig_mapping('x86'), example_inputs=(example,))
+            with torch.inference_mode():
+                for i in range(0, len(calibration_tiles), 8):
+                    prepared(torch.from_numpy(_to_input(calibration_tiles[i:i + 8])))
+            wrapped = convert_fx(prepared)
+
+        with torch.inference_mode():
+            traced = torch.jit.trace(wrapped, example)
+        torch.jit.save(traced, output_path)
+    else:
+        fp32_path = output_path if quantize is None else f"{os.path.splitext(output_path)[0]}.fp32.onnx"
+        torch.onnx.export(wrapped, (example,), fp32_path, input_names=['input'], output_names=['logits'],
+                          dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}}, opset_version=17,
+                          dynamo=False)
+        if quantize is not None:
+            _quantize_onnx(fp32_path, output_path, quantize, calibration_tiles)
+            os.remove(fp32_path)
+
+    print(f"Model exported to {output_path} ({export_format}, quantization: {quantize or 'none'})")
+    return output_path
+
+
+def _quantize_onnx(input_path, output_path, quantize, calibration_tiles=None):
+    """
+    Quantize an ONNX graph to int8 with onnxruntime.
+    """
+    from onnxruntime.quantization import (CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic,
+                                          quantize_static)
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    # Fold constants and infer shapes first, as recommended by onnxruntime
+    preprocessed_path = f"{os.path.splitext(input_path)[0]}.pre.onnx"
+    quant_pre_process(input_path, preprocessed_path, skip_symbolic_shape=True)
+
+    if quantize == 'dynamic':
+        quantize_dynamic(preprocessed_path, output_path, weight_type=QuantType.QInt8)
+    else:
+        class TileReader(CalibrationDataReader):
+            def __init__(self, tiles):
+                self.batches = iter([{'input': _to_input(tiles[i:i + 1])} for i in range(len(tiles))])
+
+            def get_next(self):
+                return next(self.batches, None)
+
+        quantize_static(preprocessed_path, output_path, TileReader(calibration_tiles), quant_format=QuantFormat.QDQ,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8, per_channel=True)
+    os.remove(preprocessed_path)
+
+
+class ExportedModel:
+    """
+    Run a model exported with export_model, without fastai.
+
+    The format is selected from the file extension: '.onnx' files run with onnxruntime and any other file
+    is loaded as TorchScript.
+
+    Parameters:
+    - model_path (str): Path to the exported model.
+    - num_threads (int, optional): Number of CPU threads used for inference. Defaults to the runtime's default.
+
+    Calling the object with a uint8 batch of tiles (N x H x W x 3) returns their logits as a float32 array
+    (N x classes x H x W), the same contract as src.models.inference.learner_predictor.
+    """
+    def __init__(self, model_path, num_threads=None):
+        self.model_path = model_path
+        if model_path.endswith('.onnx'):
+            import onnxruntime as ort
+
+            options = ort.SessionOptions()
+            if num_threads:
+                options.intra_op_num_threads = num_threads
+            self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+            self.module = None
+        else:
+            import torch
+
+            if num_threads:
+                torch.set_num_threads(num_threads)
+            if 'x86' in torch.backends.quantized.supported_engines:
+                torch.backends.quantized.engine = 'x86'
+            self.module = torch.jit.load(model_path, map_location='cpu').eval()
+            self.session = None
+
+    def __call__(self, batch):
+        x = _to_input(batch)
+        if self.session is not None:
+            return self.session.run(None, {'input': x})[0]
+
+        import torch
+        with torch.inference_mode():
+            return self.module(torch.from_numpy(x)).float().numpy()
+
+
+def accuracy_latency_report(predictors, tiles, num_classes, reference='fp32', targets=None, batch_size=8):
+    """
+    Compare the accuracy and throughput of several predictors on the same tiles.
+
+    Accuracy is measured with the multi-class Dice and Jaccard coefficients against the ground-truth masks
+    when they are given, or else against the predictions of the reference predictor. The deltas are taken
+    with respect to the reference predictor.
+
+    Parameters:
+    - predictors (dict): Mapping from a name to a predictor (uint8 N x H x W x 3 batch -> logits).
+    - tiles (numpy.ndarray): uint8 tiles (N x H x W x 3).
+    - num_classes (int): Number of classes.
+    - reference (str, optional): Name of the reference predictor. Default is 'fp32'.
+    - targets (numpy.ndarray, optional): Ground-truth class masks of the tiles (N x H x W).
+    - batch_size (int, optional): Number of tiles per call. Default is 8.
+
+    Returns:
+    - pandas.DataFrame: One row per predictor with its dice, jaccard, dice_delta, jaccard_delta,
+      tiles_per_sec and ms_per_tile.
+    """
+    import pandas as pd
+    from src.utils.confusion import confusion_matrix, dice_jaccard
+
+    predictions, timings = {}, {}
+    for name, predict in predictors.items():
+        predict(tiles[:1])  # Warm-up
+        start = time.perf_counter()
+        predictions[name] = np.concatenate([predict(tiles[i:i + batch_size]).argmax(axis=1)
+                                            for i in range(0, len(tiles), batch_size)])
+        timings[name] = time.perf_counter() - start
+
+    targets = predictions[reference] if targets is None else targets
+    rows = []
+    for name in predictors:
+        dice, jaccard = dice_jaccard(confusion_matrix(predictions[name], targets, num_classes))
+        rows.append({'model': name, 'dice': dice, 'jaccard': jaccard,
+                     'tiles_per_sec': len(tiles) / timings[name], 'ms_per_tile': 1000 * timings[name] / len(tiles)})
+
+    report = pd.DataFrame(rows).set_index('model')
+    report['dice_delta'] = report['dice'] - report.loc[reference, 'dice']
+    report['jaccard_delta'] = report['jaccard'] - report.loc[reference, 'jaccard']
+    return report[['dice', 'dice_delta', 'jaccard', 'jaccard_delta', 'tiles_per_sec', 'ms_per_tile']]
+
+
+if __name__ == "__main__":
+    from fastai.learner import load_learner
+    from src.models.inference import learner_predictor
+
+    parser = argparse.ArgumentParser(description="Export a trained learner for CPU inference.")
+    parser.add_argument('model_path', help="Exported learner (.pkl).")
+    parser.add_argument('output', help="Output file ('.pt' for TorchScript, '.onnx' for ONNX).")
+    parser.add_argument('--quantize', choices=['dynamic', 'static'], default=None)
+    parser.add_argument('--calibration', default='data/processed/val/src', help="Folder with calibration images.")
+    parser.add_argument('--tiles', type=int, default=64, help="Number of calibration/benchmark tiles.")
+    parser.add_argument('--tile-size', type=int, default=256,
+                        help="Tile size of the exported graph. ONNX exports of PSPNet need a multiple of 48 "
+                             "(e.g. 384); TorchScript accepts any size.")
+    parser.add_argument('--classes', type=int, default=3)
+    parser.add_argument('--report', action='store_true', help="Compare accuracy and latency with the fp32 learner.")
+    args = parser.parse_args()
+
+    export_format = 'onnx' if args.output.endswith('.onnx') else 'torchscript'
+    # Tiles are only needed to calibrate static quantization and for the report
+    tiles = None
+    if args.quantize == 'static' or args.report:
+        tiles = load_calibration_tiles(args.calibration, args.tiles, args.tile_size)
+    model = load_learner(args.model_path, cpu=True).model.eval()
+    export_model(model, args.output, export_format, args.quantize, tiles, args.tile_size)
+
+    if args.report:
+        report = accuracy_latency_report({'fp32': learner_predictor(args.model_path), 'exported': ExportedModel(args.output)},
+                                         tiles, args.classes)
+        print(report.to_string(float_format=lambda v: f"{v:.4f}"))
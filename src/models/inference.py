@@ -0,0 +1,180 @@
+import argparse
+import time
+import numpy as np
+from src.data.split_image import WindowReader, tile_offsets
+
+IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+IMAGENET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+
+def blend_weights(tile_height, tile_width):
+    """
+    Build the weight window used to blend the logits of overlapping tiles.
+
+    The weight decreases linearly from the center of the tile to its borders, where predictions are less
+    reliable, so overlapping tiles fade into each other instead of producing visible seams.
+
+    Parameters:
+    - tile_height (int): Height of the tiles.
+    - tile_width (int): Width of the tiles.
+
+    Returns:
+    - numpy.ndarray: A float32 array (tile_height x tile_width) of positive weights.
+    """
+    ramp_y = np.minimum(np.arange(1, tile_height + 1), np.arange(tile_height, 0, -1)).astype(np.float32)
+    ramp_x = np.minimum(np.arange(1, tile_width + 1), np.arange(tile_width, 0, -1)).astype(np.float32)
+    return np.outer(ramp_y / ramp_y.max(), ramp_x / ramp_x.max())
+
+
+def learner_predictor(model_path, normalize=True, num_threads=None):
+    """
+    Create a prediction function from an exported fastai learner.
+
+    Parameters:
+    - model_path (str): Path to the exported learner (usually a .pkl file).
+    - normalize (bool, optional): Whether to normalize the inputs with the ImageNet statistics, as done by the
+                                  training pipeline. Default is True.
+    - num_threads (int, optional): Number of CPU threads used by torch. Defaults to torch's own setting.
+
+    Returns:
+    - callable: A function that takes a uint8 batch of tiles (N x H x W x 3) and returns their logits
+                as a float32 array (N x classes x H x W).
+    """
+    import torch
+    from src.models.registry import load_artifact
+
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    # Loaded once per process: later predictors of the same file reuse the learner (see src.models.registry)
+    model = load_artifact(model_path, 'learner').model.eval()
+
+    def predict(batch):
+        x = batch.astype(np.float32) / 255.0
+        if normalize:
+            x = (x - IMAGENET_MEAN) / IMAGENET_STD
+        with torch.inference_mode():
+            logits = model(torch.from_numpy(np.ascontiguousarray(x.transpose(0, 3, 1, 2))))
+        return logits.float().numpy()
+
+    return predict
+
+
+def _pad_tile(tile, tile_height, tile_width):
+    """
+    Pad a border tile to the full tile size by reflecting its content.
+    """
+    pad_h, pad_w = tile_height - tile.shape[0], tile_width - tile.shape[1]
+    if pad_h == 0 and pad_w == 0:
+        return tile
+    return np.pad(tile, ((0, pad_h), (0, pad_w), (0, 0)), mode='reflect' if min(tile.shape[:2]) > 1 else 'edge')
+
+
+def infer_raster(predict, file_path, output_path, num_classes, tile_size=256, overlap=64, batch_size=8,
+                 colormap=None):
+    """
+    Segment a large raster with a sliding window and write the full-resolution class mask to disk.
+
+    The raster is read one row of tiles at a time. Tiles are batched through the model and their logits are
+    accumulated with blend_weights, so overlapping tiles are smoothly averaged. As soon as no later tile
+    can overlap a band of rows, the band is reduced to class indices and written to the output GeoTIFF,
+    which keeps the georeferencing of the source. Memory use is bounded by one row of tiles
+    (classes x tile_size x raster width), however tall the raster is.
+
+    Parameters:
+    - predict (callable): Function mapping a uint8 batch (N x H x W x 3) to logits (N x classes x H x W),
+                          e.g. the one returned by learner_predictor.
+    - file_path (str): Path to the source raster.
+    - output_path (str): Path of the output class mask (GeoTIFF, uint8).
+    - num_classes (int): Number of classes predicted by the model.
+    - tile_size (int, optional): Size of the square tiles fed to the model. Default is 256.
+    - overlap (int, optional): Overlap in pixels between neighbouring tiles. Default is 64.
+    - batch_size (int, optional): Number of tiles per model call. Default is 8.
+    - colormap (dict, optional): Mapping from class ID to RGB color written as the output colormap.
+
+    Returns:
+    - int: The number of tiles processed.
+
+    Raises:
+    - ValueError: If the overlap is not smaller than the tile size.
+    """
+    import rasterio
+    from rasterio.windows import Window
+
+    if not 0 <= overlap < tile_size:
+        raise ValueError(f"The overlap must be between 0 and the tile size ({tile_size}), got {overlap}.")
+    stride = tile_size - overlap
+    weights = blend_weights(tile_size, tile_size)
+    start = time.perf_counter()
+    n_tiles = 0
+
+    with WindowReader(file_path) as src:
+        width, height = src.width, src.height
+        profile = {'driver': 'GTiff', 'width': width, 'height': height, 'count': 1, 'dtype': 'uint8',
+                   'crs': src.dataset.crs, 'transform': src.dataset.transform, 'compress': 'deflate'}
+
+        xs = tile_offsets(width, tile_size, stride)
+        ys = tile_offsets(height, tile_size, stride)
+
+        # Accumulators for the rows [y, y + tile_size) of the current row of tiles
+        # (the weights are positive, so normalizing by their sum would not change the argmax)
+        acc = np.zeros((num_classes, tile_size, width), dtype=np.float32)
+
+        with rasterio.open(output_path, 'w', **profile) as dst:
+            if colormap:
+                dst.write_colormap(1, colormap)
+
+            for row, y in enumerate(ys):
+                boxes = [(x, y, min(x + tile_size, width), min(y + tile_size, height)) for x in xs]
+
+                for i in range(0, len(boxes), batch_size):
+                    batch_boxes = boxes[i:i + batch_size]
+                    tiles = [src.read(box) for box in batch_boxes]
+                    if tiles[0].ndim == 2:
+                        tiles = [np.repeat(tile[..., None], 3, axis=-1) for tile in tiles]
+                    logits = predict(np.stack([_pad_tile(tile, tile_size, tile_size) for tile in tiles]))
+
+                    # Blend the logits of each tile into the accumulators
+                    for (left, upper, right, lower), tile_logits in zip(batch_boxes, logits):
+                        h, w = lower - upper, right - left
+                        acc[:, :h, left:right] += tile_logits[:, :h, :w] * weights[:h, :w]
+                    n_tiles += len(batch_boxes)
+
+                # Rows before the next row of tiles are final: write them and shift the accumulators
+                done = (ys[row + 1] - y) if row + 1 < len(ys) else min(tile_size, height - y)
+                mask = acc[:, :done].argmax(axis=0).astype(np.uint8)
+                dst.write(mask[None], window=Window(0, y, width, done))
+
+                acc[:, :tile_size - done] = acc[:, done:]
+                acc[:, tile_size - done:] = 0
+
+    elapsed = time.perf_counter() - start
+    print(f"{n_tiles} tiles processed in {elapsed:.2f}s ({n_tiles / max(elapsed, 1e-9):.1f} tiles/sec). "
+          f"Mask saved at {output_path}")
+    return n_tiles
+
+
+if __name__ == "__main__":
+    from src.models.model_loader import load_config
+    from src.utils.mask_codec import load_mask_codec
+
+    parser = argparse.ArgumentParser(description="Segment a full orthophoto with a sliding window.")
+    parser.add_argument('model_path', help="Exported learner (.pkl) or model exported with src.models.export (.pt/.onnx).")
+    parser.add_argument('input', help="Source raster (e.g. a GeoTIFF orthophoto).")
+    parser.add_argument('output', help="Output class mask (GeoTIFF).")
+    parser.add_argument('--config', default='config.yml')
+    parser.add_argument('--tile-size', type=int, default=256)
+    parser.add_argument('--overlap', type=int, default=64)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    palette = load_mask_codec(args.config).palette
+    if args.model_path.endswith('.pkl'):
+        predict = learner_predictor(args.model_path, num_threads=args.threads)
+    else:
+        from src.models.export import ExportedModel
+        predict = ExportedModel(args.model_path, num_threads=args.threads)
+    infer_raster(predict, args.input, args.output,
+                 num_classes=config['model']['classes'], tile_size=args.tile_size, overlap=args.overlap,
+                 batch_size=args.batch_size, colormap={c: tuple(int(v) for v in color) for c, color in enumerate(palette)})
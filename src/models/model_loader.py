@@ -1,7 +1,4 @@
 import yaml
-import segmentation_models_pytorch as smp
-from fastai.vision.learner import unet_learner
-from fastai.vision.models import resnet101
 
 
 def load_config(config_path):
@@ -41,6 +38,11 @@ def create_model(config, dls=None):
     Raises:
     - ValueError: If the model type is unknown or if data loaders are not provided for U-Net.
     """
+    # Imported here so that load_config doesn't pull in PyTorch
+    import segmentation_models_pytorch as smp
+    from fastai.vision.learner import unet_learner
+    from fastai.vision.models import resnet101
+
     model_type = config['model']['type']
     backbone = config['model']['backbone']
     pretrained = config['model']['pretrained']
@@ -0,0 +1,447 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+
+# Artifact format of each file extension
+FORMATS = {'.pkl': 'learner', '.pt': 'torchscript', '.onnx': 'onnx', '.pth': 'weights'}
+
+
+def artifact_format(path):
+    """
+    Return the format of a model artifact from its extension: 'learner' (exported fastai learner, .pkl),
+    'torchscript' (.pt), 'onnx' (.onnx) or 'weights' (state dict or checkpoint of src.models.checkpoint, .pth).
+
+    Raises:
+    - ValueError: If the extension is unknown.
+    """
+    suffix = Path(path).suffix.lower()
+    if suffix not in FORMATS:
+        raise ValueError(f"Unknown model artifact '{path}'. Supported extensions: {', '.join(FORMATS)}")
+    return FORMATS[suffix]
+
+
+def _local_path(path):
+    if '://' in str(path):
+        raise ValueError(f"Only local model artifacts can be loaded, not '{path}'")
+    path = Path(path).resolve()
+    if not path.is_file():
+        raise FileNotFoundError(f"Model artifact not found: {path}")
+    return path
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(2 ** 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _module_bytes(module):
+    tensors = [*module.parameters(), *module.buffers()]
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+def model_size_mb(model, path=None):
+    """
+    Estimate the memory held by a loaded model, in MiB: the parameters and buffers of its PyTorch module, or
+    the size of the artifact file for an ONNX Runtime session.
+    """
+    for module in (getattr(model, 'model', None), getattr(model, 'module', None), model):
+        if module is not None and hasattr(module, 'parameters'):
+            return _module_bytes(module) / 2 ** 20
+    return os.path.getsize(path) / 2 ** 20 if path is not None else 0.0
+
+
+class ModelCache:
+    """
+    An in-memory LRU cache of ready-to-run models, keyed by artifact file.
+
+    The key includes the modification time and size of the file, so an artifact overwritten on disk is loaded
+    again. When the models held exceed the memory cap, the least recently used ones are dropped; a model larger
+    than the cap is returned without being cached. Threads that miss the same key at the same time wait for a
+    single load.
+
+    Parameters:
+    - max_mb (float, optional): Memory cap of the cached models, in MiB (see model_size_mb). Default is 2048.
+    """
+    def __init__(self, max_mb=2048):
+        self.max_mb = max_mb
+        self.hits = self.misses = 0
+        self._models = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    @property
+    def size_mb(self):
+        """
+        Memory held by the cached models, in MiB.
+        """
+        return sum(size for _, size in self._models.values())
+
+    def __len__(self):
+        return len(self._models)
+
+    def get(self, key, load_fn, path=None):
+        """
+        Return the cached model of a key, loading it with load_fn on a miss.
+
+        Parameters:
+        - key (hashable): Key of the model.
+        - load_fn (callable): Function without arguments that loads the model.
+        - path (str, optional): Artifact file, used to estimate the size of models without PyTorch module.
+
+        Returns:
+        - The model.
+        """
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                self.hits += 1
+                return self._models[key][0]
+            loading = self._loading.get(key)
+            waiting = loading is not None
+            if waiting:
+                self.hits += 1
+            else:
+                self.misses += 1
+                loading = self._loading[key] = Future()
+
+        if waiting:
+            return loading.result()  # Being loaded by another thread
+
+        try:
+            model = load_fn()
+            size = model_size_mb(model, path)
+            with self._lock:
+                if size <= self.max_mb:
+                    self._models[key] = (model, size)
+                    self._evict()
+            loading.set_result(model)
+        except BaseException as e:
+            loading.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+        return model
+
+    def set_limit(self, max_mb):
+        """
+        Change the memory cap, dropping the least recently used models if needed.
+        """
+        with self._lock:
+            self.max_mb = max_mb
+            self._evict()
+
+    def clear(self):
+        """
+        Drop all the cached models.
+        """
+        with self._lock:
+            self._models.clear()
+
+    def _evict(self):
+        while self._models and self.size_mb > self.max_mb:
+            self._models.popitem(last=False)
+
+
+_MODEL_CACHE = ModelCache()
+
+
+def model_cache(max_mb=None):
+    """
+    Return the model cache of the process, shared by all the models loaded with load_artifact.
+
+    Parameters:
+    - max_mb (float, optional): New memory cap of the cache, in MiB. Default is None (unchanged).
+
+    Returns:
+    - ModelCache: The cache.
+    """
+    if max_mb is not None:
+        _MODEL_CACHE.set_limit(max_mb)
+    return _MODEL_CACHE
+
+
+def _read_only(model):
+    # The cached modules are shared by every caller, for inference and evaluation only: put them in eval mode
+    # and freeze their parameters, so that an optimizer step can't change them for the others
+    module = getattr(model, 'model', model)
+    if hasattr(module, 'requires_grad_'):
+        module.eval().requires_grad_(False)
+    return model
+
+
+def _learner_view(learner):
+    # A new Learner around the shared model, so that callers can set its DataLoaders and callbacks
+    from fastai.learner import Learner
+    return Learner(learner.dls, learner.model, loss_func=learner.loss_func)
+
+
+def _load_weights(path, model_config):
+    import torch
+    from src.models.model_loader import create_model
+
+    if not model_config or 'type' not in model_config:
+        raise ValueError(f"Weights '{path}' need the model settings (type, backbone, classes) to build the model: "
+                         f"register them with their model type")
+    if model_config['type'] == 'unet':
+        raise ValueError("The fastai U-Net is built from the DataLoaders: register its exported learner (.pkl)")
+    # The encoder is built without pretrained weights (nothing is downloaded): they are all in the state dict
+    model = create_model({'model': {**model_config, 'pretrained': None}})
+    state = torch.load(path, map_location='cpu', weights_only=False)
+    if isinstance(state, dict) and 'model' in state and 'n_epoch' in state:
+        state = state['model']  # An epoch checkpoint of src.models.checkpoint
+    model.load_state_dict(state)
+    return model.eval()
+
+
+def _load(path, fmt, model_config=None, num_threads=None):
+    if fmt == 'learner':
+        from fastai.learner import load_learner
+
+        return load_learner(path, cpu=True)
+    if fmt in ('torchscript', 'onnx'):
+        from src.models.export import ExportedModel
+        return ExportedModel(str(path), num_threads=num_threads)
+    if fmt == 'weights':
+        return _load_weights(path, model_config)
+    raise ValueError(f"Unknown model format: {fmt}")
+
+
+def load_artifact(path, fmt=None, model_config=None, num_threads=None, cache=True):
+    """
+    Load a ready-to-run model from a local artifact, reusing the copy of the process cache if it was already
+    loaded (see model_cache).
+
+    Parameters:
+    - path (str or Pathlib.Path): Path to the artifact. URLs are rejected: weights are never downloaded.
+    - fmt (str, optional): Format of the artifact. Defaults to the format of its extension (see artifact_format).
+    - model_config (dict, optional): The 'model' settings (type, backbone, classes), required by 'weights'.
+    - num_threads (int, optional): Threads of the ONNX Runtime session ('onnx'), set when it is first loaded.
+    - cache (bool, optional): Whether to use the process cache. Default is True. Without the cache, the model
+                              is a private copy of the caller, which can be trained.
+
+    Returns:
+    - The model: a new fastai Learner around the model ('learner'), an ExportedModel ('torchscript', 'onnx') or
+      a PyTorch module ('weights'), in eval mode. The PyTorch modules of the cache are shared by all the
+      callers, for inference and evaluation only: their parameters don't require gradients, and they must not
+      be put back in training mode (load them with cache=False to fine-tune them).
+    """
+    path = _local_path(path)
+    fmt = fmt or artifact_format(path)
+    if cache:
+        stat = path.stat()
+        key = (str(path), stat.st_mtime_ns, stat.st_size, fmt, json.dumps(model_config, sort_keys=True))
+        model = _MODEL_CACHE.get(key, lambda: _read_only(_load(path, fmt, model_config, num_threads)), path)
+    else:
+        model = _load(path, fmt, model_config, num_threads)
+    return _learner_view(model) if fmt == 'learner' else model
+
+
+class ModelRegistry:
+    """
+    A registry of trained models, mapping a name and a version to an artifact on the local disk.
+
+    The artifacts are copied to '<root>/<name>/<version>/' and described in '<root>/registry.json' with their
+    format, SHA-256, size, registration time and model settings. Versions are numbered 1, 2, ... unless given.
+
+    Parameters:
+    - root (str or Pathlib.Path): Folder of the registry.
+    """
+    def __init__(self, root):
+        self.root = Path(root)
+        self.index_path = self.root / 'registry.json'
+
+    def _read(self):
+        if not self.index_path.exists():
+            return {}
+        with open(self.index_path, 'r') as file:
+            return json.load(file)
+
+    def _write(self, index):
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_name(f"{self.index_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'w') as file:
+            json.dump(index, file, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    def register(self, name, path, version=None, fmt=None, model_config=None, copy=True):
+        """
+        Add an artifact to the registry.
+
+        Parameters:
+        - name (str): Name of the model (e.g. 'deeplabv3_plus').
+        - path (str): Path to the artifact (.pkl, .pt, .onnx or .pth).
+        - version (str, optional): Version of the model. Defaults to the next integer.
+        - fmt (str, optional): Format of the artifact. Defaults to the format of its extension.
+        - model_config (dict, optional): The 'model' settings (type, backbone, classes). Required for 'weights'.
+        - copy (bool, optional): Copy the artifact into the registry; otherwise its path is recorded. Default is True.
+
+        Returns:
+        - str: The version registered.
+
+        Raises:
+        - ValueError: If the version is already registered or the name contains ':' or '/'.
+        """
+        if not name or any(c in name for c in ':/\\'):
+            raise ValueError(f"Invalid model name: '{name}'")
+        source = _local_path(path)
+        fmt = fmt or artifact_format(source)
+        if fmt == 'weights' and not model_config:
+            raise ValueError("Weights need the model settings (type, backbone, classes) to be loaded")
+
+        index = self._read()
+        versions = index.setdefault(name, {})
+        version = str(version) if version is not None else str(
+            max((int(v) for v in versions if v.isdigit()), default=0) + 1)
+        if version in versions:
+            raise ValueError(f"Model '{name}' already has a version {version}")
+
+        if copy:
+            target = self.root / name / version / source.name
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(source, target)
+            stored = target.relative_to(self.root).as_posix()
+        else:
+            stored = str(source)
+        versions[version] = {'path': stored, 'format': fmt, 'sha256': _sha256(source),
+                             'size': source.stat().st_size, 'registered': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                             'model': model_config}
+        self._write(index)
+        return version
+
+    def versions(self, name=None):
+        """
+        Return the registered versions of a model, or of every model by name if no name is given.
+        """
+        index = self._read()
+        return {name: list(versions) for name, versions in index.items()} if name is None else list(index.get(name, {}))
+
+    def resolve(self, name, version=None):
+        """
+        Return the registry entry of a model version, with the absolute 'path' of its artifact.
+
+        Parameters:
+        - name (str): Name of the model.
+        - version (str, optional): Version of the model. Defaults to the last one registered.
+
+        Returns:
+        - dict: The entry ('path', 'format', 'sha256', 'size', 'registered', 'model') and its 'name' and 'version'.
+
+        Raises:
+        - KeyError: If the model or the version is not registered.
+        """
+        versions = self._read().get(name)
+        if not versions:
+            raise KeyError(f"Model '{name}' is not registered in {self.root}")
+        version = str(version) if version is not None else list(versions)[-1]
+        if version not in versions:
+            raise KeyError(f"Model '{name}' has no version {version}. Registered: {', '.join(versions)}")
+        entry = dict(versions[version], name=name, version=version)
+        entry['path'] = str(self.root / entry['path'])  # Absolute paths are kept as they are
+        return entry
+
+    def load(self, name, version=None, num_threads=None, cache=True, verify=False):
+        """
+        Load a registered model, from the process cache if it was already loaded (see load_artifact).
+
+        Parameters:
+        - name (str): Name of the model.
+        - version (str, optional): Version of the model. Defaults to the last one registered.
+        - num_threads (int, optional): Threads of the ONNX Runtime session.
+        - cache (bool, optional): Whether to use the process cache. Default is True.
+        - verify (bool, optional): Check the SHA-256 of the artifact before loading it. Default is False.
+
+        Returns:
+        - The model (see load_artifact).
+        """
+        entry = self.resolve(name, version)
+        if verify and _sha256(entry['path']) != entry['sha256']:
+            raise ValueError(f"The artifact of {name}:{entry['version']} ({entry['path']}) has been modified")
+        return load_artifact(entry['path'], entry['format'], entry['model'], num_threads=num_threads, cache=cache)
+
+
+def model_registry(config):
+    """
+    Create the ModelRegistry of the 'registry' section of the configuration and apply its cache settings:
+
+        registry:
+          path: './results/registry'
+          cache_mb: 2048  # Memory cap of the models kept loaded in each process
+
+    Parameters:
+    - config (dict): The configuration.
+
+    Returns:
+    - ModelRegistry: The registry.
+    """
+    settings = config.get('registry') or {}
+    model_cache(settings.get('cache_mb'))
+    return ModelRegistry(settings.get('path', './results/registry'))
+
+
+def load_model(config, reference, num_threads=None):
+    """
+    Load a model from a file path or from a registry reference ('name' or 'name:version'), through the
+    process cache.
+
+    Parameters:
+    - config (dict): The configuration, with the 'registry' section and the 'model' settings used for weights.
+    - reference (str): Path to an artifact, or name and optional version of a registered model.
+    - num_threads (int, optional): Threads of the ONNX Runtime session.
+
+    Returns:
+    - The model (see load_artifact).
+    """
+    registry = model_registry(config)
+    if Path(reference).is_file():
+        model_config = {key: config['model'][key] for key in ('type', 'backbone', 'classes')
+                        if isinstance(config['model'].get(key), (str, int))}
+        return load_artifact(reference, model_config=model_config, num_threads=num_threads)
+    name, _, version = reference.partition(':')
+    return registry.load(name, version or None, num_threads=num_threads)
+
+
+if __name__ == "__main__":
+    from src.models.model_loader import load_config
+
+    parser = argparse.ArgumentParser(description="Registry of trained models.")
+    parser.add_argument('--config', default='config.yml')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    register_parser = subparsers.add_parser('register', help="Add a model artifact to the registry.")
+    register_parser.add_argument('name')
+    register_parser.add_argument('path', help="Exported learner (.pkl), TorchScript (.pt), ONNX (.onnx) or weights (.pth).")
+    register_parser.add_argument('--version', default=None)
+    register_parser.add_argument('--type', default=None, help="Model type of weights (.pth).")
+    register_parser.add_argument('--backbone', default=None, help="Backbone of weights. Default: model.backbone.")
+    register_parser.add_argument('--no-copy', action='store_true', help="Record the path instead of copying.")
+
+    subparsers.add_parser('list', help="List the registered models.")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    registry = model_registry(config)
+    if args.command == 'register':
+        model_config = None
+        if args.type:
+            model_config = {'type': args.type, 'backbone': args.backbone or config['model']['backbone'],
+                            'classes': config['model']['classes']}
+        version = registry.register(args.name, args.path, args.version, model_config=model_config,
+                                    copy=not args.no_copy)
+        print(f"Registered {args.name}:{version}")
+    else:
+        for name, versions in registry.versions().items():
+            for version in versions:
+                entry = registry.resolve(name, version)
+                print(f"{name}:{version}  {entry['format']:<11}  {entry['size'] / 2 ** 20:8.1f} MiB  "
+                      f"{entry['registered']}  {entry['path']}")
@@ -0,0 +1,172 @@
+import argparse
+import copy
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from src.models.model_loader import load_config
+
+
+def sweep_runs(config):
+    """
+    Return the runs of a sweep, as configured in the 'sweep' section of the configuration:
+
+        sweep:
+          runs:  # null trains every model.type with model.backbone
+            - {type: pspnet}
+            - {type: deeplabv3_plus, backbone: resnet50}
+
+    Parameters:
+    - config (dict): The configuration.
+
+    Returns:
+    - List[dict]: The runs, with their 'name', 'type' and 'backbone'.
+    """
+    runs = (config.get('sweep') or {}).get('runs') or [{'type': t} for t in config['model']['type']]
+    sweep = []
+    for run in runs:
+        if run['type'] not in config['model']['type']:
+            raise ValueError(f"Model type '{run['type']}' is not supported. Choose from {config['model']['type']}")
+        backbone = run.get('backbone', config['model']['backbone'])
+        name = run['type'] if backbone == config['model']['backbone'] else f"{run['type']}_{backbone}"
+        sweep.append({'name': run.get('name', name), 'type': run['type'], 'backbone': backbone})
+
+    names = [run['name'] for run in sweep]
+    if len(set(names)) != len(names):
+        raise ValueError(f"The runs of a sweep must have different names: {names}")
+    return sweep
+
+
+def run_config(config, run, output_path):
+    """
+    Return the configuration of a run: its backbone, and its models, metrics, figures and checkpoints saved in
+    '<output_path>/<run name>'.
+    """
+    config = copy.deepcopy(config)
+    config['model']['backbone'] = run['backbone']
+    folder = Path(output_path) / run['name']
+    config['paths'] = {'metrics': str(folder / 'logs'), 'figures': str(folder / 'figures'),
+                       'models': str(folder / 'models')}
+    if config['training'].get('checkpoint'):
+        config['training']['checkpoint']['path'] = str(folder / 'checkpoints')
+    return config
+
+
+def _train_run(config_path, config, run, dls=None):
+    from src.models.train import train_model
+
+    start = time.perf_counter()
+    train_model(config_path, run['type'], dls=dls, config=config)
+    return run['name'], time.perf_counter() - start
+
+
+def _init_worker(slots, threads):
+    from src.data.dataset import fork_loader_workers
+    from src.models.acceleration import set_cpu_budget
+
+    fork_loader_workers()
+    set_cpu_budget(slots.get(), threads)
+
+
+def run_sweep(config_path, processes=None, threads=None, output_path=None):
+    """
+    Train several architectures or backbones on the same data and summarize their metrics.
+
+    The mask and image caches are built once, before any run. With one process, the runs are trained one after
+    the other on the same DataLoaders. With several processes, the runs are trained concurrently in separate
+    processes, each pinned to its own subset of the CPU cores (on Linux) with its own number of PyTorch threads;
+    each process builds its DataLoaders over the shared caches, so no sample is decoded again.
+
+    Parameters:
+    - config_path (str): Path to the configuration file, with a 'sweep' section (see sweep_runs).
+    - processes (int, optional): Number of runs trained concurrently. Defaults to sweep.processes (1).
+    - threads (int, optional): PyTorch threads of each run. Defaults to sweep.threads, or to the CPU cores
+                               divided among the processes.
+    - output_path (str, optional): Folder of the runs (one subfolder per run). Defaults to sweep.path.
+
+    Returns:
+    - pandas.DataFrame: The summary table (see summarize_runs), also saved as '<output_path>/summary.csv'.
+    """
+    config = load_config(config_path)
+    sweep = config.get('sweep') or {}
+    processes = processes or sweep.get('processes') or 1
+    output_path = Path(output_path or sweep.get('path', './results/sweep'))
+    runs = sweep_runs(config)
+    configs = [run_config(config, run, output_path) for run in runs]
+    print(f"Sweep of {len(runs)} runs: {', '.join(run['name'] for run in runs)}")
+
+    if processes == 1:
+        from src.data.dataset import build_dataloaders
+        from src.models.acceleration import set_cpu_budget
+        from src.models.train import build_datablock
+
+        set_cpu_budget(threads=threads or sweep.get('threads'))
+        # The DataBlock doesn't depend on the architecture: build the DataLoaders once for all the runs
+        data = build_datablock(configs[0], config_path)
+        dls = build_dataloaders(data, config['data']['path_to_dataset'], config['data'])
+        times = dict(_train_run(config_path, run_cfg, run, dls) for run_cfg, run in zip(configs, runs))
+    else:
+        from src.data.dataset import build_image_cache, build_mask_cache
+        from src.models.acceleration import available_cores
+
+        # Preprocess the dataset once; the runs read it from the caches
+        build_mask_cache(config['data']['path_to_dataset'], config_path)
+        build_image_cache(config['data']['path_to_dataset'], config_path)
+
+        cores = available_cores()
+        processes = min(processes, len(runs))
+        threads = threads or sweep.get('threads') or max(1, len(cores) // processes)
+        context = multiprocessing.get_context('spawn')
+        slots = context.Queue()
+        for i in range(processes):
+            slots.put(cores[i::processes] if len(cores) >= processes else None)
+        print(f"Training {processes} runs at a time with {threads} threads each")
+
+        with ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=_init_worker,
+                                 initargs=(slots, threads)) as executor:
+            futures = [executor.submit(_train_run, config_path, run_cfg, run) for run_cfg, run in zip(configs, runs)]
+            times = dict(future.result() for future in futures)
+
+    summary = summarize_runs(configs, runs, times)
+    summary_path = output_path / 'summary.csv'
+    summary.to_csv(summary_path, index=False)
+    print(summary.to_string(index=False, float_format='{:.4f}'.format))
+    print(f"Summary saved to {summary_path}")
+    return summary
+
+
+def summarize_runs(configs, runs, times=None):
+    """
+    Collect the metrics CSV of each run into one table.
+
+    Parameters:
+    - configs (List[dict]): The configuration of each run (see run_config).
+    - runs (List[dict]): The runs (see sweep_runs).
+    - times (dict, optional): Training time of each run, in seconds, by run name.
+
+    Returns:
+    - pandas.DataFrame: One row per run with its type, backbone, epochs, training time, last valid_loss, best
+      dice_multi and jaccard_coeff_multi and the epoch of the best dice_multi, sorted by the best dice_multi.
+    """
+    import pandas as pd
+
+    rows = []
+    for config, run in zip(configs, runs):
+        metrics = pd.read_csv(Path(config['paths']['metrics']) / f"{run['type']}_metrics.csv")
+        best = metrics.loc[metrics['dice_multi'].idxmax()]
+        rows.append({'run': run['name'], 'type': run['type'], 'backbone': run['backbone'],
+                     'epochs': len(metrics), 'train_s': (times or {}).get(run['name'], float('nan')),
+                     'valid_loss': metrics['valid_loss'].iloc[-1], 'dice_multi': best['dice_multi'],
+                     'jaccard_coeff_multi': metrics['jaccard_coeff_multi'].max(), 'best_epoch': int(best['epoch'])})
+    return pd.DataFrame(rows).sort_values('dice_multi', ascending=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train several architectures or backbones on the same data.")
+    parser.add_argument('--config', default='config.yml')
+    parser.add_argument('--processes', type=int, default=None, help="Runs trained concurrently.")
+    parser.add_argument('--threads', type=int, default=None, help="PyTorch threads of each run.")
+    parser.add_argument('--output', default=None, help="Folder of the runs.")
+    args = parser.parse_args()
+
+    run_sweep(args.config, args.processes, args.threads, args.output)
@@ -1,14 +1,18 @@
 from fastai.vision.all import *
 from src.utils.metrics import save_metrics_to_csv
-from src.data.dataset import get_items, get_y_fn
+from src.utils.profiling import profile_callback
+from src.data.dataset import datablock_getters, build_dataloaders, build_image_cache, build_mask_cache, uses_image_cache
 from src.models.model_loader import load_config, create_model
+from src.models.acceleration import acceleration_callback
+from src.models.checkpoint import checkpoint_callback
+from src.models.distributed import distributed_callback, rank0_first
 from fastai.vision.augment import aug_transforms
 from fastai.data.transforms import Normalize
-from src.utils.transforms import ShadowTransform
+from src.utils.transforms import BatchShadowTransform
 from torchvision.transforms import Resize
 
 
-def train_model(config_path, model_type):
+def train_model(config_path, model_type, dls=None, config=None):
     """
     Conduct the training process for a deep learning model.
 
@@ -19,19 +23,23 @@ def train_model(config_path, model_type):
     - config_path (str): Path to the configuration file (config.yaml), which contains settings for data,
                          model, training, and paths for saving outputs.
     - model_type (str): Type of the model to train ('pspnet', 'deeplabv3_plus', 'unet').
+    - dls (DataLoaders, optional): DataLoaders to train on, e.g. shared by the runs of a sweep (see
+                                   src.models.sweep). Built from the configuration if not given.
+    - config (dict, optional): The configuration, e.g. with overrides. Loaded from config_path if not given.
 
     Steps:
     1. Load configuration from the given path.
     2. Set up data augmentation transformations based on configuration.
-    3. Prepare the data using FastAI's DataBlock API.
+    3. Prepare the data using FastAI's DataBlock API (see build_datablock).
     4. Initialize the model specified in the configuration.
     5. Create a FastAI Learner for training.
-    6. Conduct the training process.
+    6. Conduct the training process, resuming from the latest checkpoint if enabled (see src.models.checkpoint).
     7. Save the trained model and metrics in specified paths.
     """
     # Load Configuration
-    config = load_config(config_path)
-    print("Configuration loaded successfully.")
+    if config is None:
+        config = load_config(config_path)
+        print("Configuration loaded successfully.")
 
     # Validate model type
     if model_type not in config['model']['type']:
@@ -41,24 +49,11 @@ def train_model(config_path, model_type):
     # Update model type in the configuration
     config['model']['type'] = model_type
 
-    # Data Augmentation Setup
-    batch_tfms = setup_augmentations(config['data']['augmentation'])
-    print("Data augmentation setup completed.")
-
     # Data Preparation
-    data = DataBlock(
-        blocks=(ImageBlock, MaskBlock(
-            codes=np.arange(config['model']['classes']))),
-        get_items=get_items,
-        get_y=get_y_fn,
-        splitter=RandomSplitter(
-            valid_pct=config['data']['validation_split'], seed=42),
-        item_tfms=Resize(config['data']['augmentation']['resize']),
-        batch_tfms=batch_tfms
-    )
-
-    dls = data.dataloaders(
-        config['data']['path_to_dataset'], bs=config['data']['batch_size'])
+    if dls is None:
+        # In distributed training, rank 0 builds the caches before the other processes read them
+        data = rank0_first(build_datablock, config, config_path)
+        dls = build_dataloaders(data, config['data']['path_to_dataset'], config['data'])
     print("Data preparation completed.")
 
     # Model Initialization
@@ -66,16 +61,37 @@ def train_model(config_path, model_type):
     print(f"Model '{config['model']['type']}' initialized.")
 
     # Create Learner
+    main_process = rank_distrib() == 0  # The only process that logs and saves in distributed training
+    cbs = [ShowGraphCallback()] if main_process else []
+    checkpointer = checkpoint_callback(config)
+    for callback in (distributed_callback(), acceleration_callback(config),
+                     profile_callback(config) if main_process else None, checkpointer):
+        if callback is not None:
+            cbs.append(callback)
     learner = Learner(dls, model, loss_func=FocalLoss(), metrics=[
                       foreground_acc, DiceMulti(), JaccardCoeffMulti()], 
-                      cbs=[ShowGraphCallback()])
+                      cbs=cbs)
+    if not main_process:
+        learner.remove_cb(ProgressCallback)
     print("Learner created, starting training process.")
     
+    # Resume from the latest checkpoint (the one-cycle schedule continues from start_epoch)
+    epochs = config['training']['epochs']
+    start_epoch = 0
+    if checkpointer is not None:
+        if config['training']['checkpoint'].get('resume', True):
+            start_epoch = checkpointer.resume(epochs)
+        else:
+            checkpointer.clear()
+
     # Training
     print("Starting training...")
-    learner.fit_one_cycle(config['training']['epochs'])
+    learner.fit_one_cycle(epochs, start_epoch=start_epoch)
     print("Training completed.")
 
+    if not main_process:
+        return
+
     # Save model
     model_save_path = Path(config['paths']['models']) / \
         f"{config['model']['type']}_model.pkl"
@@ -89,11 +105,45 @@ def train_model(config_path, model_type):
     # Save metrics
     metrics_save_path = Path(
         config['paths']['metrics']) / f"{config['model']['type']}_metrics.csv"
+    metrics_save_path.parent.mkdir(parents=True, exist_ok=True)
     save_metrics_to_csv(learner, file_path=metrics_save_path)
     print(f"Metrics saved at {metrics_save_path}")
     print("Training process completed and outputs saved.")
 
 
+def build_datablock(config, config_path):
+    """
+    Build the training DataBlock described by a configuration.
+
+    The class masks and images are preprocessed into their caches first (if enabled), so only new or
+    modified files are decoded.
+
+    Parameters:
+    - config (dict): The configuration, as loaded by load_config.
+    - config_path (str): Path to the configuration file.
+
+    Returns:
+    - DataBlock: The DataBlock, with the training augmentations as batch transforms.
+    """
+    # Data Augmentation Setup
+    batch_tfms = setup_augmentations(config['data']['augmentation'])
+    print("Data augmentation setup completed.")
+
+    # Preprocess the class masks and images once (only new or modified files are decoded)
+    build_mask_cache(config['data']['path_to_dataset'], config_path)
+    build_image_cache(config['data']['path_to_dataset'], config_path)
+
+    return DataBlock(
+        blocks=(ImageBlock, MaskBlock(
+            codes=np.arange(config['model']['classes']))),
+        **datablock_getters(config['data'], config_path),
+        splitter=RandomSplitter(
+            valid_pct=config['data']['validation_split'], seed=42),
+        item_tfms=None if uses_image_cache(config['data'], config_path) else Resize(config['data']['augmentation']['resize']),
+        batch_tfms=batch_tfms
+    )
+
+
 def setup_augmentations(aug_config):
     """
     Set up data augmentation transformations based on a configuration dictionary.
@@ -115,12 +165,14 @@ def setup_augmentations(aug_config):
     if 'resize' in aug_config:
         transforms_list.append(Resize(aug_config['resize']))
 
-    # Shadow transformation
+    # Shadow transformation (on the whole batch of image tensors)
     if 'shadow_transform' in aug_config:
         shadow_params = aug_config['shadow_transform']
-        transforms_list.append(ShadowTransform(num_shadows=shadow_params['num_shadows'],
-                                               min_opacity=shadow_params['min_opacity'],
-                                               max_opacity=shadow_params['max_opacity']))
+        transforms_list.append(BatchShadowTransform(num_shadows=shadow_params['num_shadows'],
+                                                    min_opacity=shadow_params['min_opacity'],
+                                                    max_opacity=shadow_params['max_opacity'],
+                                                    p=shadow_params.get('p', 1.0),
+                                                    seed=shadow_params.get('seed')))
 
     # Fastai's aug_transforms
     if 'aug_transforms' in aug_config:
@@ -0,0 +1,241 @@
+import numpy as np
+
+
+def confusion_matrix(preds, targs, num_classes):
+    """
+    Compute the confusion matrix of a segmentation with a single bincount.
+
+    Parameters:
+    - preds (numpy.ndarray): Predicted class of each pixel (any shape).
+    - targs (numpy.ndarray): True class of each pixel (same shape as preds).
+    - num_classes (int): Number of classes.
+
+    Returns:
+    - numpy.ndarray: An int64 (num_classes x num_classes) matrix whose entry [t, p] counts the pixels of
+      true class t predicted as class p.
+    """
+    preds = np.asarray(preds, dtype=np.int64).ravel()
+    targs = np.asarray(targs, dtype=np.int64).ravel()
+    return np.bincount(targs * num_classes + preds, minlength=num_classes ** 2).reshape(num_classes, num_classes)
+
+
+def dice_jaccard(cm):
+    """
+    Compute the multi-class Dice and Jaccard coefficients from a confusion matrix.
+
+    Like fastai's DiceMulti and JaccardCoeffMulti, each coefficient is averaged over the classes that
+    appear in the predictions or the targets.
+
+    Parameters:
+    - cm (numpy.ndarray): A confusion matrix as returned by confusion_matrix.
+
+    Returns:
+    - Tuple[float, float]: The mean Dice and Jaccard coefficients.
+    """
+    tp = np.diag(cm).astype(np.float64)
+    total = cm.sum(axis=0) + cm.sum(axis=1)
+    present = total > 0
+    dice = 2 * tp[present] / total[present]
+    jaccard = tp[present] / (total[present] - tp[present])
+    return float(dice.mean()), float(jaccard.mean())
+
+
+def tile_confusion_matrices(preds, targs, num_classes):
+    """
+    Compute one confusion matrix per tile of a batch with a single bincount.
+
+    Parameters:
+    - preds (numpy.ndarray): Predicted classes of a batch of tiles (N x H x W).
+    - targs (numpy.ndarray): True classes of the tiles (N x H x W).
+    - num_classes (int): Number of classes.
+
+    Returns:
+    - numpy.ndarray: An int64 (N x num_classes x num_classes) array with the confusion matrix of each tile.
+    """
+    preds = np.asarray(preds, dtype=np.int64).reshape(len(preds), -1)
+    targs = np.asarray(targs, dtype=np.int64).reshape(len(targs), -1)
+    offsets = np.arange(len(preds), dtype=np.int64)[:, None] * num_classes ** 2
+    counts = np.bincount((offsets + targs * num_classes + preds).ravel(), minlength=len(preds) * num_classes ** 2)
+    return counts.reshape(len(preds), num_classes, num_classes)
+
+
+def class_scores(cm):
+    """
+    Compute per-class segmentation metrics from a confusion matrix (or a stack of them).
+
+    Classes that appear neither in the predictions nor in the targets get NaN scores.
+
+    Parameters:
+    - cm (numpy.ndarray): A (C x C) confusion matrix or a (N x C x C) stack, as returned by confusion_matrix
+                          and tile_confusion_matrices.
+
+    Returns:
+    - dict: Arrays with the 'iou', 'dice', 'precision' and 'recall' of each class, its 'support' (number of
+      true pixels) and the 'fw_iou' (frequency-weighted IoU) of each matrix.
+    """
+    cm = np.asarray(cm, dtype=np.float64)
+    tp = np.diagonal(cm, axis1=-2, axis2=-1)
+    support = cm.sum(axis=-1)
+    predicted = cm.sum(axis=-2)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = tp / (support + predicted - tp)
+        scores = {
+            'iou': iou,
+            'dice': 2 * tp / (support + predicted),
+            'precision': tp / predicted,
+            'recall': tp / support,
+            'support': support.astype(np.int64),
+            'fw_iou': np.nansum(support * iou, axis=-1) / support.sum(axis=-1),
+        }
+    return scores
+
+
+class ConfusionMatrix:
+    """
+    Accumulate the confusion matrix of a segmentation over batches, tiles and processes.
+
+    The matrix of a dataset is the sum of the matrices of its parts, so partial results computed on different
+    batches, jobs or processes are merged by adding them, and any metric is derived from the total at the end.
+    Optionally, the matrix of every tile is kept too (C x C integers per tile) to score and rank tiles.
+
+    Parameters:
+    - num_classes (int): Number of classes.
+    - track_tiles (bool, optional): Keep the confusion matrix of each tile. Default is False.
+    """
+    def __init__(self, num_classes, track_tiles=False):
+        self.num_classes = num_classes
+        self.track_tiles = track_tiles
+        self.matrix = np.zeros((num_classes, num_classes), dtype=np.int64)
+        self.tile_names = []
+        self.tile_matrices = []
+
+    def update(self, preds, targs, names=None):
+        """
+        Add a batch of predictions.
+
+        Parameters:
+        - preds (numpy.ndarray): Predicted classes of a batch of tiles (N x H x W).
+        - targs (numpy.ndarray): True classes of the tiles (N x H x W).
+        - names (List[str], optional): Names of the tiles, used when tracking tiles. Defaults to their position.
+        """
+        if not self.track_tiles:
+            self.matrix += confusion_matrix(preds, targs, self.num_classes)
+            return
+
+        tiles = tile_confusion_matrices(preds, targs, self.num_classes)
+        self.matrix += tiles.sum(axis=0)
+        start = sum(len(m) for m in self.tile_matrices)
+        self.tile_names.extend(names if names is not None else range(start, start + len(tiles)))
+        self.tile_matrices.append(tiles)
+
+    def merge(self, other):
+        """
+        Add the matrices accumulated by another ConfusionMatrix (e.g. from another job or process).
+
+        Returns:
+        - ConfusionMatrix: self.
+        """
+        self.matrix += other.matrix
+        self.tile_names.extend(other.tile_names)
+        self.tile_matrices.extend(other.tile_matrices)
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def all_reduce(self):
+        """
+        Sum the matrix over all the processes of the default torch.distributed group (per-tile matrices stay
+        local). Does nothing if torch.distributed is not initialized.
+
+        Returns:
+        - ConfusionMatrix: self.
+        """
+        import torch
+        import torch.distributed as dist
+
+        if dist.is_available() and dist.is_initialized():
+            total = torch.from_numpy(self.matrix.copy())
+            dist.all_reduce(total, op=dist.ReduceOp.SUM)
+            self.matrix = total.numpy()
+        return self
+
+    def scores(self):
+        """
+        Per-class metrics of the accumulated matrix (see class_scores), plus the mean 'dice' and 'jaccard'
+        over the classes present, as reported by fastai's DiceMulti and JaccardCoeffMulti.
+        """
+        scores = class_scores(self.matrix)
+        scores['mean_dice'], scores['mean_jaccard'] = dice_jaccard(self.matrix)
+        return scores
+
+    def class_table(self, class_names=None):
+        """
+        Per-class metrics as a table, one row per class.
+
+        Parameters:
+        - class_names (List[str], optional): Names of the classes. Defaults to their indices.
+
+        Returns:
+        - pandas.DataFrame: The iou, dice, precision, recall and support of each class.
+        """
+        import pandas as pd
+
+        scores = class_scores(self.matrix)
+        table = pd.DataFrame({k: scores[k] for k in ('iou', 'dice', 'precision', 'recall', 'support')},
+                             index=pd.Index(class_names or range(self.num_classes), name='class'))
+        return table
+
+    def tile_table(self, class_names=None):
+        """
+        Score every tracked tile, sorted from the worst to the best mean IoU.
+
+        Parameters:
+        - class_names (List[str], optional): Names of the classes. Defaults to their indices.
+
+        Returns:
+        - pandas.DataFrame: One row per tile with its mean IoU over the classes present, its frequency-weighted
+          IoU and the IoU of each class.
+        """
+        import pandas as pd
+
+        if not self.tile_matrices:
+            return pd.DataFrame(columns=['tile', 'mean_iou', 'fw_iou'])
+        scores = class_scores(np.concatenate(self.tile_matrices))
+        with np.errstate(all='ignore'):
+            table = pd.DataFrame({'tile': self.tile_names, 'mean_iou': np.nanmean(scores['iou'], axis=1),
+                                  'fw_iou': scores['fw_iou']})
+        for c, name in enumerate(class_names or range(self.num_classes)):
+            table[f"iou_{name}"] = scores['iou'][:, c]
+        return table.sort_values('mean_iou', kind='stable').reset_index(drop=True)
+
+    def worst_tiles(self, k=10):
+        """
+        Return the k tracked tiles with the lowest mean IoU (see tile_table).
+        """
+        return self.tile_table().head(k)
+
+
+def save_class_metrics_to_csv(metrics, file_path, class_names=None):
+    """
+    Save the per-class metrics of a ConfusionMatrix to a CSV file.
+
+    Besides one row per class, the file has a 'mean' row (average over the classes present) and a
+    'frequency_weighted' row (average weighted by the number of true pixels of each class, which for the IoU
+    is the frequency-weighted IoU).
+
+    Parameters:
+    - metrics (ConfusionMatrix): The accumulated confusion matrix.
+    - file_path (str): The path where the CSV file will be saved.
+    - class_names (List[str], optional): Names of the classes. Defaults to their indices.
+    """
+    table = metrics.class_table(class_names)
+    columns = ['iou', 'dice', 'precision', 'recall']
+    support = table['support'].to_numpy()
+    table.loc['mean'] = [*np.nanmean(table[columns].to_numpy(), axis=0), support.sum()]
+    table.loc['frequency_weighted'] = [*(np.nansum(table[columns].to_numpy()[:-1] * support[:, None], axis=0)
+                                         / max(support.sum(), 1)), support.sum()]
+    table['support'] = table['support'].astype(np.int64)
+    table.to_csv(file_path)
+    print(f"Metrics saved to {file_path}")
@@ -0,0 +1,125 @@
+import numpy as np
+import yaml
+from functools import lru_cache
+
+DEFAULT_CONFIG_PATH = "config.yml"
+
+
+def pack_rgb(mask):
+    """
+    Pack the three channels of an RGB image into a single integer per pixel.
+
+    Parameters:
+    - mask (numpy.ndarray): An RGB image (H x W x 3) or an array of RGB triples (N x 3).
+
+    Returns:
+    - numpy.ndarray: An int32 array with the packed value (R << 16 | G << 8 | B) of each pixel.
+    """
+    mask = np.asarray(mask)
+    return (mask[..., 0].astype(np.int32) << 16) | (mask[..., 1].astype(np.int32) << 8) | mask[..., 2]
+
+
+class MaskCodec:
+    """
+    Convert color masks to class masks and back using precomputed lookup tables.
+
+    The color-to-class mapping is compiled once into a 2^24 entry lookup table indexed by the packed RGB
+    value of a pixel, so normalizing a mask takes a single vectorized pass regardless of the palette size.
+    Denormalizing indexes a class-to-color palette with the class mask.
+
+    Colors not present in the mapping are assigned class 0, and classes without a color are rendered black.
+    When several colors map to the same class, the last one in the mapping is used to render it.
+
+    Parameters:
+    - mapping (dict): A dictionary mapping RGB color tuples to class IDs.
+    """
+    def __init__(self, mapping):
+        self.mapping = {tuple(int(v) for v in color): int(c) for color, c in mapping.items()}
+
+        colors = np.array(list(self.mapping.keys()), dtype=np.uint8).reshape(-1, 3)
+        classes = np.array(list(self.mapping.values()), dtype=np.uint8)
+
+        # Color to class lookup table
+        self.lut = np.zeros(1 << 24, dtype=np.uint8)
+        self.lut[pack_rgb(colors)] = classes
+
+        # Class to color palette
+        self.palette = np.zeros((int(classes.max(initial=0)) + 1, 3), dtype=np.uint8)
+        for color, c in self.mapping.items():
+            self.palette[c] = color
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create a codec from the 'mapping_class_color' section of a configuration dictionary.
+
+        Parameters:
+        - config (dict): A configuration dictionary, typically loaded from config.yml.
+
+        Returns:
+        - MaskCodec: A codec for the configured palette.
+        """
+        return cls({tuple(item['color']): item['class'] for item in config['data']['mapping_class_color']})
+
+    def normalize(self, mask):
+        """
+        Convert an RGB mask into a class mask.
+
+        Parameters:
+        - mask (numpy.ndarray): An RGB image of the mask (3-channel).
+
+        Returns:
+        - numpy.ndarray: A 2D uint8 array where each pixel's value represents its class.
+
+        Raises:
+        - ValueError: If the mask is not a 3-channel RGB image.
+        """
+        if mask.ndim != 3 or mask.shape[-1] != 3:
+            raise ValueError(
+                "La máscara debe ser una imagen RGB con 3 canales de color.")
+        return self.lut[pack_rgb(mask)]
+
+    def denormalize(self, mask_class):
+        """
+        Convert a class mask back into an RGB mask.
+
+        Parameters:
+        - mask_class (numpy.ndarray): A 2D array where each pixel's value represents its class.
+
+        Returns:
+        - numpy.ndarray: An RGB image of the mask (3-channel).
+        """
+        return self.palette[mask_class]
+
+
+@lru_cache(maxsize=8)
+def get_mask_codec(mapping_items):
+    """
+    Return a cached codec for a mapping given as a tuple of (color, class) pairs.
+
+    Parameters:
+    - mapping_items (tuple): The items of a color-to-class mapping, e.g. tuple(mapping.items()).
+
+    Returns:
+    - MaskCodec: The codec for the mapping.
+    """
+    return MaskCodec(dict(mapping_items))
+
+
+@lru_cache(maxsize=None)
+def load_mask_codec(config_path=DEFAULT_CONFIG_PATH):
+    """
+    Load the mask codec defined in a configuration file.
+
+    The codec is cached per configuration path, so the file is only parsed and the lookup tables are only
+    built once per process.
+
+    Parameters:
+    - config_path (str, optional): Path to the YAML configuration file. Defaults to 'config.yml'.
+
+    Returns:
+    - MaskCodec: The codec for the palette defined in the configuration.
+    """
+    with open(config_path, 'r') as stream:
+        config = yaml.safe_load(stream)
+    return MaskCodec.from_config(config)
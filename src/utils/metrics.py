@@ -3,6 +3,10 @@ import math
 import numpy as np
 import matplotlib.pyplot as plt
 from fastai.vision.all import Recorder, patch, delegates, subplots
+# The confusion-matrix metrics are numpy-only and live in src.utils.confusion, so that inference jobs can
+# import them without fastai
+from src.utils.confusion import (ConfusionMatrix, class_scores, confusion_matrix, dice_jaccard,
+                                 save_class_metrics_to_csv, tile_confusion_matrices)
 
 @patch
 @delegates(subplots)
@@ -74,4 +78,5 @@ def save_metrics_to_csv(learner, file_path='file_metrics.csv', **kwargs):
         for epoch, metric_values in enumerate(metrics):
             writer.writerow([epoch + 1] + list(metric_values))
 
-    print(f"Metrics saved to {file_path}")
\ No newline at end of file
+    print(f"Metrics saved to {file_path}")
+
@@ -0,0 +1,141 @@
+import csv
+import resource
+import sys
+import time
+from pathlib import Path
+from fastai.callback.core import Callback
+
+STAGES = ('data_wait', 'forward', 'loss', 'backward', 'step')
+
+
+def peak_rss_mb():
+    """
+    Return the peak resident set size of the current process, in MiB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB on Linux
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+class ProfileCallback(Callback):
+    """
+    A fastai callback that measures where the time of each epoch goes.
+
+    For the training and validation phases of every epoch it records the wall time, the time spent waiting for
+    the DataLoader, in the forward pass, the loss, the backward pass and the optimizer step, the throughput
+    and the peak RSS of the process, and writes them to a CSV file when training ends (one row per epoch and
+    phase). Optionally, a window of training steps is traced with the PyTorch profiler and exported as a
+    Chrome trace (viewable in chrome://tracing or Perfetto).
+
+    Parameters:
+    - file_path (str): Path of the CSV file (e.g. next to '<model>_metrics.csv').
+    - trace_start (int, optional): First training step traced by the PyTorch profiler. Default is None (no trace).
+    - trace_steps (int, optional): Number of traced steps. Default is 5.
+    - trace_path (str, optional): Path of the Chrome trace. Defaults to the CSV path with a '_trace.json' suffix.
+    """
+    order = -10  # Time the batches before the other callbacks run
+
+    def __init__(self, file_path, trace_start=None, trace_steps=5, trace_path=None):
+        self.file_path = Path(file_path)
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+        self.trace_path = Path(trace_path) if trace_path else self.file_path.with_name(
+            f"{self.file_path.stem}_trace.json")
+        self.rows = []
+        self.profiler = None
+
+    def before_fit(self):
+        self.rows = []
+        if self.trace_start is not None:
+            from torch.profiler import ProfilerActivity, profile, schedule
+
+            self.trace_path.parent.mkdir(parents=True, exist_ok=True)
+            self.profiler = profile(activities=[ProfilerActivity.CPU], record_shapes=True,
+                                    schedule=schedule(wait=max(self.trace_start - 1, 0),
+                                                      warmup=min(self.trace_start, 1),
+                                                      active=self.trace_steps, repeat=1),
+                                    on_trace_ready=lambda prof: prof.export_chrome_trace(str(self.trace_path)))
+            self.profiler.__enter__()
+
+    def _start_phase(self):
+        self.times = dict.fromkeys(STAGES, 0.0)
+        self.n_batches = self.n_samples = 0
+        self.phase_start = self.last = time.perf_counter()
+
+    def _end_phase(self, phase):
+        wall = time.perf_counter() - self.phase_start
+        row = {'epoch': self.epoch + 1, 'phase': phase, 'batches': self.n_batches, 'samples': self.n_samples,
+               'wall_s': wall, **{f"{stage}_s": value for stage, value in self.times.items()},
+               'other_s': wall - sum(self.times.values()),
+               'batches_per_sec': self.n_batches / wall if wall > 0 else 0.0,
+               'samples_per_sec': self.n_samples / wall if wall > 0 else 0.0,
+               'peak_rss_mb': peak_rss_mb()}
+        self.rows.append(row)
+
+    def before_train(self): self._start_phase()
+    def after_train(self): self._end_phase('train')
+    def before_validate(self): self._start_phase()
+    def after_validate(self): self._end_phase('valid')
+
+    def _lap(self, stage):
+        now = time.perf_counter()
+        self.times[stage] += now - self.last
+        self.last = now
+
+    def before_batch(self):
+        # Time since the end of the previous batch: fetching and collating the next one
+        self._lap('data_wait')
+
+    def after_pred(self): self._lap('forward')
+    def after_loss(self): self._lap('loss')
+    def before_backward(self): self.last = time.perf_counter()
+    def after_backward(self): self._lap('backward')
+    def before_step(self): self.last = time.perf_counter()
+    def after_step(self): self._lap('step')
+
+    def after_batch(self):
+        self.n_batches += 1
+        self.n_samples += len(self.xb[0]) if self.xb else 0
+        if self.training and self.profiler is not None:
+            self.profiler.step()
+        self.last = time.perf_counter()
+
+    def after_fit(self):
+        if self.profiler is not None:
+            self.profiler.__exit__(None, None, None)
+            self.profiler = None
+            if self.trace_path.exists():
+                print(f"Profiler trace saved to {self.trace_path}")
+
+        if not self.rows:
+            return
+        self.file_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.file_path, mode='w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=list(self.rows[0]))
+            writer.writeheader()
+            writer.writerows(self.rows)
+        print(f"Profile saved to {self.file_path}")
+
+
+def profile_callback(config):
+    """
+    Create the ProfileCallback configured in the 'profiling' section of the configuration, if enabled:
+
+        profiling:
+          enabled: true
+          trace_start: 10  # First training step traced by the PyTorch profiler (null for no trace)
+          trace_steps: 5
+
+    The profile is written to '<model>_profile.csv' in the metrics folder, next to '<model>_metrics.csv'.
+
+    Parameters:
+    - config (dict): The configuration, with the model type already selected.
+
+    Returns:
+    - ProfileCallback or None: The callback, or None if profiling is disabled.
+    """
+    profiling = config.get('profiling') or {}
+    if not profiling.get('enabled', False):
+        return None
+    return ProfileCallback(Path(config['paths']['metrics']) / f"{config['model']['type']}_profile.csv",
+                           trace_start=profiling.get('trace_start'), trace_steps=profiling.get('trace_steps', 5))
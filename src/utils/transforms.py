@@ -1,7 +1,9 @@
 import numpy as np
 import cv2
-from PIL import Image as PILImage
+import torch
 from fastai.vision.augment import Transform
+from fastai.vision.core import PILImage, TensorImage
+from src.utils.mask_codec import get_mask_codec
 import random
 
 def normalize_mask(mask, mapping):
@@ -9,7 +11,8 @@ def normalize_mask(mask, mapping):
     Normalize a mask image based on a color-to-class mapping.
 
     This function converts a color mask (RGB) into a class mask where each pixel's class is determined
-    by its color according to the provided mapping.
+    by its color according to the provided mapping. The mapping is compiled into a lookup table on
+    first use (see MaskCodec), so the conversion is a single vectorized pass over the image.
 
     Parameters:
     - mask (numpy.ndarray): An RGB image of the mask (3-channel).
@@ -21,36 +24,23 @@ def normalize_mask(mask, mapping):
     Raises:
     - ValueError: If the mask is not a 3-channel RGB image.
     """
-    if mask.ndim != 3 or mask.shape[-1] != 3:
-        raise ValueError(
-            "La máscara debe ser una imagen RGB con 3 canales de color.")
-    h, w, _ = mask.shape
-    mask_class = np.zeros((h, w), dtype=np.uint8)
-    for color, c in mapping.items():
-        mask_class[(mask == color).all(axis=-1)] = c
-    return mask_class
+    return get_mask_codec(tuple(mapping.items())).normalize(mask)
 
 def denormalize_mask(mask_class, mapeo):
     """
     Denormalize a class mask back to a color mask using the provided mapping.
 
     This function converts a class mask, where each pixel's value represents its class, back to a
-    color mask (RGB) using an inverse mapping of class IDs to RGB colors.
+    color mask (RGB) by indexing a class-to-color palette built from the mapping.
 
     Parameters:
     - mask_class (numpy.ndarray): A 2D array where each pixel's value represents its class.
-    - mapeo (dict): A dictionary mapping class IDs to RGB color tuples.
+    - mapeo (dict): A dictionary mapping RGB color tuples to class IDs (the mapping given to normalize_mask).
 
     Returns:
     - numpy.ndarray: An RGB image of the mask (3-channel).
     """
-    inverse_map = {v: k for k, v in mapeo.items()}
-    h, w = mask_class.shape
-    mask_color = np.zeros((h, w, 3), dtype=np.uint8)
-    for c in np.unique(mask_class):
-        color = inverse_map[c]
-        mask_color[mask_class == c] = color
-    return mask_color
+    return get_mask_codec(tuple(mapeo.items())).denormalize(mask_class)
 
 def add_shadow(image, num_shadows, min_opacity, max_opacity):
     """
@@ -105,7 +95,113 @@ class ShadowTransform(Transform):
         self.max_opacity = max_opacity
 
     def encodes(self, x: PILImage):
-        return add_shadow(x, self.num_shadows, self.min_opacity, self.max_opacity)
+        return PILImage.create(add_shadow(np.array(x), self.num_shadows, self.min_opacity, self.max_opacity))
+
+def random_quad_masks(n, height, width, generator=None, device=None):
+    """
+    Rasterize n random quadrilaterals at once.
+
+    The vertices are drawn uniformly over the image, like in add_shadow, and a pixel is inside a quadrilateral
+    when its center is, following the even-odd rule (so self-intersecting quadrilaterals are also filled like
+    cv2.fillPoly does). Only the crossings of the edges with each row are computed; the pixels are then filled
+    with a cumulative sum along the rows.
+
+    Parameters:
+    - n (int): The number of quadrilaterals.
+    - height (int): The height of the masks.
+    - width (int): The width of the masks.
+    - generator (torch.Generator, optional): The random generator (on the CPU).
+    - device (torch.device, optional): The device of the masks. Defaults to the CPU.
+
+    Returns:
+    - torch.Tensor: A boolean tensor (n x height x width).
+    """
+    scale = torch.tensor([width, height], dtype=torch.float32)
+    vertices = (torch.rand(n, 4, 2, generator=generator) * scale).to(device)
+    ax, ay = vertices[..., 0].unsqueeze(1), vertices[..., 1].unsqueeze(1)
+    bx, by = ax.roll(-1, dims=2), ay.roll(-1, dims=2)
+    py = torch.arange(height, dtype=torch.float32, device=device).view(1, height, 1) + 0.5
+
+    # Scanline: column where each edge crosses each row (n x height x 4), if it crosses it
+    crosses = (ay > py) != (by > py)
+    x_cross = ax + (py - ay) * (bx - ax) / torch.where(by == ay, torch.ones_like(by), by - ay)
+    first = (torch.floor(x_cross - 0.5) + 1).clamp(0, width).long()
+
+    # Every crossing toggles the pixels to its right; the parity of the toggles is the even-odd rule
+    toggles = torch.zeros(n, height, width + 1, dtype=torch.uint8, device=device)
+    toggles.scatter_add_(2, first, crosses.to(torch.uint8))
+    return (toggles.cumsum(dim=2, dtype=torch.uint8)[..., :width] & 1).bool()
+
+def add_shadow_batch(images, num_shadows, min_opacity, max_opacity, p=1.0, generator=None):
+    """
+    Add random shadow effects to a batch of images at once.
+
+    Each image gets num_shadows random quadrilateral shadows, each with its own opacity; a shadow of opacity
+    alpha scales the pixels it covers by (1 - alpha), as the blending of add_shadow does, and overlapping
+    shadows compound.
+
+    Parameters:
+    - images (torch.Tensor): A float batch of images (N x C x H x W).
+    - num_shadows (int): The number of shadows to add to each image.
+    - min_opacity (float): The minimum opacity of the shadows (0 to 1).
+    - max_opacity (float): The maximum opacity of the shadows (0 to 1).
+    - p (float, optional): The probability of adding shadows to each image. Default is 1.0.
+    - generator (torch.Generator, optional): The random generator (on the CPU), for reproducibility.
+
+    Returns:
+    - torch.Tensor: The images with added shadow effects.
+    """
+    n, _, height, width = images.shape
+    if num_shadows <= 0 or n == 0:
+        return images
+
+    masks = random_quad_masks(n * num_shadows, height, width, generator, images.device)
+    masks = masks.view(n, num_shadows, height, width)
+    alpha = torch.empty(n, num_shadows).uniform_(min_opacity, max_opacity, generator=generator)
+    alpha *= (torch.rand(n, 1, generator=generator) < p)
+    keep = (1 - alpha).to(device=images.device, dtype=images.dtype).view(n, num_shadows, 1, 1)
+
+    # Multiply the attenuation of every shadow covering each pixel, on plain tensors (the fastai tensor
+    # subclasses add overhead to every operation)
+    images = images.as_subclass(torch.Tensor)
+    factor = torch.ones(n, 1, height, width, dtype=images.dtype, device=images.device)
+    one = torch.ones((), dtype=images.dtype, device=images.device)
+    for i in range(num_shadows):
+        factor.mul_(torch.where(masks[:, i:i + 1], keep[:, i:i + 1], one))
+    return images * factor
+
+class BatchShadowTransform(Transform):
+    """
+    A batch transform that adds random shadows to the images of a FastAI batch, on tensors.
+
+    Unlike ShadowTransform, which works on one PIL image at a time, the shadows of the whole batch are
+    rasterized and blended at once in the main process, after the images are converted to float tensors and
+    before they are normalized. Masks are left untouched, and it only runs on the training set.
+
+    Parameters:
+    - num_shadows (int): The number of shadows to add to each image.
+    - min_opacity (float): The minimum opacity of the shadows (0 to 1).
+    - max_opacity (float): The maximum opacity of the shadows (0 to 1).
+    - p (float, optional): The probability of adding shadows to each image. Default is 1.0.
+    - seed (int, optional): The seed of the random generator, for reproducible shadows. Default is None.
+    """
+    order = 20
+    split_idx = 0
+
+    def __init__(self, num_shadows=3, min_opacity=0.25, max_opacity=0.5, p=1.0, seed=None):
+        super().__init__()
+        self.num_shadows = num_shadows
+        self.min_opacity = min_opacity
+        self.max_opacity = max_opacity
+        self.p = p
+        self.generator = torch.Generator()
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+
+    def encodes(self, x: TensorImage):
+        return add_shadow_batch(x, self.num_shadows, self.min_opacity, self.max_opacity, self.p, self.generator)
 
 if __name__ == "__main__":
     img_path = "data/external/UDD/UDD5/train/src/DJI_0300.JPG"